@@ -0,0 +1,856 @@
+#!/usr/bin/env python3
+"""
+Benchmark camera discovery against synthetic Home Assistant data.
+
+Generates synthetic .storage files (core.entity_registry, core.device_registry,
+core.config_entries) and starts local stand-in servers for the HA API
+(/api/template, /api/states, config entries), go2rtc (/api/streams), a
+UniFi Protect NVR (login, bootstrap, cameras) and an RTSP responder for
+stream probing (a share of its streams answer 404), with optional injected
+latency.
+Each scenario runs discovery in a fresh subprocess and reports wall time,
+per-phase time (from the built-in discovery metrics), peak RSS and request
+counts.
+
+Not part of the add-on image; run it from a checkout:
+
+    python3 benchmark_discovery.py --sizes 1000:10,10000:100,100000:1000 --runs 2
+    python3 benchmark_discovery.py --sizes 20000:200 --latency-ms 50 --json bench.json
+    python3 benchmark_discovery.py --sizes 5000:500 --probe drop --dead-streams 20
+
+--check runs a few behaviour self-checks instead (camera matching and naming, and
+events from stand-in HA and UniFi Protect WebSockets).
+"""
+
+import argparse
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import os
+import queue
+import random
+import resource
+import shutil
+import socket
+import socketserver
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# =============================================================================
+# Synthetic data
+# =============================================================================
+
+def fake_mac(i: int) -> str:
+    return f"AC8BA9{i:06X}"
+
+
+def generate_fixtures(storage_dir: str, entities: int, cameras: int, nvr_host: str,
+                      rtsp_host: str = "192.0.2.1:554", seed: int = 42) -> Dict:
+    """Write synthetic .storage files and return the matching API payloads."""
+    rng = random.Random(seed)
+    os.makedirs(storage_dir, exist_ok=True)
+
+    unifi_count = cameras // 2
+    registry_entities, devices, states = [], [], []
+    go2rtc_streams, nvr_cameras = {}, []
+    platforms = ["hue", "zha", "mqtt", "esphome", "shelly", "template", "sun", "met"]
+
+    for i in range(entities):
+        device_id = f"dev{i:08x}"
+        if i < cameras:
+            is_unifi = i < unifi_count
+            name = f"Camera {i} {rng.choice(['Front', 'Back', 'Garage', 'Porch', 'Yard'])}"
+            slug = name.lower().replace(" ", "_")
+            entity_id = f"camera.{slug}_high" if is_unifi else f"camera.{slug}"
+            platform = "unifiprotect" if is_unifi else "generic"
+            unique_id = f"{fake_mac(i)}_0" if is_unifi else f"generic-{i}"
+            devices.append({
+                "id": device_id, "name": name, "name_by_user": None,
+                "connections": [["mac", fake_mac(i)]] if is_unifi else [],
+                "identifiers": [[platform, unique_id]], "manufacturer": "Ubiquiti" if is_unifi else "Generic",
+                "model": "G4 Bullet", "config_entries": ["unifi-entry" if is_unifi else f"entry{i}"],
+            })
+            attributes = {"friendly_name": name, "access_token": f"{rng.getrandbits(128):032x}",
+                          "entity_picture": f"/api/camera_proxy/{entity_id}?token=x",
+                          "supported_features": 2, "frontend_stream_type": "hls"}
+            if not is_unifi:
+                attributes["stream_source"] = f"rtsp://{rtsp_host}/stream{i}"
+                if i % 3 == 0:
+                    go2rtc_streams[slug] = {"producers": [{"url": f"rtsp://{rtsp_host}/stream{i}"}]}
+            else:
+                nvr_cameras.append({
+                    "id": f"cam{i:08x}", "mac": fake_mac(i), "name": name, "state": "CONNECTED",
+                    "isConnected": True, "type": "UVC G4 Bullet",
+                    "channels": [
+                        {"id": ch, "name": q, "enabled": True, "isRtspEnabled": True,
+                         "rtspAlias": f"{rng.getrandbits(64):016x}", "width": w, "height": h,
+                         "fps": fps, "bitrate": br}
+                        for ch, (q, w, h, fps, br) in enumerate([
+                            ("High", 2688, 1512, 30, 8000000),
+                            ("Medium", 1280, 720, 30, 2000000),
+                            ("Low", 640, 360, 15, 300000)])
+                    ],
+                    "featureFlags": {"hasSmartDetect": True, "videoModes": ["default"]},
+                    "ispSettings": {k: rng.randint(0, 100) for k in ("brightness", "contrast", "hue")},
+                })
+        else:
+            platform = rng.choice(platforms)
+            entity_id = f"sensor.synthetic_{i}"
+            unique_id = f"{platform}-{i}"
+            if i % 4 == 0:
+                devices.append({"id": device_id, "name": f"Device {i}", "name_by_user": None,
+                                "connections": [["mac", f"02:00:{i >> 16 & 255:02x}:{i >> 8 & 255:02x}:{i & 255:02x}:00"]],
+                                "identifiers": [[platform, unique_id]], "config_entries": [f"entry{i}"]})
+            attributes = {"friendly_name": f"Synthetic {i}", "unit_of_measurement": "W",
+                          "device_class": "power", "state_class": "measurement"}
+
+        registry_entities.append({
+            "aliases": [], "area_id": None, "capabilities": None, "categories": {},
+            "config_entry_id": f"entry{i}", "device_class": None,
+            "device_id": device_id, "disabled_by": None, "entity_category": None,
+            "entity_id": entity_id, "hidden_by": None, "icon": None, "id": f"{rng.getrandbits(64):016x}",
+            "has_entity_name": True, "labels": [], "name": None,
+            "options": {"conversation": {"should_expose": False}},
+            "original_name": None, "platform": platform, "translation_key": None,
+            "unique_id": unique_id,
+        })
+        states.append({"entity_id": entity_id, "state": "idle" if i < cameras else str(rng.random()),
+                       "attributes": attributes, "last_changed": "2026-01-01T00:00:00+00:00",
+                       "last_updated": "2026-01-01T00:00:00+00:00",
+                       "context": {"id": f"{rng.getrandbits(64):016x}", "parent_id": None, "user_id": None}})
+
+    config_entries = [{"entry_id": f"entry{i}", "domain": rng.choice(platforms), "title": f"Entry {i}",
+                       "data": {}, "options": {}} for i in range(max(10, entities // 100))]
+    if unifi_count:
+        config_entries.append({"entry_id": "unifi-entry", "domain": "unifiprotect", "title": "NVR",
+                               "data": {"host": nvr_host, "username": "bench", "password": "bench"},
+                               "options": {}})
+
+    def write(filename: str, key: str, data: Dict):
+        with open(os.path.join(storage_dir, filename), "w") as f:
+            json.dump({"version": 1, "minor_version": 1, "key": key, "data": data}, f, indent=2)
+
+    write("core.entity_registry", "core.entity_registry",
+          {"entities": registry_entities, "deleted_entities": []})
+    write("core.device_registry", "core.device_registry",
+          {"devices": devices, "deleted_devices": []})
+    write("core.config_entries", "core.config_entries", {"entries": config_entries})
+
+    # The bootstrap carries much more than cameras; pad it like a busy NVR
+    filler = max(10, entities // 20)
+    bootstrap = {
+        "authUserId": "bench", "accessKey": "x", "lastUpdateId": "bench-update-1",
+        "nvr": {"id": "nvr", "name": "NVR", "version": "4.0.0"},
+        "users": [{"id": f"user{i}", "name": f"User {i}", "permissions": ["x"] * 10} for i in range(50)],
+        "cameras": nvr_cameras,
+        "sensors": [{"id": f"sensor{i}", "name": f"Sensor {i}", "stats": {"temp": i}} for i in range(filler)],
+        "lights": [{"id": f"light{i}", "name": f"Light {i}"} for i in range(filler // 2)],
+        "events": [{"id": f"event{i}", "type": "motion", "score": 50} for i in range(filler * 2)],
+    }
+    return {
+        "states": states,
+        "camera_states": [s for s in states if s["entity_id"].startswith("camera.")],
+        "config_entries": config_entries,
+        "go2rtc": go2rtc_streams,
+        "bootstrap": bootstrap,
+    }
+
+
+# =============================================================================
+# Stand-in servers
+# =============================================================================
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class WebSocketPeer:
+    """Server side of one stand-in WebSocket connection (unfragmented frames only)."""
+
+    def __init__(self, path: str, sock, rfile, wfile):
+        self.path = path  # request path, with query
+        self.sock = sock
+        self.rfile = rfile
+        self.wfile = wfile
+        self._lock = threading.Lock()
+
+    def _frame(self, opcode: int, payload: bytes):
+        size = len(payload)
+        if size < 126:
+            header = struct.pack("!BB", 0x80 | opcode, size)
+        elif size < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, size)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, size)
+        with self._lock:
+            self.wfile.write(header + payload)
+            self.wfile.flush()
+
+    def send(self, data: Union[str, bytes]):
+        """Send a text (str) or binary (bytes) message."""
+        if isinstance(data, str):
+            self._frame(0x1, data.encode())
+        else:
+            self._frame(0x2, data)
+
+    def recv(self) -> Optional[Union[str, bytes]]:
+        """Next client message (pings are answered); None once the connection is closed."""
+        while True:
+            header = self.rfile.read(2)
+            if len(header) < 2:
+                return None
+            opcode, size = header[0] & 0x0F, header[1] & 0x7F
+            if size == 126:
+                size = struct.unpack("!H", self.rfile.read(2))[0]
+            elif size == 127:
+                size = struct.unpack("!Q", self.rfile.read(8))[0]
+            mask = self.rfile.read(4) if header[1] & 0x80 else b"\0\0\0\0"
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.rfile.read(size)))
+            if opcode == 0x8:
+                return None
+            if opcode == 0x9:
+                self._frame(0xA, payload)
+            elif opcode == 0x1:
+                return payload.decode()
+            elif opcode == 0x2:
+                return payload
+
+    def close(self):
+        """Drop the connection, like a server restart would."""
+        try:
+            self._frame(0x8, b"")
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class StubServer:
+    """Threaded HTTP(S) server with per-path request counters and injected latency.
+
+    ``websockets`` maps paths to session functions; a WebSocket upgrade on
+    such a path runs the function with a WebSocketPeer until it returns.
+    """
+
+    def __init__(self, name: str, routes: Dict[Tuple[str, str], bytes], latency: float = 0.0,
+                 tls: Optional[ssl.SSLContext] = None,
+                 websockets: Optional[Dict[str, Callable[[WebSocketPeer], None]]] = None):
+        self.name = name
+        self.routes = routes
+        self.websockets = websockets or {}
+        self.latency = latency
+        self.requests = {}
+        self.bytes_sent = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, method: str):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                path = self.path.split("?", 1)[0]
+                stub.requests[f"{method} {path}"] = stub.requests.get(f"{method} {path}", 0) + 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                body = stub.routes.get((method, path))
+                if body is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if path == "/api/auth/login":
+                    self.send_header("Set-Cookie", "TOKEN=bench; path=/")
+                self.end_headers()
+                self.wfile.write(body)
+                stub.bytes_sent += len(body)
+
+            def _websocket(self, session: Callable[[WebSocketPeer], None]):
+                path = self.path.split("?", 1)[0]
+                stub.requests[f"WS {path}"] = stub.requests.get(f"WS {path}", 0) + 1
+                key = self.headers.get("Sec-WebSocket-Key", "")
+                accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest())
+                self.send_response(101, "Switching Protocols")
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept.decode())
+                self.end_headers()
+                self.close_connection = True
+                try:
+                    session(WebSocketPeer(self.path, self.connection, self.rfile, self.wfile))
+                except OSError:
+                    pass
+
+            def do_GET(self):
+                session = stub.websockets.get(self.path.split("?", 1)[0])
+                if session and self.headers.get("Upgrade", "").lower() == "websocket":
+                    self._websocket(session)
+                else:
+                    self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        if tls is not None:
+            self.server.socket = tls.wrap_socket(self.server.socket, server_side=True)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class RTSPStub:
+    """Minimal RTSP responder: answers OPTIONS/DESCRIBE, 404 for "dead" streams.
+
+    Stream ``/streamN`` is dead if N % 100 < dead_percent.
+    """
+
+    def __init__(self, dead_percent: int = 0, latency: float = 0.0):
+        self.name = "rtsp"
+        self.requests = {}
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    request_line = self.rfile.readline().decode("latin-1").strip()
+                    if not request_line:
+                        return
+                    headers = {}
+                    for line in iter(self.rfile.readline, b"\r\n"):
+                        if not line:
+                            return
+                        name, _, value = line.decode("latin-1").partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                    method, url = request_line.split()[:2]
+                    stub.requests[method] = stub.requests.get(method, 0) + 1
+                    if latency:
+                        time.sleep(latency)
+                    stream = url.rsplit("/", 1)[-1]
+                    number = int(stream[6:]) if stream[6:].isdigit() else 0
+                    cseq = headers.get("cseq", "0")
+                    if number % 100 < dead_percent:
+                        reply = f"RTSP/1.0 404 Not Found\r\nCSeq: {cseq}\r\n\r\n"
+                    elif method == "DESCRIBE":
+                        sdp = "v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=bench\r\nm=video 0 RTP/AVP 96\r\n"
+                        reply = (f"RTSP/1.0 200 OK\r\nCSeq: {cseq}\r\nContent-Type: application/sdp\r\n"
+                                 f"Content-Length: {len(sdp)}\r\n\r\n{sdp}")
+                    else:
+                        reply = f"RTSP/1.0 200 OK\r\nCSeq: {cseq}\r\nPublic: OPTIONS, DESCRIBE\r\n\r\n"
+                    self.wfile.write(reply.encode())
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            request_queue_size = 128  # the prober connects many streams at once
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def protect_packet(action: Dict, data: Dict) -> bytes:
+    """UniFi Protect updates packet: an action and a data frame, JSON, not deflated."""
+    packet = b""
+    for packet_type, payload in ((1, action), (2, data)):
+        body = json.dumps(payload).encode()
+        packet += struct.pack("!BBBBI", packet_type, 1, 0, 0, len(body)) + body
+    return packet
+
+
+class ProtectUpdatesStub:
+    """Session for the NVR stub's updates WebSocket: sends the queued packets."""
+
+    def __init__(self):
+        self.packets = queue.Queue()
+        self.connections = queue.Queue()  # one WebSocketPeer per connection
+
+    def __call__(self, peer: WebSocketPeer):
+        closed = threading.Event()
+
+        def read():
+            while peer.recv() is not None:
+                pass
+            closed.set()
+
+        threading.Thread(target=read, daemon=True).start()
+        self.connections.put(peer)
+        while not closed.is_set():
+            try:
+                peer.send(self.packets.get(timeout=0.2))
+            except queue.Empty:
+                continue
+
+
+def make_tls_context(workdir: str) -> Optional[ssl.SSLContext]:
+    """Self-signed server context for the NVR stub (needs the openssl CLI)."""
+    if not shutil.which("openssl"):
+        return None
+    cert, key = os.path.join(workdir, "nvr.crt"), os.path.join(workdir, "nvr.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key,
+                    "-out", cert, "-days", "1", "-subj", "/CN=127.0.0.1"],
+                   check=True, capture_output=True)
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(cert, key)
+    return ctx
+
+
+# =============================================================================
+# Self-checks (--check): behaviour the timings do not show
+# =============================================================================
+
+def check_camera_matching(dc) -> List[str]:
+    """Source names must only match cameras they (nearly) fully name."""
+    matcher = dc.CameraMatcher()
+    for entity_id, name in (("camera.front_door", "Front Door"),
+                            ("camera.living_room", "Living Room"),
+                            ("camera.garage_side", "Garage Side"),
+                            ("camera.garage", "Garage"),
+                            ("camera.driveway_cam", "Driveway Camera")):
+        matcher.add(entity_id, name)
+
+    expected = {
+        "Back Door": None,
+        "Dining Room": None,
+        "Side Yard": None,
+        "Garage": "camera.garage",
+        "Front Door Cam": "camera.front_door",
+        "Driveway": "camera.driveway_cam",
+        "frontdoor": "camera.front_door",
+    }
+    failures = []
+    for name, entity_id in expected.items():
+        got = matcher.assign({name: {"name": name}}).get(name)
+        if got != entity_id:
+            failures.append(f"{name!r} matched {got}, expected {entity_id}")
+    return failures
+
+
+def check_same_name_cameras(dc) -> List[str]:
+    """Unmatched cameras with the same name on two consoles are both kept."""
+    resolver = dc.CameraResolver()
+    for cid, host in (("camera.garage", "10.0.0.1"), ("camera.garage@10.0.0.2", "10.0.0.2")):
+        resolver.add({"source": dc.SOURCE_UNIFI, "id": cid, "name": "Garage",
+                      "urls": [f"rtsps://{host}:7441/alias"], "keys": [], "info": {"nvr": host}})
+    for name in dc.SOURCES:
+        resolver.source_done(name)
+    urls = sorted(cam["stream_url"] for cam in resolver.finish())
+    expected = ["rtsps://10.0.0.1:7441/alias", "rtsps://10.0.0.2:7441/alias"]
+    return [] if urls == expected else [f"got {urls}, expected {expected}"]
+
+
+def check_config_diff(dc) -> List[str]:
+    """A camera added under an existing name still restarts the gateway."""
+    old = {"cameras": [{"name": "Garage", "url": "rtsp://nvr/a"}]}
+    new = {"cameras": [{"name": "Garage", "url": "rtsp://nvr/b"}, {"name": "Garage", "url": "rtsp://nvr/a"}]}
+    failures = []
+    for before, after, key in ((old, new, "added"), (new, old, "removed")):
+        diff = dc.diff_monocle_configs(before, after)
+        if diff[key] != ["Garage"] or not diff["restart"]:
+            failures.append(f"{len(before['cameras'])} -> {len(after['cameras'])} Garage cameras: {diff}")
+    if dc.diff_monocle_configs(new, {"cameras": new["cameras"][::-1]})["restart"]:
+        failures.append("reordering same-named cameras restarts the gateway")
+    return failures
+
+
+class SkipCheck(Exception):
+    """A self-check cannot run here (e.g. an optional package is missing)."""
+
+
+def ha_event(event_type: str, data: Dict) -> str:
+    """HA WebSocket event message, compact like HA sends it."""
+    return json.dumps({"id": 4, "type": "event", "event": {"event_type": event_type, "data": data}},
+                      separators=(",", ":"))
+
+
+def wait_for_refresh(service, timeout: float = 10.0) -> Tuple[Optional[set], float]:
+    """Run the service's scheduler wait once; returns (sources, seconds waited)."""
+    result = queue.Queue()
+    start = time.monotonic()
+    threading.Thread(target=lambda: result.put(service._wait_for_work()), daemon=True).start()
+    try:
+        sources = result.get(timeout=timeout)
+    except queue.Empty:
+        sources = None
+        service.stop()
+    return sources, time.monotonic() - start
+
+
+def check_ha_events(dc) -> List[str]:
+    """HA events over the WebSocket trigger one debounced refresh of the right sources."""
+    if dc.websocket is None:
+        raise SkipCheck("websocket-client not installed")
+    sessions = queue.Queue()
+
+    def session(peer: WebSocketPeer):
+        peer.send(json.dumps({"type": "auth_required"}))
+        auth = json.loads(peer.recv())
+        peer.send(json.dumps({"type": "auth_ok" if auth.get("access_token") == "bench" else "auth_invalid"}))
+        for _ in dc.HAEventListener.SUBSCRIPTIONS:
+            msg = json.loads(peer.recv())
+            peer.send(json.dumps({"id": msg["id"], "type": "result", "success": True, "result": None}))
+        sessions.put(peer)
+        while peer.recv() is not None:
+            pass
+
+    ha = StubServer("ha", {}, websockets={"/core/websocket": session})
+    workdir = tempfile.mkdtemp(prefix="monocle-check-")
+    service = dc.DiscoveryService({"discovery_mode": "events"},
+                                  config_path=os.path.join(workdir, "monocle.json"))
+    service.DEBOUNCE_SECONDS = 0.3
+    service.listener = dc.HAEventListener(service.mark_dirty, url=f"ws://127.0.0.1:{ha.port}/core/websocket",
+                                          token="bench")
+    service.listener.REGISTRY_SAVE_DELAY = 1.0
+    service.listener.start()
+    failures = []
+    try:
+        peer = sessions.get(timeout=10)
+
+        # A burst: registry change, an unrelated entity, a camera attribute change
+        camera = {"entity_id": "camera.porch", "state": "idle", "attributes": {"friendly_name": "Porch"}}
+        renamed = dict(camera, attributes={"friendly_name": "Front Porch"})
+        peer.send(ha_event("entity_registry_updated", {"action": "create", "entity_id": "camera.garage"}))
+        peer.send(ha_event("state_changed", {"entity_id": "sensor.power", "old_state": {}, "new_state": {}}))
+        peer.send(ha_event("state_changed", {"entity_id": "camera.porch", "old_state": camera,
+                                             "new_state": renamed}))
+        sources, waited = wait_for_refresh(service)
+        expected = {dc.SOURCE_ENTITIES, dc.SOURCE_UNIFI}
+        if sources != expected:
+            failures.append(f"burst refreshed {sources}, expected {expected}")
+        elif waited < service.DEBOUNCE_SECONDS:
+            failures.append(f"burst refreshed after {waited:.2f}s, before the debounce")
+
+        # The registry change is refreshed again once HA has saved the registry files
+        sources, waited = wait_for_refresh(service)
+        if sources != expected:
+            failures.append(f"registry follow-up refreshed {sources}, expected {expected}")
+
+        # A camera state change alone is not a discovery change; a later attribute change is
+        streaming = dict(renamed, state="streaming")
+        peer.send(ha_event("state_changed", {"entity_id": "camera.porch", "old_state": renamed,
+                                             "new_state": streaming}))
+        time.sleep(service.DEBOUNCE_SECONDS)
+        moved = dict(streaming, attributes={"friendly_name": "Front Porch", "stream_source": "rtsp://x/1"})
+        peer.send(ha_event("state_changed", {"entity_id": "camera.porch", "old_state": streaming,
+                                             "new_state": moved}))
+        sources, _ = wait_for_refresh(service)
+        if sources != {dc.SOURCE_ENTITIES}:
+            failures.append(f"attribute change refreshed {sources}, expected {{'entities'}}")
+
+        # Events may have been missed while disconnected: everything is refreshed
+        peer.close()
+        sources, _ = wait_for_refresh(service)
+        if sources != set(dc.SOURCES):
+            failures.append(f"reconnect refreshed {sources}, expected all sources")
+        if ha.requests.get("WS /core/websocket") != 2:
+            failures.append(f"{ha.requests.get('WS /core/websocket')} connections, expected 2")
+    except queue.Empty:
+        failures.append("listener did not connect and subscribe")
+    finally:
+        service.listener.stop()
+        ha.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return failures
+
+
+def check_unifi_updates(dc) -> List[str]:
+    """Protect updates and reconnects of the updates WebSocket reach on_change."""
+    if dc.websocket is None:
+        raise SkipCheck("websocket-client not installed")
+    workdir = tempfile.mkdtemp(prefix="monocle-check-")
+    tls = make_tls_context(workdir)
+    if tls is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise SkipCheck("openssl not found")
+    updates = ProtectUpdatesStub()
+    nvr = StubServer("unifi", {("POST", "/api/auth/login"): b"{}"}, tls=tls,
+                     websockets={"/proxy/protect/ws/updates": updates})
+    client = dc.UniFiProtectClient(f"127.0.0.1:{nvr.port}", "bench", "bench",
+                                   state_path=os.path.join(workdir, "session.json"))
+    cache = dc.UniFiCameraCache(client, state_path=os.path.join(workdir, "cameras.json"))
+    cache.cameras = {"cam1": {"id": "cam1", "mac": "AABBCCDDEEFF", "name": "Garage", "channels": []}}
+    cache.last_update_id = "update-1"
+    changes = queue.Queue()
+    listener = cache.listener = dc.UniFiUpdatesListener(cache, lambda sources, reason: changes.put((sources, reason)))
+    listener.RECONNECT_DELAY = 0.1
+    listener.start()
+    failures = []
+    try:
+        peer = updates.connections.get(timeout=10)
+        if "lastUpdateId=update-1" not in peer.path:
+            failures.append(f"connected to {peer.path}, expected to resume from update-1")
+
+        updates.packets.put(protect_packet(
+            {"action": "update", "newUpdateId": "update-2", "modelKey": "camera", "id": "cam1"},
+            {"name": "Garage Door"}))
+        sources, reason = changes.get(timeout=10)
+        if sources != {dc.SOURCE_UNIFI} or cache.cameras["cam1"]["name"] != "Garage Door":
+            failures.append(f"rename reported {sources} ({reason}), cached name {cache.cameras['cam1']['name']!r}")
+
+        # Reconnect: resumes from the last update seen and reports a change
+        peer.close()
+        peer = updates.connections.get(timeout=10)
+        sources, reason = changes.get(timeout=10)
+        if "lastUpdateId=update-2" not in peer.path:
+            failures.append(f"reconnected to {peer.path}, expected to resume from update-2")
+        if sources != {dc.SOURCE_UNIFI} or cache.out_of_sync:
+            failures.append(f"reconnect reported {sources} ({reason}), out of sync {cache.out_of_sync}")
+
+        # Reconnect with nothing to resume from: the cache must be re-bootstrapped
+        cache.last_update_id = None
+        peer.close()
+        sources, reason = changes.get(timeout=10)
+        if sources != {dc.SOURCE_UNIFI} or not cache.out_of_sync:
+            failures.append(f"gap reported {sources} ({reason}), out of sync {cache.out_of_sync}")
+
+        # New credentials replace the cache: the old listener must stop and stay quiet
+        updates.connections.get(timeout=10)
+        dc._UNIFI_CACHES[client.host] = cache
+        dc.get_unifi_camera_cache(dc.UniFiProtectClient(client.host, "other", "other",
+                                                        state_path=os.path.join(workdir, "session.json")))
+        listener.join(timeout=5)
+        updates.packets.put(protect_packet(
+            {"action": "update", "newUpdateId": "update-3", "modelKey": "camera", "id": "cam1"},
+            {"name": "Garage Side"}))
+        time.sleep(0.5)
+        if listener.is_alive() or not changes.empty():
+            failures.append("replaced cache's listener kept running")
+    except queue.Empty:
+        failures.append("no connection or change within 10s")
+    finally:
+        listener.stop()
+        dc._UNIFI_CACHES.pop(client.host, None)
+        nvr.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return failures
+
+
+CHECKS = [check_camera_matching, check_same_name_cameras, check_config_diff, check_ha_events,
+          check_unifi_updates]
+
+
+def run_checks() -> int:
+    """Run the self-checks; returns the number of failed checks."""
+    sys.path.insert(0, HERE)
+    import discover_cameras as dc
+
+    failed = 0
+    for check in CHECKS:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                failures = check(dc)
+        except SkipCheck as e:
+            print(f"[SKIP] {check.__name__}: {e}")
+            continue
+        print(f"[{'FAIL' if failures else 'OK'}] {check.__name__}")
+        for failure in failures:
+            print(f"       {failure}")
+        failed += bool(failures)
+    return failed
+
+
+# =============================================================================
+# Single scenario (runs in a subprocess for a clean peak RSS)
+# =============================================================================
+
+def run_scenario(args) -> Dict:
+    """Generate fixtures, start stubs and run discovery ``args.runs`` times."""
+    workdir = tempfile.mkdtemp(prefix="monocle-bench-")
+    latency = args.latency_ms / 1000.0
+    try:
+        tls = None if args.no_unifi else make_tls_context(workdir)
+        if tls is None and not args.no_unifi:
+            print("[WARN] openssl not found, UniFi stub disabled", file=sys.stderr)
+
+        # The NVR port is needed in the config entries, so start it first
+        nvr = StubServer("unifi", {}, latency, tls,
+                         {"/proxy/protect/ws/updates": ProtectUpdatesStub()}) if tls else None
+        nvr_host = f"127.0.0.1:{nvr.port}" if nvr else "127.0.0.1:9"
+        rtsp = RTSPStub(args.dead_streams, latency)
+        fixtures = generate_fixtures(os.path.join(workdir, "storage"), args.entities, args.cameras,
+                                     nvr_host if nvr else "", f"127.0.0.1:{rtsp.port}")
+        if nvr:
+            nvr.routes.update({
+                ("POST", "/api/auth/login"): b"{}",
+                ("GET", "/proxy/protect/api/bootstrap"): json.dumps(fixtures["bootstrap"]).encode(),
+                ("GET", "/proxy/protect/api/cameras"): json.dumps(fixtures["bootstrap"]["cameras"]).encode(),
+            })
+        ha = StubServer("ha", {
+            ("POST", "/api/template"): json.dumps(fixtures["camera_states"]).encode()
+            if not args.no_template else None,
+            ("GET", "/api/states"): json.dumps(fixtures["states"]).encode(),
+            ("GET", "/api/config/config_entries/entry"): json.dumps(fixtures["config_entries"]).encode(),
+        }, latency)
+        go2rtc = StubServer("go2rtc", {
+            ("GET", "/api/streams"): json.dumps(fixtures["go2rtc"]).encode(),
+        }, latency) if not args.no_go2rtc else None
+        del fixtures
+
+        os.environ["SUPERVISOR_TOKEN"] = "bench"
+        sys.path.insert(0, HERE)
+        import discover_cameras as dc
+
+        data_dir = os.path.join(workdir, "data")
+        os.makedirs(data_dir)
+        dc.HA_URL = f"http://127.0.0.1:{ha.port}"
+        dc.HA_STORAGE_PATH = os.path.join(workdir, "storage")
+        dc.DATA_PATH = data_dir
+        dc.UNIFI_SESSION_PATH = os.path.join(data_dir, "unifi_session.json")
+        dc.UNIFI_CAMERAS_PATH = os.path.join(data_dir, "unifi_cameras.json")
+        dc.METRICS_JSON_PATH = os.path.join(data_dir, "discovery_metrics.json")
+        dc.METRICS_PROM_PATH = os.path.join(data_dir, "discovery_metrics.prom")
+        dc.STREAM_QUALITY_REPORT_PATH = os.path.join(data_dir, "stream_quality.json")
+        dc.PROFILE_PATH = os.path.abspath(f"discovery-{args.entities}-{args.cameras}.prof")
+        dc.GO2RTC_ENDPOINTS = [f"http://127.0.0.1:{go2rtc.port}/api/streams" if go2rtc
+                               else "http://127.0.0.1:9/api/streams"]
+
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        options = {"stream_quality": "auto" if args.budget else "high",
+                   "bandwidth_budget": args.budget, "profile_discovery": args.profile,
+                   "stream_probe": args.probe}
+        results = []
+        source_data = {}
+        for run in range(args.runs):
+            requests_before = {s.name: dict(s.requests) for s in (ha, go2rtc, nvr, rtsp) if s}
+            log = io.StringIO()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(log):
+                config, _ = dc.run_discovery(options, os.path.join(workdir, "monocle.json"),
+                                             source_data if args.reuse else None)
+            wall = time.perf_counter() - start
+
+            request_counts = {}
+            for stub in (ha, go2rtc, nvr, rtsp):
+                if not stub:
+                    continue
+                for path, count in stub.requests.items():
+                    delta = count - requests_before[stub.name].get(path, 0)
+                    if delta:
+                        request_counts[f"{stub.name} {path}"] = delta
+            results.append({
+                "run": run + 1,
+                "wall_s": round(wall, 4),
+                "metrics": dc.METRICS.summary(),
+                "requests": request_counts,
+                "cameras": len(config["cameras"]),
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            })
+        return {
+            "entities": args.entities,
+            "cameras": args.cameras,
+            "latency_ms": args.latency_ms,
+            "baseline_rss_kb": baseline_rss,
+            "storage_bytes": sum(os.path.getsize(os.path.join(dc.HA_STORAGE_PATH, f))
+                                 for f in os.listdir(dc.HA_STORAGE_PATH)),
+            "runs": results,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# =============================================================================
+# Driver
+# =============================================================================
+
+def parse_sizes(value: str) -> List[Tuple[int, int]]:
+    sizes = []
+    for pair in value.split(","):
+        entities, cameras = pair.split(":")
+        sizes.append((int(entities), int(cameras)))
+    return sizes
+
+
+def print_report(scenarios: List[Dict]):
+    print()
+    print(f"{'entities':>9} {'cameras':>8} {'run':>4} {'wall s':>8} {'peak RSS MB':>12} "
+          f"{'+RSS MB':>8} {'requests':>9} {'found':>6}  slowest phases")
+    for sc in scenarios:
+        for run in sc["runs"]:
+            phases = sorted(((k, v) for k, v in run["metrics"]["phases_seconds"].items()
+                             if k not in ("total", "fetch_sources")), key=lambda kv: -kv[1])[:3]
+            print(f"{sc['entities']:>9} {sc['cameras']:>8} {run['run']:>4} {run['wall_s']:>8.3f} "
+                  f"{run['peak_rss_kb'] / 1024:>12.1f} "
+                  f"{(run['peak_rss_kb'] - sc['baseline_rss_kb']) / 1024:>8.1f} {sum(run['requests'].values()):>9} "
+                  f"{run['cameras']:>6}  " + ", ".join(f"{k} {v:.3f}s" for k, v in phases))
+    print()
+    print("Sources are fetched concurrently, so phase times can add up to more than the wall time.")
+    print("Full per-run metrics (bytes, cache hits, matches) are in the --json output.")
+    print("Peak RSS includes the stand-in servers and fixtures;")
+    print("+RSS is the growth over the process peak before the first discovery run.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Auto-Monocle camera discovery")
+    parser.add_argument("--sizes", default="1000:10,10000:100,100000:1000",
+                        help="comma-separated entities:cameras pairs (default: %(default)s)")
+    parser.add_argument("--runs", type=int, default=2, help="discovery runs per scenario")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency added to every stub request")
+    parser.add_argument("--reuse", action="store_true",
+                        help="reuse per-source results between runs, like the discovery service")
+    parser.add_argument("--no-go2rtc", action="store_true", help="simulate a missing go2rtc")
+    parser.add_argument("--no-unifi", action="store_true", help="no UniFi Protect NVR")
+    parser.add_argument("--no-template", action="store_true",
+                        help="make /api/template fail (forces the /api/states fallback)")
+    parser.add_argument("--probe", choices=("off", "prefer", "drop"), default="off",
+                        help="stream_probe mode (default: %(default)s)")
+    parser.add_argument("--dead-streams", type=int, default=10, metavar="PCT",
+                        help="percentage of RTSP stand-in streams that answer 404")
+    parser.add_argument("--budget", type=int, default=0, metavar="MBPS",
+                        help="use stream_quality auto with this bandwidth_budget")
+    parser.add_argument("--profile", action="store_true",
+                        help="enable profile_discovery; writes discovery-<entities>-<cameras>.prof")
+    parser.add_argument("--json", metavar="FILE", help="also write results as JSON")
+    parser.add_argument("--check", action="store_true",
+                        help="run the behaviour self-checks instead of the benchmark")
+    # Internal: run one scenario and print its JSON result
+    parser.add_argument("--entities", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--cameras", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(1 if run_checks() else 0)
+
+    if args.entities is not None:
+        print(json.dumps(run_scenario(args)))
+        return
+
+    scenarios = []
+    for entities, cameras in parse_sizes(args.sizes):
+        cmd = [sys.executable, os.path.abspath(__file__), "--entities", str(entities),
+               "--cameras", str(cameras), "--runs", str(args.runs),
+               "--latency-ms", str(args.latency_ms), "--probe", args.probe,
+               "--dead-streams", str(args.dead_streams), "--budget", str(args.budget)]
+        for flag in ("reuse", "no_go2rtc", "no_unifi", "no_template", "profile"):
+            if getattr(args, flag):
+                cmd.append("--" + flag.replace("_", "-"))
+        print(f"[INFO] Running {entities} entities / {cameras} cameras...", file=sys.stderr)
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        scenarios.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    print_report(scenarios)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(scenarios, f, indent=2)
+        print(f"[INFO] Wrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
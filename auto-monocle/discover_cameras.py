@@ -5,28 +5,409 @@ Supports multiple discovery methods:
 1. go2rtc streams (HA built-in or standalone)
 2. UniFi Protect integration (construct RTSP URLs from storage files)
 3. Generic camera stream_source attributes
+
+Each method is a source plugin (CameraSource); more can be added with
+register_source().
+
+Run without arguments for a single discovery pass, or with --daemon to keep
+a discovery service running that refreshes cameras in-process.
 """
 
+import abc
+import argparse
+import base64
+import codecs
+import cProfile
 import json
 import os
+import pstats
+import queue
+import random
+import re
+import signal
+import socket
+import ssl
+import struct
 import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import zlib
 import requests
-from typing import Dict, List, Optional, Tuple
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+try:
+    import websocket  # websocket-client, used for event-driven discovery
+except ImportError:
+    websocket = None
 
 SUPERVISOR_TOKEN = os.environ.get("SUPERVISOR_TOKEN")
 HA_URL = "http://supervisor/core"
+HA_WS_URL = "ws://supervisor/core/websocket"
+
+# UniFi NVRs use self-signed certificates (not verified, like HA does)
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # HA storage paths (mapped as homeassistant_config:ro)
 HA_STORAGE_PATH = "/homeassistant/.storage"
 
-def api_get(endpoint: str, timeout: int = 10) -> Optional[Dict]:
-    """Make authenticated GET request to HA API."""
-    headers = {
+# Add-on persistent storage
+DATA_PATH = "/data"
+OPTIONS_PATH = os.path.join(DATA_PATH, "options.json")
+MONOCLE_CONFIG_PATH = "/etc/monocle/monocle.json"
+UNIFI_SESSION_PATH = os.path.join(DATA_PATH, "unifi_session.json")
+UNIFI_CAMERAS_PATH = os.path.join(DATA_PATH, "unifi_cameras.json")
+METRICS_JSON_PATH = os.path.join(DATA_PATH, "discovery_metrics.json")
+METRICS_PROM_PATH = os.path.join(DATA_PATH, "discovery_metrics.prom")
+PROFILE_PATH = os.path.join(DATA_PATH, "discovery.prof")
+# Before Python 3.12 a cProfile only sees its own thread, so worker threads
+# need their own; from 3.12 on one profiler covers every thread and a
+# second one cannot be enabled while it runs
+PROFILE_PER_THREAD = sys.version_info < (3, 12)
+SNAPSHOT_PATH = os.path.join(DATA_PATH, "discovery_snapshot.json")
+
+# Built-in discovery sources (see CameraSource; candidates are cached per
+# source in daemon mode)
+SOURCE_ENTITIES = "entities"
+SOURCE_GO2RTC = "go2rtc"
+SOURCE_UNIFI = "unifi"
+
+# =============================================================================
+# Discovery metrics
+# =============================================================================
+
+class DiscoveryMetrics:
+    """Timings and counters for the current discovery run.
+
+    Reset at the start of every run and written after it as a JSON summary
+    and a Prometheus text file. Thread-safe: sources are fetched in worker
+    threads. With profiling enabled, the run is also run under cProfile
+    (before Python 3.12 every source fetch gets its own profiler in its
+    worker thread, merged into the same stats file).
+
+    Collected per run:
+        phases       seconds per step (cumulative if a step runs repeatedly)
+        http         responses per (upstream, status) and time to headers
+        bytes        fetched per upstream (Content-Length), parsed per input
+        counters     cache hits/misses and other events
+        matched      cameras matched per source
+        sources      how each source was obtained (fetched/cached/stale/partial/failed)
+        circuits     circuit breaker state per upstream
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profiling = False
+        self.runs = 0
+        self.reset()
+
+    def reset(self):
+        """Start a new run."""
+        with self._lock:
+            self.started = time.time()
+            self.phases = {}
+            self.http_requests = {}  # (upstream, status) -> count
+            self.http_seconds = {}   # upstream -> seconds
+            self.bytes_fetched = {}  # upstream -> bytes
+            self.bytes_parsed = {}   # input -> bytes
+            self.counters = {}
+            self.matched = {}
+            self.sources = {}
+            self._profiles = []
+
+    @contextmanager
+    def phase(self, name: str, profile: bool = False):
+        """Time a block as ``name``; ``profile`` also runs it under cProfile."""
+        profiler = None
+        if profile and self.profiling:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                print(f"[WARN] Not profiling {name}: {e}")
+                profiler = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+                if profiler is not None:
+                    self._profiles.append(profiler)
+
+    def add_phase(self, name: str, started: float) -> float:
+        """Record the time since ``started`` (perf_counter) as ``name``; returns now."""
+        now = time.perf_counter()
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + now - started
+        return now
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_parsed(self, source: str, size: int):
+        with self._lock:
+            self.bytes_parsed[source] = self.bytes_parsed.get(source, 0) + size
+
+    def set_matched(self, source: str, cameras: int):
+        with self._lock:
+            self.matched[source] = cameras
+
+    def set_source(self, source: str, status: str):
+        with self._lock:
+            self.sources[source] = status
+
+    def record_response(self, upstream: str, response: requests.Response):
+        """requests response hook: count the call, its latency and size."""
+        key = (upstream, str(response.status_code))
+        size = response.headers.get("Content-Length")
+        with self._lock:
+            self.http_requests[key] = self.http_requests.get(key, 0) + 1
+            self.http_seconds[upstream] = (self.http_seconds.get(upstream, 0.0)
+                                           + response.elapsed.total_seconds())
+            if size and size.isdigit():
+                self.bytes_fetched[upstream] = self.bytes_fetched.get(upstream, 0) + int(size)
+
+    def summary(self) -> Dict:
+        """JSON-serializable snapshot of the current run."""
+        with self._lock:
+            return {
+                "run": self.runs,
+                "started": round(self.started, 3),
+                "phases_seconds": {k: round(v, 4) for k, v in sorted(self.phases.items())},
+                "http_requests": [
+                    {"upstream": upstream, "status": status, "count": count}
+                    for (upstream, status), count in sorted(self.http_requests.items())
+                ],
+                "http_seconds": {k: round(v, 4) for k, v in sorted(self.http_seconds.items())},
+                "bytes_fetched": dict(sorted(self.bytes_fetched.items())),
+                "bytes_parsed": dict(sorted(self.bytes_parsed.items())),
+                "counters": dict(sorted(self.counters.items())),
+                "cameras_matched": dict(sorted(self.matched.items())),
+                "sources": dict(sorted(self.sources.items())),
+                "circuits": breaker_states(),
+            }
+
+    @staticmethod
+    def prometheus_text(summary: Dict) -> str:
+        """Render a summary in the Prometheus text exposition format."""
+        def esc(value: str) -> str:
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines = []
+
+        def metric(name: str, help_text: str, kind: str, samples):
+            lines.append(f"# HELP monocle_discovery_{name} {help_text}")
+            lines.append(f"# TYPE monocle_discovery_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{esc(v)}"' for k, v in labels.items())
+                lines.append(f"monocle_discovery_{name}{{{label_text}}} {value}" if label_text
+                             else f"monocle_discovery_{name} {value}")
+
+        metric("runs_total", "Discovery runs since the service started.", "counter",
+               [({}, summary["run"])])
+        metric("last_run_timestamp_seconds", "Start time of the last discovery run.", "gauge",
+               [({}, summary["started"])])
+        metric("phase_seconds", "Time spent per discovery phase in the last run.", "gauge",
+               [({"phase": k}, v) for k, v in summary["phases_seconds"].items()])
+        metric("http_requests", "HTTP responses per upstream and status in the last run.", "gauge",
+               [({"upstream": r["upstream"], "status": r["status"]}, r["count"])
+                for r in summary["http_requests"]])
+        metric("http_seconds", "Time to response headers per upstream in the last run.", "gauge",
+               [({"upstream": k}, v) for k, v in summary["http_seconds"].items()])
+        metric("bytes_fetched", "Response bytes per upstream (Content-Length) in the last run.",
+               "gauge", [({"upstream": k}, v) for k, v in summary["bytes_fetched"].items()])
+        metric("bytes_parsed", "JSON bytes parsed per input in the last run.", "gauge",
+               [({"input": k}, v) for k, v in summary["bytes_parsed"].items()])
+        metric("events", "Cache hits, misses and other events in the last run.", "gauge",
+               [({"event": k}, v) for k, v in summary["counters"].items()])
+        metric("cameras_matched", "Cameras matched per source in the last run.", "gauge",
+               [({"source": k}, v) for k, v in summary["cameras_matched"].items()])
+        metric("source_info", "How each source was obtained in the last run.", "gauge",
+               [({"source": k, "status": v}, 1) for k, v in summary["sources"].items()])
+        metric("circuit_open", "1 if the upstream's circuit breaker is open or half-open.", "gauge",
+               [({"circuit": k}, int(v != "closed")) for k, v in summary.get("circuits", {}).items()])
+        return "\n".join(lines) + "\n"
+
+    def write(self) -> Dict:
+        """Write the JSON summary, Prometheus file and profile (if enabled)."""
+        summary = self.summary()
+        outputs = [
+            (METRICS_JSON_PATH, json.dumps(summary, indent=2) + "\n"),
+            (METRICS_PROM_PATH, self.prometheus_text(summary)),
+        ]
+        for path, content in outputs:
+            try:
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"[DEBUG] Could not write {path}: {e}")
+
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+        if profiles:
+            try:
+                pstats.Stats(*profiles).dump_stats(PROFILE_PATH)
+                print(f"[INFO] Discovery profile written to {PROFILE_PATH}")
+            except (OSError, TypeError) as e:
+                print(f"[WARN] Could not write discovery profile: {e}")
+        return summary
+
+    def log_summary(self, summary: Dict):
+        phases = ", ".join(f"{k} {v:.2f}s" for k, v in
+                           sorted(summary["phases_seconds"].items(), key=lambda kv: -kv[1])[:5])
+        requests_made = sum(r["count"] for r in summary["http_requests"])
+        print(f"[DEBUG] Discovery metrics: {phases}; {requests_made} HTTP requests")
+
+
+METRICS = DiscoveryMetrics()
+
+
+# =============================================================================
+# Circuit breakers (negative caching of failing upstreams)
+# =============================================================================
+
+CIRCUIT_FAILURE_THRESHOLD = 2   # consecutive failures before a circuit opens
+CIRCUIT_BASE_DELAY = 120        # first back-off, doubled on every further failure
+CIRCUIT_MAX_DELAY = 3600
+
+
+class SourceUnavailable(Exception):
+    """A discovery source could not reach its upstream."""
+
+
+class CircuitBreaker:
+    """Failure tracking and exponential back-off for one upstream.
+
+    closed     requests go through
+    open       requests are skipped until the back-off expires
+    half-open  one trial request; success closes, failure re-opens longer
+
+    Names are "<source>" or "<source>:<upstream>" (e.g. "go2rtc:<url>"),
+    so all breakers of a source can be reset together.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error = ""
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """True if a request may be made now."""
+        with self._lock:
+            if self.state == "open" and time.monotonic() >= self.retry_at:
+                self.state = "half-open"
+                print(f"[INFO] Circuit {self.name}: half-open, trying again")
+            if self.state == "open":
+                print(f"[DEBUG] Circuit {self.name}: open, skipping "
+                      f"(retry in {self.retry_at - time.monotonic():.0f}s)")
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print(f"[INFO] Circuit {self.name}: closed (recovered)")
+            self.state = "closed"
+            self.failures = 0
+            self.last_error = ""
+
+    def record_failure(self, error: str = ""):
+        with self._lock:
+            self.failures += 1
+            self.last_error = error
+            if self.failures < CIRCUIT_FAILURE_THRESHOLD and self.state == "closed":
+                return
+            delay = min(CIRCUIT_MAX_DELAY,
+                        CIRCUIT_BASE_DELAY * 2 ** max(0, self.failures - CIRCUIT_FAILURE_THRESHOLD))
+            self.state = "open"
+            self.retry_at = time.monotonic() + delay
+            print(f"[WARN] Circuit {self.name}: open after {self.failures} failures"
+                  f"{f' ({error})' if error else ''}, retry in {delay:.0f}s")
+
+    def reset(self):
+        with self._lock:
+            if self.state != "closed":
+                print(f"[INFO] Circuit {self.name}: reset")
+            self.state = "closed"
+            self.failures = 0
+
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Return the circuit breaker for an upstream, creating it on first use."""
+    with _BREAKERS_LOCK:
+        breaker = _BREAKERS.get(name)
+        if breaker is None:
+            breaker = _BREAKERS[name] = CircuitBreaker(name)
+        return breaker
+
+
+def reset_breakers(source: str):
+    """Close all circuits of a source (its upstream just showed signs of life)."""
+    with _BREAKERS_LOCK:
+        breakers = [b for name, b in _BREAKERS.items()
+                    if name == source or name.startswith(f"{source}:")]
+    for breaker in breakers:
+        breaker.reset()
+
+
+def breaker_states() -> Dict[str, str]:
+    with _BREAKERS_LOCK:
+        return {name: b.state for name, b in sorted(_BREAKERS.items())}
+
+
+# One keep-alive connection pool per upstream (HA core, go2rtc, each NVR),
+# reused by every request and, in daemon mode, across refresh cycles
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_session(upstream: str) -> requests.Session:
+    """Return the shared keep-alive session for an upstream."""
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(upstream)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.hooks["response"].append(
+                lambda response, *args, **kwargs: METRICS.record_response(upstream, response))
+            _SESSIONS[upstream] = session
+        return session
+
+
+def ha_headers() -> Dict[str, str]:
+    """Headers for authenticated HA API requests."""
+    return {
         "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
         "Content-Type": "application/json"
     }
+
+
+def api_get(endpoint: str, timeout: int = 10) -> Optional[Dict]:
+    """Make authenticated GET request to HA API."""
     try:
-        response = requests.get(f"{HA_URL}{endpoint}", headers=headers, timeout=timeout)
+        response = get_session("ha").get(f"{HA_URL}{endpoint}", headers=ha_headers(), timeout=timeout)
         if response.status_code == 200:
             return response.json()
     except Exception as e:
@@ -34,6 +415,19 @@ def api_get(endpoint: str, timeout: int = 10) -> Optional[Dict]:
     return None
 
 
+def api_post(endpoint: str, payload: Dict, timeout: int = 10) -> Optional[str]:
+    """Make authenticated POST request to HA API, returning the response text."""
+    try:
+        response = get_session("ha").post(f"{HA_URL}{endpoint}", headers=ha_headers(),
+                                          json=payload, timeout=timeout)
+        if response.status_code == 200:
+            return response.text
+        print(f"[DEBUG] API error {endpoint}: HTTP {response.status_code}")
+    except Exception as e:
+        print(f"[DEBUG] API error {endpoint}: {e}")
+    return None
+
+
 def read_storage_file(filename: str) -> Optional[Dict]:
     """Read HA storage file directly (more reliable than API for some data)."""
     filepath = os.path.join(HA_STORAGE_PATH, filename)
@@ -45,44 +439,478 @@ def read_storage_file(filename: str) -> Optional[Dict]:
     return None
 
 
+# =============================================================================
+# Streaming JSON reader (filter-as-you-parse for large payloads)
+# =============================================================================
+
+# Possessive quantifiers keep an unterminated string at the end of the buffer
+# from backtracking; the match then stops on its opening quote
+_STRING_PATTERN = r'"(?:[^"\\]++|\\.)*+"'
+_CONTAINER_BODY_RE = re.compile(r'(?:[^"{}\[\]]++|%s)*+' % _STRING_PATTERN, re.S)
+
+
+def _nested_container_pattern(depth: int) -> str:
+    """Regex for a complete object/array nested at most ``depth`` levels."""
+    inner = ""
+    for _ in range(depth):
+        inner = r'[\[{](?:[^"{}\[\]]++|%s%s)*+[\]}]' % (_STRING_PATTERN, "|" + inner if inner else "")
+    return inner
+
+
+# Matches typical registry/bootstrap records in one call; deeper or
+# incomplete containers fall back to the bracket-counting loop
+_CONTAINER_RE = re.compile(_nested_container_pattern(8), re.S)
+_STRING_BODY_RE = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+_SCALAR_END_RE = re.compile(r'[,\]}\s]')
+_WHITESPACE_RE = re.compile(r'\s*')
+
+
+class JSONStreamReader:
+    """Incremental reader over a file-like object holding one JSON document.
+
+    Walks objects and arrays without materializing them: values can be
+    skipped (scanned with regexes, buffer dropped as it goes) or returned as
+    raw text for json.loads. Memory use tracks the largest value kept, not
+    the document size. Accepts text or binary (UTF-8) streams.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def _fill(self, compact: bool = True) -> bool:
+        """Read the next chunk; drops consumed text unless ``compact`` is False."""
+        chunk = ""
+        while not chunk:
+            if self.eof:
+                return False
+            raw = self.fp.read(self.CHUNK_SIZE)
+            self.eof = not raw
+            self.bytes_read += len(raw)
+            # A chunk may end inside a multi-byte character and decode to ""
+            chunk = self._decoder.decode(raw, final=self.eof) if isinstance(raw, bytes) else raw
+        if compact:
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        else:
+            self.buf += chunk
+        return True
+
+    def _skip_ws(self, compact: bool = True):
+        while True:
+            self.pos = _WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._fill(compact):
+                return
+
+    def _peek(self, compact: bool = True) -> str:
+        self._skip_ws(compact)
+        if self.pos >= len(self.buf):
+            raise ValueError("Unexpected end of JSON")
+        return self.buf[self.pos]
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self.pos}, got '{self.buf[self.pos]}'")
+        self.pos += 1
+
+    def _skip_string(self, compact: bool):
+        # self.pos is on the opening quote
+        while True:
+            m = _STRING_BODY_RE.match(self.buf, self.pos + 1)
+            if m:
+                self.pos = m.end()
+                return
+            if not self._fill(compact):
+                raise ValueError("Unterminated string in JSON")
+
+    def _skip_value(self, compact: bool):
+        char = self._peek(compact)
+        if char == '"':
+            self._skip_string(compact)
+        elif char in "{[":
+            # Fast path: the whole container is in the buffer and not too deep
+            m = _CONTAINER_RE.match(self.buf, self.pos)
+            if m:
+                self.pos = m.end()
+                return
+            depth = 0
+            while True:
+                # Jump over scalars and complete strings to the next bracket
+                self.pos = _CONTAINER_BODY_RE.match(self.buf, self.pos).end()
+                if self.pos >= len(self.buf) or self.buf[self.pos] == '"':
+                    # End of buffer, or a string that continues in the next chunk
+                    if not self._fill(compact):
+                        raise ValueError("Unexpected end of JSON")
+                    continue
+                depth += 1 if self.buf[self.pos] in "{[" else -1
+                self.pos += 1
+                if depth == 0:
+                    return
+        else:
+            while True:
+                m = _SCALAR_END_RE.search(self.buf, self.pos)
+                if m:
+                    self.pos = m.start()
+                    return
+                self.pos = len(self.buf)
+                if not self._fill(compact):
+                    return
+
+    def skip(self):
+        """Skip the next value without keeping it in memory."""
+        self._skip_value(compact=True)
+
+    def value_text(self) -> str:
+        """Return the raw JSON text of the next value."""
+        self._skip_ws()
+        if self.pos > self.CHUNK_SIZE:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        start = self.pos
+        self._skip_value(compact=False)
+        return self.buf[start:self.pos]
+
+    def _separator(self, close: str) -> bool:
+        """Consume ',' or the closing bracket; True when the container ended."""
+        char = self._peek()
+        self.pos += 1
+        if char == close:
+            return True
+        if char != ",":
+            raise ValueError(f"Expected ',' or '{close}' at offset {self.pos - 1}, got '{char}'")
+        return False
+
+    def iter_object(self):
+        """Yield the keys of the next object; the caller must consume each value."""
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            if self._peek() != '"':
+                raise ValueError(f"Expected object key at offset {self.pos}")
+            start = self.pos
+            self._skip_string(compact=False)
+            key = json.loads(self.buf[start:self.pos])
+            self._expect(":")
+            yield key
+            if self._separator("}"):
+                return
+
+    def iter_array(self):
+        """Yield once per element of the next array; the caller must consume it."""
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self._separator("]"):
+                return
+
+
+def stream_json_filter(fp, array_path: Tuple[str, ...],
+                       keep: Optional[Callable[[Dict], bool]] = None,
+                       prefilter: Optional["re.Pattern"] = None,
+                       transform: Optional[Callable[[Dict], Dict]] = None,
+                       extra_keys: Tuple[str, ...] = (),
+                       source: Optional[str] = None) -> Tuple[List[Dict], Dict]:
+    """Stream a JSON document and keep only the wanted items of one array.
+
+    Args:
+        fp: Text or binary file-like object
+        array_path: Object keys leading to the array, e.g. ("data", "entities");
+            empty if the document itself is the array
+        keep: Predicate on decoded items; items failing it are dropped
+        prefilter: Regex the raw item text must match before it is decoded at all
+        transform: Applied to kept items (e.g. to drop unused fields)
+        extra_keys: Keys next to the array whose values are returned too
+        source: Name the parsed bytes are recorded under in METRICS
+
+    Returns:
+        (kept items, {extra key: value})
+    """
+    reader = JSONStreamReader(fp)
+    items = []
+    extras = {}
+
+    def collect():
+        for _ in reader.iter_array():
+            text = reader.value_text()
+            if prefilter is not None and not prefilter.search(text):
+                continue
+            item = json.loads(text)
+            if keep is None or keep(item):
+                items.append(transform(item) if transform else item)
+
+    def walk(depth: int):
+        if depth == len(array_path):
+            collect()
+            return
+        for key in reader.iter_object():
+            if key == array_path[depth]:
+                walk(depth + 1)
+            elif depth == len(array_path) - 1 and key in extra_keys:
+                extras[key] = json.loads(reader.value_text())
+            else:
+                reader.skip()
+
+    walk(0)
+    if source:
+        METRICS.add_parsed(source, reader.bytes_read)
+    return items, extras
+
+
+CAMERA_ENTITY_PREFILTER = re.compile(r'"entity_id"\s*:\s*"camera\.')
+
+
+def read_camera_entity_registry(filename: str = "core.entity_registry") -> Optional[Dict]:
+    """Stream the entity registry, keeping only camera.* entities.
+
+    Returns the same shape as read_storage_file() ({"data": {"entities": [...]}}),
+    but peak memory tracks the number of cameras, not the number of entities.
+    """
+    filepath = os.path.join(HA_STORAGE_PATH, filename)
+    try:
+        with open(filepath, "rb") as f:
+            entities, _ = stream_json_filter(
+                f, ("data", "entities"),
+                keep=lambda ent: ent.get("entity_id", "").startswith("camera."),
+                prefilter=CAMERA_ENTITY_PREFILTER)
+        return {"data": {"entities": entities}}
+    except Exception as e:
+        print(f"[DEBUG] Storage file error {filename}: {e}")
+    return None
+
+
+# =============================================================================
+# Registry snapshot cache
+# =============================================================================
+
+def device_macs(device: Dict) -> List[str]:
+    """Return a device's MAC connections, normalized (upper case, no colons)."""
+    macs = []
+    for conn in device.get("connections", []):
+        if isinstance(conn, list) and len(conn) >= 2 and conn[0] == "mac" and conn[1]:
+            macs.append(conn[1].upper().replace(":", ""))
+    return macs
+
+
+def _index_device_registry(data: Dict) -> Dict[str, Dict]:
+    by_id, by_mac = {}, {}
+    for dev in data.get("data", {}).get("devices", []):
+        if dev.get("id"):
+            by_id[dev["id"]] = dev
+        for mac in device_macs(dev):
+            by_mac[mac] = dev
+    return {"by_id": by_id, "by_mac": by_mac}
+
+
+def _index_entity_registry(data: Dict) -> Dict[str, Dict]:
+    by_platform, by_entity_id = {}, {}
+    for ent in data.get("data", {}).get("entities", []):
+        by_platform.setdefault(ent.get("platform", ""), []).append(ent)
+        if ent.get("entity_id"):
+            by_entity_id[ent["entity_id"]] = ent
+    return {"by_platform": by_platform, "by_entity_id": by_entity_id}
+
+
+def _index_config_entries(data: Dict) -> Dict[str, Dict]:
+    by_domain = {}
+    for entry in data.get("data", {}).get("entries", []):
+        by_domain.setdefault(entry.get("domain", ""), []).append(entry)
+    return {"by_domain": by_domain}
+
+
+class RegistryCache:
+    """Parsed HA .storage files with prebuilt lookup indexes.
+
+    Each file is parsed at most once per change: snapshots are keyed on
+    (path, mtime, size) and re-read only when the file on disk changes.
+    Kept at module level, so the discovery service reuses it across cycles.
+    """
+
+    INDEX_BUILDERS = {
+        "core.device_registry": _index_device_registry,
+        "core.entity_registry": _index_entity_registry,
+        "core.config_entries": _index_config_entries,
+    }
+
+    # Files read with a streaming filter instead of a full json.load
+    LOADERS = {
+        "core.entity_registry": read_camera_entity_registry,
+    }
+
+    def __init__(self, storage_path: Optional[str] = None):
+        self.storage_path = storage_path  # None: use HA_STORAGE_PATH
+        self._snapshots = {}  # filename -> (key, data, indexes)
+        self._lock = threading.Lock()
+
+    def _load(self, filename: str) -> Tuple[Optional[Dict], Dict[str, Dict]]:
+        filepath = os.path.join(self.storage_path or HA_STORAGE_PATH, filename)
+        try:
+            st = os.stat(filepath)
+            key = (filepath, st.st_mtime_ns, st.st_size)
+        except OSError as e:
+            print(f"[DEBUG] Storage file error {filename}: {e}")
+            return None, {}
+
+        with self._lock:
+            cached = self._snapshots.get(filename)
+            if cached and cached[0] == key:
+                METRICS.count("registry_cache_hits")
+                return cached[1], cached[2]
+
+            METRICS.count("registry_cache_misses")
+            with METRICS.phase("registry_load"):
+                data = self.LOADERS.get(filename, read_storage_file)(filename)
+                if data is None:
+                    return None, {}
+                METRICS.add_parsed(f"storage:{filename}", st.st_size)
+                builder = self.INDEX_BUILDERS.get(filename)
+                indexes = builder(data) if builder else {}
+            self._snapshots[filename] = (key, data, indexes)
+            return data, indexes
+
+    def get(self, filename: str) -> Optional[Dict]:
+        """Return the parsed storage file (None if missing or invalid)."""
+        return self._load(filename)[0]
+
+    def _index(self, filename: str, name: str) -> Optional[Dict]:
+        data, indexes = self._load(filename)
+        return indexes.get(name) if data is not None else None
+
+    def devices_by_id(self) -> Optional[Dict[str, Dict]]:
+        """device_id -> device registry entry."""
+        return self._index("core.device_registry", "by_id")
+
+    def devices_by_mac(self) -> Optional[Dict[str, Dict]]:
+        """Normalized MAC -> device registry entry."""
+        return self._index("core.device_registry", "by_mac")
+
+    def entities_by_platform(self) -> Optional[Dict[str, List[Dict]]]:
+        """Integration platform -> camera entity registry entries."""
+        return self._index("core.entity_registry", "by_platform")
+
+    def entities_by_id(self) -> Optional[Dict[str, Dict]]:
+        """entity_id -> camera entity registry entry."""
+        return self._index("core.entity_registry", "by_entity_id")
+
+    def config_entries_by_domain(self) -> Optional[Dict[str, List[Dict]]]:
+        """Integration domain -> config entries."""
+        return self._index("core.config_entries", "by_domain")
+
+
+REGISTRY = RegistryCache()
+
+
 # =============================================================================
 # Method 1: go2rtc streams
 # =============================================================================
 
+# go2rtc API endpoints, probed concurrently (first one to answer wins)
+GO2RTC_ENDPOINTS = [
+    "http://supervisor/core/api/go2rtc/streams",  # HA built-in go2rtc
+    "http://localhost:1984/api/streams",           # Standalone go2rtc
+    "http://localhost:11984/api/streams",          # HA go2rtc alternate port
+    "http://homeassistant:1984/api/streams",       # Docker network
+]
+
+
+def probe_go2rtc_endpoint(url: str) -> Optional[Dict]:
+    """Query one go2rtc streams endpoint (None if unreachable or not go2rtc)."""
+    headers = {"Authorization": f"Bearer {SUPERVISOR_TOKEN}"} if "supervisor" in url else {}
+    try:
+        response = get_session("go2rtc").get(url, headers=headers, timeout=5)
+        if response.status_code == 200:
+            data = response.json()
+            if isinstance(data, dict):
+                return data
+    except Exception:
+        pass
+    return None
+
+
+# Endpoint that answered last time; tried first, alone for a short head start
+_GO2RTC_PREFERRED = None
+GO2RTC_PREFERRED_HEAD_START = 1.0
+
+
+def _probe_go2rtc_with_breaker(url: str) -> Optional[Dict]:
+    data = probe_go2rtc_endpoint(url)
+    breaker = get_breaker(f"go2rtc:{url}")
+    if data is None:
+        breaker.record_failure("no answer")
+    else:
+        breaker.record_success()
+    return data
+
+
 def get_go2rtc_streams() -> Dict[str, str]:
-    """Try to get streams from go2rtc (HA built-in or standalone)."""
-    streams = {}
+    """Try to get streams from go2rtc (HA built-in or standalone).
 
-    # Try various go2rtc endpoints
-    endpoints = [
-        "http://supervisor/core/api/go2rtc/streams",  # HA built-in go2rtc
-        "http://localhost:1984/api/streams",           # Standalone go2rtc
-        "http://localhost:11984/api/streams",          # HA go2rtc alternate port
-        "http://homeassistant:1984/api/streams",       # Docker network
-    ]
+    The endpoint that answered last time gets a short head start
+    (GO2RTC_PREFERRED_HEAD_START); if it has not answered by then, the
+    other endpoints are probed in parallel with it and the first
+    successful answer is used. A missing go2rtc costs about one timeout
+    instead of one per endpoint, and a slow preferred endpoint cannot
+    push the source past its deadline. Endpoints that keep failing are
+    skipped while their circuit is open, so a missing go2rtc soon costs
+    no requests at all.
+    """
+    global _GO2RTC_PREFERRED
+    streams = {}
 
-    for url in endpoints:
+    data = None
+    preferred = _GO2RTC_PREFERRED
+    if preferred not in GO2RTC_ENDPOINTS or not get_breaker(f"go2rtc:{preferred}").allow():
+        preferred = None
+    others = [url for url in GO2RTC_ENDPOINTS
+              if url != preferred and get_breaker(f"go2rtc:{url}").allow()]
+    if preferred or others:
+        executor = ThreadPoolExecutor(max_workers=len(others) + bool(preferred),
+                                      thread_name_prefix="go2rtc")
         try:
-            headers = {"Authorization": f"Bearer {SUPERVISOR_TOKEN}"} if "supervisor" in url else {}
-            response = requests.get(url, headers=headers, timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                print(f"[INFO] Found go2rtc at {url}")
-                # go2rtc returns {stream_name: {producers: [{url: "rtsp://..."}]}}
-                for name, info in data.items():
-                    if isinstance(info, dict):
-                        producers = info.get("producers", [])
-                        for producer in producers:
-                            if isinstance(producer, dict) and "url" in producer:
-                                url = producer["url"]
-                                if "rtsp" in url.lower():
-                                    streams[name] = url
-                                    print(f"[INFO] go2rtc stream: {name} -> {url[:50]}...")
-                return streams
-        except:
-            pass
-
-    print("[INFO] go2rtc not found or no streams configured")
+            futures = {}
+            if preferred:
+                futures[executor.submit(_probe_go2rtc_with_breaker, preferred)] = preferred
+                done, _ = wait(futures, timeout=GO2RTC_PREFERRED_HEAD_START)
+                if any(future.result() is not None for future in done):
+                    others = []
+            futures.update({executor.submit(_probe_go2rtc_with_breaker, url): url for url in others})
+            for future in as_completed(futures):
+                data = future.result()
+                if data is not None:
+                    url = futures[future]
+                    if url == preferred:
+                        print(f"[DEBUG] go2rtc answered at {url} (last used endpoint)")
+                    else:
+                        _GO2RTC_PREFERRED = url
+                        print(f"[INFO] Found go2rtc at {url}")
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    if data is None:
+        print("[INFO] go2rtc not found or no streams configured")
+        return streams
+
+    # go2rtc returns {stream_name: {producers: [{url: "rtsp://..."}]}}
+    for name, info in data.items():
+        if isinstance(info, dict):
+            producers = info.get("producers", [])
+            for producer in producers:
+                if isinstance(producer, dict) and "url" in producer:
+                    url = producer["url"]
+                    if "rtsp" in url.lower():
+                        streams[name] = url
+                        print(f"[INFO] go2rtc stream: {name} -> {url[:50]}...")
     return streams
 
 
@@ -90,50 +918,64 @@ def get_go2rtc_streams() -> Dict[str, str]:
 # Method 2: UniFi Protect integration (reads from HA storage files)
 # =============================================================================
 
-def get_unifi_protect_config() -> Optional[Dict]:
-    """Get UniFi Protect NVR config from config entries (storage file or API)."""
+UNIFI_RTSPS_PORT = 7441
+UNIFI_RTSP_INSECURE_PORT = 7447
+
+
+def get_unifi_protect_configs() -> List[Dict]:
+    """Get every UniFi Protect NVR config from config entries (storage file or API)."""
     from urllib.parse import quote
 
+    unifi_domains = ["unifiprotect", "unifi_protect", "ubiquiti_unifi_protect"]
+
     # Try reading from storage file first (more reliable - contains full data)
-    config_data = read_storage_file("core.config_entries")
-    if config_data:
-        entries = config_data.get("data", {}).get("entries", [])
-        print(f"[DEBUG] Read {len(entries)} config entries from storage")
+    entries_by_domain = REGISTRY.config_entries_by_domain()
+    if entries_by_domain is not None:
+        print(f"[DEBUG] Read {sum(map(len, entries_by_domain.values()))} config entries from storage")
     else:
-        # Fall back to API
-        entries = api_get("/api/config/config_entries/entry") or []
-        print(f"[DEBUG] Got {len(entries)} config entries from API")
+        # Fall back to API, asking only for UniFi Protect entries
+        entries = []
+        for domain in unifi_domains:
+            entries += api_get(f"/api/config/config_entries/entry?domain={domain}") or []
+        print(f"[DEBUG] Got {len(entries)} UniFi Protect config entries from API")
+        entries_by_domain = _index_config_entries({"data": {"entries": entries}})["by_domain"]
 
-    if not entries:
+    if not entries_by_domain:
         print("[DEBUG] No config entries found")
-        return None
+        return []
 
-    # Look for UniFi Protect
-    unifi_domains = ["unifiprotect", "unifi_protect", "ubiquiti_unifi_protect"]
-    for entry in entries:
-        domain = entry.get("domain", "")
-        if domain in unifi_domains or "protect" in domain.lower():
+    # Look for UniFi Protect (one entry per NVR/console)
+    configs = []
+    seen_hosts = set()
+    for domain, domain_entries in entries_by_domain.items():
+        if not (domain in unifi_domains or "protect" in domain.lower()):
+            continue
+        for entry in domain_entries:
             print(f"[DEBUG] Found UniFi Protect entry: domain={domain}")
             data = entry.get("data", {})
             host = data.get("host") or data.get("ip") or data.get("address")
             username = data.get("username", "")
             password = data.get("password", "")
             # RTSP port is 7441 for secure, 7447 for insecure
-            port = 7441
-            if host:
+            port = UNIFI_RTSPS_PORT
+            if host and host not in seen_hosts and not entry.get("disabled_by"):
+                seen_hosts.add(host)
                 print(f"[INFO] Found UniFi Protect NVR: {host}:{port}")
                 # URL-encode credentials (password may have special chars)
                 encoded_user = quote(username, safe='') if username else ""
                 encoded_pass = quote(password, safe='') if password else ""
-                return {
+                configs.append({
+                    "entry_id": entry.get("entry_id"),
+                    "title": entry.get("title") or host,
                     "host": host,
                     "port": port,
                     "username": encoded_user,
                     "password": encoded_pass
-                }
+                })
 
-    print("[DEBUG] No UniFi Protect config entry found")
-    return None
+    if not configs:
+        print("[DEBUG] No UniFi Protect config entry found")
+    return configs
 
 
 def get_unifi_camera_info_from_entities(stream_quality: str = "high") -> Dict[str, Dict]:
@@ -149,39 +991,29 @@ def get_unifi_camera_info_from_entities(stream_quality: str = "high") -> Dict[st
     target_channel = quality_to_channel.get(stream_quality, "0")
     print(f"[INFO] Using stream quality: {stream_quality} (channel {target_channel})")
 
-    # Read device registry to get pretty names (name_by_user or name)
-    device_names = {}
-    device_data = read_storage_file("core.device_registry")
-    if device_data:
-        devices = device_data.get("data", {}).get("devices", [])
-        for dev in devices:
-            dev_id = dev.get("id")
-            # name_by_user is the user's custom alias, name is the original device name
-            name = dev.get("name_by_user") or dev.get("name")
-            if dev_id and name:
-                device_names[dev_id] = name
-        print(f"[DEBUG] Loaded {len(device_names)} device names")
-
-    # Read entity registry from storage
-    entity_data = read_storage_file("core.entity_registry")
-    if not entity_data:
+    # Device registry gives pretty names (name_by_user or name)
+    devices_by_id = REGISTRY.devices_by_id() or {}
+    print(f"[DEBUG] Loaded {len(devices_by_id)} devices")
+
+    # Entity registry from storage, indexed by platform
+    entities_by_platform = REGISTRY.entities_by_platform()
+    if entities_by_platform is None:
         print("[DEBUG] Could not read entity registry")
         return cameras
 
-    entities = entity_data.get("data", {}).get("entities", [])
-    print(f"[DEBUG] Read {len(entities)} entities from registry")
+    entities = [ent for platform, platform_entities in entities_by_platform.items()
+                if "unifi" in platform.lower() for ent in platform_entities]
+    print(f"[DEBUG] Read {len(entities)} UniFi entities from registry")
 
     # Track which MACs we've already added (to avoid duplicates across quality levels)
     seen_macs = set()
 
     for ent in entities:
         entity_id = ent.get("entity_id", "")
-        platform = ent.get("platform", "")
         unique_id = ent.get("unique_id", "")
 
         # Look for UniFi Protect camera entities
         if (entity_id.startswith("camera.") and
-            "unifi" in platform.lower() and
             f"_{target_channel}" in unique_id and  # Match target quality channel
             "_insecure" not in unique_id):  # Skip insecure duplicates
 
@@ -197,8 +1029,9 @@ def get_unifi_camera_info_from_entities(stream_quality: str = "high") -> Dict[st
                 seen_macs.add(mac)
 
                 # Get device name from device registry (the pretty name like "Garagem E9")
-                device_id = ent.get("device_id")
-                name = device_names.get(device_id)
+                # name_by_user is the user's custom alias, name is the original device name
+                device = devices_by_id.get(ent.get("device_id")) or {}
+                name = device.get("name_by_user") or device.get("name")
 
                 # Fallback to entity_id if no device name found
                 if not name:
@@ -208,285 +1041,2350 @@ def get_unifi_camera_info_from_entities(stream_quality: str = "high") -> Dict[st
                     "entity_id": entity_id,
                     "name": name,
                     "mac": mac,
-                    "channel": channel
+                    "channel": channel,
+                    "config_entry_id": ent.get("config_entry_id")
                 }
                 print(f"[DEBUG] Found UniFi camera: {name} (MAC: {mac})")
 
     return cameras
 
 
-def get_unifi_rtsp_urls(stream_quality: str = "high") -> Dict[str, str]:
-    """Get RTSP URLs from UniFi Protect API using rtspAlias."""
-    import ssl
-    import urllib.request
-    import http.cookiejar
-    from urllib.parse import unquote
+# Shared state files hold one entry per NVR; clients for different NVRs
+# update them concurrently, so each file gets its own lock
+_STATE_FILE_LOCKS: Dict[str, threading.Lock] = {}
+_STATE_FILE_LOCKS_LOCK = threading.Lock()
 
-    urls = {}
-    quality_to_channel = {"high": 0, "medium": 1, "low": 2}
-    target_channel = quality_to_channel.get(stream_quality, 0)
 
-    nvr_config = get_unifi_protect_config()
-    if not nvr_config:
-        print("[INFO] UniFi Protect integration not found")
-        return urls
+def update_state_file(path: str, key: str, value: Dict) -> None:
+    """Set one entry of a shared JSON state file, owner-only and atomically.
 
-    host = nvr_config["host"]
-    port = nvr_config["port"]
-    username = unquote(nvr_config["username"])  # Decode for API auth
-    password = unquote(nvr_config["password"])
+    The read-modify-write runs under a per-file lock and goes through a
+    unique temp file, so concurrent writers neither lose each other's
+    entries nor clobber each other's temp file.
 
-    print(f"[INFO] Querying UniFi Protect API for camera streams (quality: {stream_quality})...")
-
-    # Get device names from HA device registry
-    device_names = {}
-    device_data = read_storage_file("core.device_registry")
-    if device_data:
-        for dev in device_data.get("data", {}).get("devices", []):
-            # Map MAC to device name
-            for conn in dev.get("connections", []):
-                if isinstance(conn, list) and len(conn) >= 2 and conn[0] == "mac":
-                    mac = conn[1].upper().replace(":", "")
-                    name = dev.get("name_by_user") or dev.get("name")
-                    if mac and name:
-                        device_names[mac] = name
+    Raises:
+        OSError: If the file cannot be written
+    """
+    with _STATE_FILE_LOCKS_LOCK:
+        lock = _STATE_FILE_LOCKS.setdefault(os.path.abspath(path), threading.Lock())
+    with lock:
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except Exception:
+            state = {}
+        state[key] = value
+        # mkstemp creates the file 0600
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                        prefix=f".{os.path.basename(path)}.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
 
-    try:
-        # SSL context (ignore cert verification like HA does)
-        ctx = ssl.create_default_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-
-        cj = http.cookiejar.CookieJar()
-        opener = urllib.request.build_opener(
-            urllib.request.HTTPSHandler(context=ctx),
-            urllib.request.HTTPCookieProcessor(cj)
-        )
-
-        # Authenticate
-        auth_url = f"https://{host}/api/auth/login"
-        auth_data = json.dumps({"username": username, "password": password}).encode()
-        req = urllib.request.Request(auth_url, data=auth_data, method='POST')
-        req.add_header('Content-Type', 'application/json')
-        opener.open(req, timeout=10)
-
-        # Get bootstrap (contains all cameras)
-        bootstrap_url = f"https://{host}/proxy/protect/api/bootstrap"
-        req = urllib.request.Request(bootstrap_url)
-        with opener.open(req, timeout=30) as resp:
-            bootstrap = json.loads(resp.read())
-
-        cameras = bootstrap.get("cameras", [])
-        print(f"[INFO] Found {len(cameras)} cameras in UniFi Protect")
-
-        for cam in cameras:
-            cam_id = cam.get("id", "")
-            mac = cam.get("mac", "").upper()
-            cam_name = device_names.get(mac) or cam.get("name", cam_id)
-
-            # Get rtspAlias for the target channel
-            channels = cam.get("channels", [])
-            rtsp_alias = None
-            for ch in channels:
-                if ch.get("id") == target_channel:
-                    rtsp_alias = ch.get("rtspAlias")
-                    break
 
-            if rtsp_alias:
-                # RTSP URL format: rtsps://host:7441/rtspAlias
-                # Auth is handled via the rtspAlias token, no user/pass needed in URL
-                rtsp_url = f"rtsps://{host}:{port}/{rtsp_alias}"
-                urls[f"camera.{cam_name.lower().replace(' ', '_')}"] = {
-                    "name": cam_name,
-                    "url": rtsp_url
-                }
-                print(f"[INFO] UniFi RTSP: {cam_name} -> rtsps://{host}:{port}/{rtsp_alias}")
-            else:
-                print(f"[WARN] No rtspAlias for {cam_name} channel {target_channel}")
+class UniFiProtectClient:
+    """Keep-alive HTTPS session to one UniFi Protect NVR.
 
-    except Exception as e:
-        print(f"[ERROR] Failed to query UniFi Protect API: {e}")
-        # Fall back to MAC-based URLs
-        print("[INFO] Falling back to MAC-based RTSP URLs...")
-        return get_unifi_rtsp_urls_fallback(stream_quality)
+    The login cookie is persisted in UNIFI_SESSION_PATH and reused across
+    refresh cycles and add-on restarts until it expires; a 401 triggers a
+    single re-login. Certificates are not verified (like HA does).
+    """
 
-    return urls
+    def __init__(self, host: str, username: str, password: str,
+                 state_path: Optional[str] = None):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.state_path = state_path or UNIFI_SESSION_PATH
+        self.session = get_session(f"unifi:{host}")
+        self.expires = None  # epoch seconds, None if unknown
+        self._lock = threading.Lock()
+        self._load_cookies()
 
+    def _state_key(self) -> str:
+        return f"{self.username}@{self.host}"
 
-def get_unifi_rtsp_urls_fallback(stream_quality: str = "high") -> Dict[str, str]:
-    """Fallback: Construct RTSP URLs using MAC addresses (may not work on all setups)."""
-    urls = {}
+    def _load_cookies(self):
+        try:
+            with open(self.state_path) as f:
+                saved = json.load(f).get(self._state_key())
+        except Exception:
+            return
+        if not saved:
+            return
+        if saved.get("expires") and saved["expires"] <= time.time() + 60:
+            return
+        domain = urlsplit(f"https://{self.host}").hostname
+        for name, value in saved.get("cookies", {}).items():
+            self.session.cookies.set(name, value, domain=domain)
+        self.expires = saved.get("expires")
+        print(f"[DEBUG] Reusing saved UniFi Protect session for {self.host}")
 
-    nvr_config = get_unifi_protect_config()
-    if not nvr_config:
-        return urls
+    def _save_cookies(self):
+        try:
+            # Contains a login token: update_state_file writes owner-only
+            update_state_file(self.state_path, self._state_key(), {
+                "cookies": requests.utils.dict_from_cookiejar(self.session.cookies),
+                "expires": self.expires,
+            })
+        except OSError as e:
+            print(f"[DEBUG] Could not persist UniFi session: {e}")
 
-    host = nvr_config["host"]
-    port = nvr_config["port"]
-    username = nvr_config["username"]
-    password = nvr_config["password"]
+    def _cookie_expiry(self) -> Optional[float]:
+        """Expiry of the auth cookie (Expires attribute or JWT exp claim)."""
+        for cookie in self.session.cookies:
+            if cookie.name != "TOKEN":
+                continue
+            if cookie.expires:
+                return float(cookie.expires)
+            try:
+                payload = cookie.value.split(".")[1]
+                payload += "=" * (-len(payload) % 4)
+                return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+            except Exception:
+                return None
+        return None
 
-    cameras = get_unifi_camera_info_from_entities(stream_quality)
+    def _logged_in(self) -> bool:
+        if not self.session.cookies:
+            return False
+        return self.expires is None or self.expires > time.time() + 60
 
-    for entity_id, cam_info in cameras.items():
-        mac = cam_info["mac"]
-        channel = cam_info["channel"]
-        name = cam_info["name"]
+    def login(self):
+        """Authenticate and persist the session cookie."""
+        self.session.cookies.clear()
+        METRICS.count("unifi_logins")
+        resp = self.session.post(f"https://{self.host}/api/auth/login",
+                                 json={"username": self.username, "password": self.password},
+                                 timeout=10, verify=False)
+        resp.raise_for_status()
+        self.expires = self._cookie_expiry()
+        self._save_cookies()
+        print(f"[INFO] Logged in to UniFi Protect at {self.host}")
 
-        if username and password:
-            rtsp_url = f"rtsps://{username}:{password}@{host}:{port}/{mac}?channel={channel}"
-        else:
-            rtsp_url = f"rtsps://{host}:{port}/{mac}?channel={channel}"
+    def cookie_header(self) -> str:
+        """Session cookies as a Cookie header value (for the updates WebSocket)."""
+        with self._lock:
+            if not self._logged_in():
+                self.login()
+        return "; ".join(f"{c.name}={c.value}" for c in self.session.cookies)
 
-        urls[entity_id] = {"name": name, "url": rtsp_url}
+    def get(self, path: str, **kwargs) -> requests.Response:
+        """GET an NVR path, logging in first if needed and once more on 401."""
+        url = f"https://{self.host}{path}"
+        # Passed per request: a session-level verify=False loses to REQUESTS_CA_BUNDLE
+        kwargs.setdefault("verify", False)
+        with self._lock:
+            if not self._logged_in():
+                self.login()
+        resp = self.session.get(url, **kwargs)
+        if resp.status_code == 401:
+            resp.close()
+            print("[INFO] UniFi Protect session expired, logging in again")
+            with self._lock:
+                self.login()
+            resp = self.session.get(url, **kwargs)
+        resp.raise_for_status()
+        return resp
 
-    return urls
 
+class UniFiCameraCache:
+    """Camera/channel map of one NVR, kept current between refresh cycles.
 
-# =============================================================================
-# Method 3: Camera entity attributes
-# =============================================================================
+    Holds the slimmed bootstrap cameras plus the bootstrap ``lastUpdateId``,
+    persisted in UNIFI_CAMERAS_PATH. get_cameras() picks the cheapest way
+    to an up-to-date list:
 
-def get_camera_entities() -> List[Dict]:
-    """Get all camera entities from HA."""
-    states = api_get("/api/states", timeout=30)
-    if not states:
-        return []
+    1. in sync with the live updates WebSocket: cached cameras, no request
+    2. cache present: the cameras-only endpoint (/proxy/protect/api/cameras)
+    3. cache missing or out of sync: the full bootstrap
+    """
 
-    cameras = []
-    for state in states:
-        entity_id = state.get("entity_id", "")
-        if entity_id.startswith("camera."):
-            cameras.append(state)
-    return cameras
+    def __init__(self, client: UniFiProtectClient, state_path: Optional[str] = None):
+        self.client = client
+        self.state_path = state_path or UNIFI_CAMERAS_PATH
+        self.cameras = {}  # camera id -> slimmed camera
+        self.last_update_id = None
+        self.out_of_sync = False
+        self.listener = None
+        self._lock = threading.Lock()
+        self._load()
 
-def get_stream_url_from_attributes(state: Dict) -> Optional[str]:
-    """Try to get RTSP URL from camera entity attributes."""
-    attrs = state.get("attributes", {})
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                saved = json.load(f).get(self.client.host)
+        except Exception:
+            return
+        if saved:
+            self.cameras = {cam["id"]: cam for cam in saved.get("cameras", [])}
+            self.last_update_id = saved.get("lastUpdateId")
 
-    # Check common attribute names
-    for attr in ["stream_source", "rtsp_url", "video_url", "stream_url", "rtsp_stream"]:
-        if attr in attrs and attrs[attr]:
-            url = attrs[attr]
-            if isinstance(url, str) and "://" in url:
-                return url
+    def save(self):
+        with self._lock:
+            entry = {"lastUpdateId": self.last_update_id,
+                     "cameras": list(self.cameras.values())}
+        try:
+            # rtspAlias values grant stream access: update_state_file writes owner-only
+            update_state_file(self.state_path, self.client.host, entry)
+        except OSError as e:
+            print(f"[DEBUG] Could not persist UniFi camera cache: {e}")
 
-    return None
+    def in_sync(self) -> bool:
+        return (bool(self.cameras) and not self.out_of_sync and
+                self.listener is not None and self.listener.synced)
 
+    def _replace(self, cameras: List[Dict], last_update_id: Optional[str] = None):
+        with self._lock:
+            self.cameras = {cam["id"]: cam for cam in cameras if cam.get("id")}
+            if last_update_id:
+                self.last_update_id = last_update_id
+            self.out_of_sync = False
+        self.save()
 
-# =============================================================================
-# Main discovery logic
-# =============================================================================
+    def fetch_bootstrap(self):
+        """Full bootstrap (streamed; only cameras and lastUpdateId are kept)."""
+        with self.client.get("/proxy/protect/api/bootstrap", timeout=30, stream=True) as resp:
+            resp.raw.decode_content = True
+            cameras, extras = stream_json_filter(resp.raw, ("cameras",), transform=slim_unifi_camera,
+                                                 extra_keys=("lastUpdateId",),
+                                                 source="unifi_bootstrap")
+        self._replace(cameras, extras.get("lastUpdateId"))
+        print(f"[DEBUG] UniFi bootstrap: {len(cameras)} cameras, lastUpdateId {self.last_update_id}")
 
-def discover_cameras(filters: List[str] = None, stream_quality: str = "high") -> List[Dict]:
-    """
-    Discover cameras using multiple methods:
-    1. go2rtc streams
-    2. UniFi Protect integration
-    3. Camera entity attributes
+    def fetch_cameras(self):
+        """Cameras-only endpoint: much smaller than the bootstrap."""
+        with self.client.get("/proxy/protect/api/cameras", timeout=15, stream=True) as resp:
+            resp.raw.decode_content = True
+            cameras, _ = stream_json_filter(resp.raw, (), transform=slim_unifi_camera,
+                                            source="unifi_cameras")
+        self._replace(cameras)
+        print(f"[DEBUG] UniFi cameras endpoint: {len(cameras)} cameras")
 
-    Args:
-        filters: List of filter strings to match camera names/entity_ids
-        stream_quality: "high", "medium", or "low" for UniFi cameras
-    """
-    discovered = {}  # name -> {entity_id, name, stream_url}
-
-    # Get all camera entities first
-    camera_entities = get_camera_entities()
-    print(f"[INFO] Found {len(camera_entities)} camera entities in HA")
-
-    # Build entity lookup by name
-    entity_lookup = {}  # name variations -> entity_id
-    for state in camera_entities:
-        entity_id = state.get("entity_id", "")
-        attrs = state.get("attributes", {})
-        friendly_name = attrs.get("friendly_name", "")
-
-        # Apply filters
-        if filters:
-            match = False
-            for f in filters:
-                if f.lower() in entity_id.lower() or f.lower() in friendly_name.lower():
-                    match = True
+    def get_cameras(self) -> List[Dict]:
+        """Return the NVR's cameras, refreshing the cache as cheaply as possible."""
+        if self.in_sync():
+            METRICS.count("unifi_live_cache_hits")
+            print(f"[DEBUG] UniFi cameras from live cache ({len(self.cameras)})")
+        elif self.cameras and self.last_update_id and not self.out_of_sync:
+            try:
+                METRICS.count("unifi_cameras_fetches")
+                self.fetch_cameras()
+            except Exception as e:
+                print(f"[DEBUG] UniFi cameras endpoint failed ({e}), using bootstrap")
+                METRICS.count("unifi_bootstrap_fetches")
+                self.fetch_bootstrap()
+        else:
+            METRICS.count("unifi_bootstrap_fetches")
+            self.fetch_bootstrap()
+
+        if self.listener is not None:
+            self.listener.mark_synced()
+        return self.cached_cameras()
+
+    def cached_cameras(self) -> List[Dict]:
+        """Last known cameras, without any request."""
+        with self._lock:
+            return list(self.cameras.values())
+
+    def apply_update(self, action: Dict, data) -> bool:
+        """Apply one Protect update message; True if discovery-relevant data changed."""
+        with self._lock:
+            if action.get("newUpdateId"):
+                self.last_update_id = action["newUpdateId"]
+            if action.get("modelKey") != "camera":
+                return False
+
+            cam_id = action.get("id")
+            kind = action.get("action")
+            if kind == "remove":
+                return self.cameras.pop(cam_id, None) is not None
+            if kind == "add" and isinstance(data, dict):
+                self.cameras[cam_id] = slim_unifi_camera({"id": cam_id, **data})
+                return True
+            if kind == "update" and isinstance(data, dict):
+                cam = self.cameras.get(cam_id)
+                if cam is None:
+                    # Update for a camera we never saw: the cache missed something
+                    self.out_of_sync = True
+                    return True
+                changed = False
+                for key in UNIFI_CAMERA_FIELDS:
+                    if key in data and cam.get(key) != data[key]:
+                        cam[key] = data[key]
+                        changed = changed or key in UNIFI_CAMERA_URL_FIELDS
+                return changed
+            return False
+
+
+def decode_protect_packet(packet: bytes) -> Tuple[Dict, object]:
+    """Decode a UniFi Protect updates WebSocket packet into (action, data).
+
+    Each packet is two frames (action, then data), each with an 8-byte
+    header: packet type, payload format (1 JSON, 2 text, 3 binary),
+    deflated flag, reserved byte, big-endian payload size. The data frame
+    is returned undecoded (raw bytes) unless the update is for a camera.
+    """
+    frames = []
+    offset = 0
+    while offset < len(packet) and len(frames) < 2:
+        _, payload_format, deflated, _, size = struct.unpack_from("!BBBBI", packet, offset)
+        payload = packet[offset + 8:offset + 8 + size]
+        offset += 8 + size
+        frames.append((payload_format, deflated, payload))
+
+    def decode(frame):
+        payload_format, deflated, payload = frame
+        if deflated:
+            payload = zlib.decompress(payload)
+        if payload_format == 1:
+            return json.loads(payload)
+        if payload_format == 2:
+            return payload.decode()
+        return payload
+
+    action = decode(frames[0])
+    if len(frames) < 2:
+        return action, None
+    if action.get("modelKey") != "camera":
+        return action, frames[1][2]
+    return action, decode(frames[1])
+
+
+class UniFiUpdatesListener(threading.Thread):
+    """Keeps a UniFiCameraCache current from the Protect updates WebSocket.
+
+    ``synced`` is True while connected and after the cache has been
+    refreshed since the last (re)connect. Discovery-relevant changes
+    (cameras added/removed, renamed, channel/rtspAlias changes) are
+    reported through ``on_change``.
+
+    Updates sent while disconnected may have been missed, so every
+    reconnect is reported too. The connection resumes from the cache's
+    lastUpdateId when it has one; without it (a gap that the NVR cannot
+    replay) the cache is marked out of sync, so the refresh uses the full
+    bootstrap instead of the cameras endpoint.
+    """
+
+    RECONNECT_DELAY = 5  # doubled after each failed attempt, up to 300
+
+    def __init__(self, cache: UniFiCameraCache, on_change: Callable[[Set[str], str], None]):
+        super().__init__(name=f"unifi-updates-{cache.client.host}", daemon=True)
+        self.cache = cache
+        self.on_change = on_change
+        self.connected = False
+        self.synced = False
+        self._has_connected = False
+        self._ws = None
+        self._stopping = threading.Event()
+
+    def mark_synced(self):
+        self.synced = self.connected
+
+    def stop(self):
+        self._stopping.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def run(self):
+        backoff = self.RECONNECT_DELAY
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                if not self._stopping.is_set():
+                    print(f"[DEBUG] UniFi updates connection to {self.cache.client.host} lost: {e}")
+            if self.connected:
+                backoff = self.RECONNECT_DELAY
+            self.connected = False
+            self.synced = False
+            self._stopping.wait(backoff)
+            backoff = min(backoff * 2, 300)
+
+    def _listen(self):
+        client = self.cache.client
+        url = f"wss://{client.host}/proxy/protect/ws/updates"
+        resume_id = self.cache.last_update_id
+        if resume_id:
+            url += f"?lastUpdateId={resume_id}"
+        ws = websocket.create_connection(
+            url, cookie=client.cookie_header(), timeout=30,
+            sslopt={"cert_reqs": ssl.CERT_NONE, "check_hostname": False})
+        self._ws = ws
+        try:
+            if self._stopping.is_set():
+                return
+            self.connected = True
+            print(f"[INFO] Listening for UniFi Protect updates from {client.host}")
+            if self._has_connected:
+                if resume_id:
+                    reason = f"UniFi updates from {client.host} reconnected"
+                else:
+                    # Nothing to resume from: changes in the gap are unknown
+                    self.cache.out_of_sync = True
+                    reason = f"UniFi updates from {client.host} reconnected without lastUpdateId"
+                self.on_change({SOURCE_UNIFI}, reason)
+            self._has_connected = True
+            while not self._stopping.is_set():
+                try:
+                    packet = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    ws.ping()
+                    continue
+                if self._stopping.is_set():
+                    break  # replaced or stopped while waiting
+                if not packet:
+                    raise ConnectionError("connection closed")
+                try:
+                    action, data = decode_protect_packet(packet)
+                except Exception as e:
+                    print(f"[DEBUG] Undecodable UniFi update ({e}), cache marked out of sync")
+                    self.cache.out_of_sync = True
+                    self.on_change({SOURCE_UNIFI}, "UniFi update stream out of sync")
+                    continue
+                if self.cache.apply_update(action, data):
+                    self.cache.save()
+                    self.on_change({SOURCE_UNIFI},
+                                   f"UniFi camera {action.get('id')} {action.get('action')}")
+        finally:
+            self._ws = None
+            ws.close()
+
+
+# Set by the discovery service to receive UniFi camera changes (daemon mode)
+_unifi_on_change = None
+
+
+def enable_unifi_live_updates(on_change: Callable[[Set[str], str], None]):
+    """Keep UniFi camera caches current via the Protect updates WebSocket."""
+    global _unifi_on_change
+    _unifi_on_change = on_change
+
+
+_UNIFI_CACHES = {}
+
+
+def get_unifi_camera_cache(client: UniFiProtectClient) -> UniFiCameraCache:
+    """Return the camera cache for an NVR, starting its updates listener if enabled."""
+    with _UNIFI_CLIENTS_LOCK:
+        cache = _UNIFI_CACHES.get(client.host)
+        if cache is None or cache.client is not client:
+            if cache is not None and cache.listener is not None:
+                # New credentials for this NVR: the old session's listener must not linger
+                cache.listener.stop()
+            cache = _UNIFI_CACHES[client.host] = UniFiCameraCache(client)
+        if cache.listener is None and _unifi_on_change is not None and websocket is not None:
+            cache.listener = UniFiUpdatesListener(cache, _unifi_on_change)
+            cache.listener.start()
+        return cache
+
+
+def release_unifi_caches(hosts: Set[str]):
+    """Drop the camera caches (and stop the listeners) of NVRs not in ``hosts``."""
+    with _UNIFI_CLIENTS_LOCK:
+        for host in [h for h in _UNIFI_CACHES if h not in hosts]:
+            cache = _UNIFI_CACHES.pop(host)
+            if cache.listener is not None:
+                cache.listener.stop()
+                print(f"[INFO] Stopped UniFi Protect updates from {host} (no longer configured)")
+
+
+_UNIFI_CLIENTS = {}
+_UNIFI_CLIENTS_LOCK = threading.Lock()
+
+
+def get_unifi_client(host: str, username: str, password: str) -> UniFiProtectClient:
+    """Return the shared client for an NVR (one per host and credentials)."""
+    key = (host, username, password)
+    with _UNIFI_CLIENTS_LOCK:
+        client = _UNIFI_CLIENTS.get(key)
+        if client is None:
+            client = _UNIFI_CLIENTS[key] = UniFiProtectClient(host, username, password)
+        return client
+
+
+# Bootstrap camera fields used by discovery; the rest is dropped while streaming
+UNIFI_CAMERA_FIELDS = ("id", "mac", "name", "channels", "state", "isConnected")
+# Fields whose change alters the generated URLs or names
+UNIFI_CAMERA_URL_FIELDS = ("mac", "name", "channels")
+
+
+def slim_unifi_camera(cam: Dict) -> Dict:
+    """Keep only the bootstrap camera fields discovery needs."""
+    return {key: cam[key] for key in UNIFI_CAMERA_FIELDS if key in cam}
+
+
+# Channel selection: fixed quality, per-camera overrides, or "auto" (fit a bandwidth budget)
+QUALITY_CHANNELS = {"high": 0, "medium": 1, "low": 2}
+STREAM_QUALITY_REPORT_PATH = os.path.join(DATA_PATH, "stream_quality.json")
+
+
+def channel_bitrate(channel: Dict) -> int:
+    """Channel bitrate in bit/s (estimated from resolution and fps if not reported)."""
+    bitrate = channel.get("bitrate") or channel.get("maxBitrate")
+    if bitrate:
+        return int(bitrate)
+    # Rough H.264 estimate: ~0.1 bit per pixel per frame
+    return int((channel.get("width") or 1280) * (channel.get("height") or 720)
+               * (channel.get("fps") or 15) * 0.1)
+
+
+def channel_policy_from_options(options: Dict) -> Dict:
+    """Bandwidth budget and per-camera quality overrides from add-on options."""
+    overrides = {}
+    for item in options.get("camera_quality") or []:
+        if isinstance(item, dict) and item.get("camera") and item.get("quality"):
+            overrides[normalize_name(item["camera"])] = item["quality"]
+    return {
+        "budget_bps": int(float(options.get("bandwidth_budget", 0) or 0) * 1_000_000),
+        "overrides": overrides,
+    }
+
+
+def select_unifi_channels(cameras: List[Dict], stream_quality: str = "high",
+                          policy: Optional[Dict] = None) -> Dict[str, Dict]:
+    """Choose one RTSP channel per UniFi camera.
+
+    Args:
+        cameras: [{"key", "name", "mac", "channels"}] (channels as in the bootstrap)
+        stream_quality: "high", "medium", "low" or "auto"
+        policy: channel_policy_from_options() result
+
+    With "auto", cameras whose quality is not overridden start on their
+    lowest-bitrate channel and are upgraded one step at a time, cheapest
+    upgrade first, while the total stays within the budget. Without a
+    budget, "auto" means "high".
+
+    Returns key -> {"channel", "reason"} (cameras without an RTSP channel
+    are left out).
+    """
+    policy = policy or {}
+    overrides = policy.get("overrides") or {}
+    budget = policy.get("budget_bps") or 0
+    if stream_quality == "auto" and not budget:
+        print("[WARN] stream_quality is auto but no bandwidth_budget is set, using high")
+        stream_quality = "high"
+
+    choices = {}
+    ladders = {}  # key -> RTSP channels, lowest bitrate first
+    for cam in cameras:
+        ladder = sorted((ch for ch in cam.get("channels") or []
+                         if ch.get("rtspAlias") and ch.get("enabled", True)),
+                        key=channel_bitrate)
+        if not ladder:
+            continue
+        override = overrides.get(normalize_name(cam["name"])) or overrides.get(normalize_name(cam.get("mac", "")))
+        quality = override or stream_quality
+        if quality in QUALITY_CHANNELS:
+            wanted = QUALITY_CHANNELS[quality]
+            channel = next((ch for ch in ladder if ch.get("id") == wanted), None)
+            if channel is None:
+                print(f"[WARN] No rtspAlias for {cam['name']} channel {wanted}")
+                continue
+            choices[cam["key"]] = {"channel": channel, "reason": "override" if override else quality}
+        else:
+            ladders[cam["key"]] = ladder
+
+    if ladders:
+        used = sum(channel_bitrate(c["channel"]) for c in choices.values())
+        level = {key: 0 for key in ladders}
+        used += sum(channel_bitrate(ladder[0]) for ladder in ladders.values())
+        if used > budget:
+            print(f"[WARN] Lowest channels already need {used / 1e6:.1f} Mbps, "
+                  f"over the {budget / 1e6:.1f} Mbps budget")
+        upgraded = True
+        while upgraded:
+            # One step per camera per round, cheapest first, so no camera runs ahead
+            upgraded = False
+            steps = sorted((channel_bitrate(ladders[key][level[key] + 1])
+                            - channel_bitrate(ladders[key][level[key]]), key)
+                           for key in ladders if level[key] + 1 < len(ladders[key]))
+            for cost, key in steps:
+                if used + cost <= budget:
+                    used += cost
+                    level[key] += 1
+                    upgraded = True
+        for key, ladder in ladders.items():
+            choices[key] = {"channel": ladder[level[key]], "reason": "budget"}
+    return choices
+
+
+def report_stream_quality(cameras: List[Dict], choices: Dict[str, Dict], policy: Optional[Dict],
+                          path: Optional[str] = None):
+    """Log the chosen channel per camera and write the report to /data."""
+    rows = []
+    for cam in cameras:
+        choice = choices.get(cam["key"])
+        if not choice:
+            continue
+        ch = choice["channel"]
+        rows.append({
+            "camera": cam["name"],
+            "mac": cam.get("mac", ""),
+            "channel": ch.get("id"),
+            "channel_name": ch.get("name", ""),
+            "resolution": f"{ch.get('width', '?')}x{ch.get('height', '?')}",
+            "fps": ch.get("fps"),
+            "bitrate_bps": channel_bitrate(ch),
+            "reason": choice["reason"],
+        })
+    total = sum(row["bitrate_bps"] for row in rows)
+    budget = (policy or {}).get("budget_bps") or 0
+
+    print("[INFO] UniFi stream quality:")
+    for row in sorted(rows, key=lambda r: r["camera"].lower()):
+        print(f"[INFO]   {row['camera']}: channel {row['channel']} ({row['channel_name']}, "
+              f"{row['resolution']}@{row['fps']}fps, {row['bitrate_bps'] / 1e6:.1f} Mbps, {row['reason']})")
+    print(f"[INFO]   Total {total / 1e6:.1f} Mbps" + (f" of {budget / 1e6:.1f} Mbps budget" if budget else ""))
+
+    path = path or STREAM_QUALITY_REPORT_PATH
+    try:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"total_bps": total, "budget_bps": budget, "cameras": rows}, f, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"[DEBUG] Could not write stream quality report: {e}")
+
+
+UNIFI_NVR_DEADLINE = 40  # per NVR, inside the unifi source deadline
+
+
+def get_nvr_cameras(nvr_config: Dict) -> List[Dict]:
+    """Cameras of one NVR from its cached/live camera map (may raise)."""
+    from urllib.parse import unquote
+
+    host = nvr_config["host"]
+    username = unquote(nvr_config["username"])  # Decode for API auth
+    password = unquote(nvr_config["password"])
+    breaker = get_breaker(f"{SOURCE_UNIFI}:{host}")
+    cache = get_unifi_camera_cache(get_unifi_client(host, username, password))
+    if not breaker.allow():
+        # NVR backing off: last known cameras, no requests
+        cameras = cache.cached_cameras()
+        if cameras:
+            return cameras
+        raise SourceUnavailable(f"{host}: circuit open")
+    try:
+        # Cached camera/channel map, refreshed from live updates, the cameras
+        # endpoint or (only if missing/out of sync) the full bootstrap
+        cameras = cache.get_cameras()
+    except Exception as e:
+        breaker.record_failure(str(e))
+        raise
+    breaker.record_success()
+    return cameras
+
+
+def get_unifi_rtsp_urls(stream_quality: str = "high",
+                        channel_policy: Optional[Dict] = None) -> Dict[str, str]:
+    """Get RTSP URLs from UniFi Protect API using rtspAlias.
+
+    Every UniFi Protect config entry (NVR/console) is queried in parallel,
+    each with its own session, circuit breaker and UNIFI_NVR_DEADLINE. An
+    NVR that fails or is too slow contributes its last known cameras
+    (or the registry-based fallback URLs) without holding up the others.
+
+    The channel per camera comes from select_unifi_channels() (fixed
+    quality, per-camera overrides or a bandwidth budget shared by all NVRs).
+    """
+    urls = {}
+
+    nvr_configs = get_unifi_protect_configs()
+    release_unifi_caches({nvr["host"] for nvr in nvr_configs})
+    if not nvr_configs:
+        print("[INFO] UniFi Protect integration not found")
+        return urls
+
+    print(f"[INFO] Querying {len(nvr_configs)} UniFi Protect NVR(s) for camera streams "
+          f"(quality: {stream_quality})...")
+
+    # Get device names from HA device registry (indexed by MAC)
+    devices_by_mac = REGISTRY.devices_by_mac() or {}
+
+    results = {}  # host -> cameras
+    fallback_nvrs = []
+    executor = ThreadPoolExecutor(max_workers=len(nvr_configs), thread_name_prefix="nvr")
+    started = time.monotonic()
+    try:
+        futures = {executor.submit(get_nvr_cameras, nvr): nvr for nvr in nvr_configs}
+        for future, nvr in futures.items():
+            host = nvr["host"]
+            remaining = max(0, UNIFI_NVR_DEADLINE - (time.monotonic() - started))
+            try:
+                results[host] = future.result(timeout=remaining)
+                print(f"[INFO] Found {len(results[host])} cameras in UniFi Protect at {host}")
+                continue
+            except FuturesTimeoutError:
+                print(f"[WARN] UniFi Protect at {host} missed its {UNIFI_NVR_DEADLINE}s deadline")
+                get_breaker(f"{SOURCE_UNIFI}:{host}").record_failure("missed deadline")
+            except Exception as e:
+                print(f"[ERROR] Failed to query UniFi Protect API at {host}: {e}")
+            cache = _UNIFI_CACHES.get(host)
+            cameras = cache.cached_cameras() if cache is not None else []
+            if cameras:
+                print(f"[INFO] Using last known cameras for {host}")
+                results[host] = cameras
+            else:
+                fallback_nvrs.append(nvr)
+    finally:
+        # A slow NVR finishes (and updates its cache) in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    named = []
+    keys = set()
+    for nvr in nvr_configs:
+        for cam in results.get(nvr["host"], []):
+            cam_id = cam.get("id", "")
+            mac = cam.get("mac", "").upper()
+            device = devices_by_mac.get(mac) or {}
+            cam_name = device.get("name_by_user") or device.get("name") or cam.get("name", cam_id)
+            key = f"camera.{cam_name.lower().replace(' ', '_')}"
+            if key in keys:
+                # Same name on two consoles, or twice on one
+                unique = f"{key}@{nvr['host']}"
+                if unique in keys:
+                    unique = f"{unique}/{mac or cam_id}"
+                print(f"[WARN] Duplicate UniFi camera name '{cam_name}', using {unique}")
+                key = unique
+            keys.add(key)
+            named.append({"key": key, "name": cam_name, "mac": mac, "nvr": nvr,
+                          "channels": cam.get("channels", [])})
+
+    choices = select_unifi_channels(named, stream_quality, channel_policy)
+    for cam in named:
+        choice = choices.get(cam["key"])
+        if not choice:
+            continue
+        host, port = cam["nvr"]["host"], cam["nvr"]["port"]
+        rtsp_alias = choice["channel"]["rtspAlias"]
+        # RTSP URL format: rtsps://host:7441/rtspAlias
+        # Auth is handled via the rtspAlias token, no user/pass needed in URL
+        rtsp_url = f"rtsps://{host}:{port}/{rtsp_alias}"
+        urls[cam["key"]] = {
+            "name": cam["name"],
+            "url": rtsp_url,
+            # Plain RTSP on 7447 if RTSPS is unreachable
+            "candidates": [rtsp_url, f"rtsp://{host}:{UNIFI_RTSP_INSECURE_PORT}/{rtsp_alias}"],
+            "mac": cam["mac"],
+            "channel": choice["channel"].get("id"),
+            "nvr": host
+        }
+        print(f"[INFO] UniFi RTSP: {cam['name']} -> rtsps://{host}:{port}/{rtsp_alias}")
+    if choices:
+        report_stream_quality(named, choices, channel_policy)
+
+    if fallback_nvrs:
+        # Fall back to MAC-based URLs for NVRs without any camera data
+        print("[INFO] Falling back to MAC-based RTSP URLs...")
+        fallback = get_unifi_rtsp_urls_fallback("high" if stream_quality == "auto" else stream_quality,
+                                                fallback_nvrs, single_nvr=len(nvr_configs) == 1)
+        for key, cam in fallback.items():
+            urls.setdefault(key, cam)
+
+    return urls
+
+
+def get_unifi_rtsp_urls_fallback(stream_quality: str = "high",
+                                 nvr_configs: Optional[List[Dict]] = None,
+                                 single_nvr: bool = False) -> Dict[str, str]:
+    """Fallback: Construct RTSP URLs using MAC addresses (may not work on all setups).
+
+    Cameras are assigned to an NVR through their entity's config entry; with
+    a single NVR configured, every UniFi camera entity belongs to it.
+    """
+    urls = {}
+
+    if nvr_configs is None:
+        nvr_configs = get_unifi_protect_configs()
+        single_nvr = len(nvr_configs) == 1
+    if not nvr_configs:
+        return urls
+    nvrs_by_entry = {nvr.get("entry_id"): nvr for nvr in nvr_configs}
+
+    cameras = get_unifi_camera_info_from_entities(stream_quality)
+
+    for entity_id, cam_info in cameras.items():
+        nvr = nvr_configs[0] if single_nvr else nvrs_by_entry.get(cam_info.get("config_entry_id"))
+        if nvr is None:
+            continue
+        host = nvr["host"]
+        port = nvr["port"]
+        username = nvr["username"]
+        password = nvr["password"]
+        mac = cam_info["mac"]
+        channel = cam_info["channel"]
+        name = cam_info["name"]
+
+        if username and password:
+            rtsp_url = f"rtsps://{username}:{password}@{host}:{port}/{mac}?channel={channel}"
+        else:
+            rtsp_url = f"rtsps://{host}:{port}/{mac}?channel={channel}"
+
+        urls[entity_id] = {"name": name, "url": rtsp_url, "mac": mac, "entity_id": entity_id,
+                           "nvr": host}
+
+    return urls
+
+
+# =============================================================================
+# Method 3: Camera entity attributes
+# =============================================================================
+
+# Renders only camera states server-side, so bytes transferred scale with
+# the number of cameras instead of the number of entities
+CAMERA_STATES_TEMPLATE = (
+    "[{% for s in states.camera %}"
+    "{{ {'entity_id': s.entity_id, 'state': s.state, 'attributes': dict(s.attributes)} | to_json }}"
+    "{% if not loop.last %},{% endif %}"
+    "{% endfor %}]"
+)
+# The template and the /api/states fallback must both fit in EntitySource.deadline
+HA_TEMPLATE_TIMEOUT = 12
+HA_STATES_TIMEOUT = 20
+
+
+def get_camera_entities() -> List[Dict]:
+    """Get all camera entities from HA.
+
+    Uses a template over states.camera; if that fails, falls back to
+    /api/states, streamed and filtered to camera.* as it is parsed.
+    Raises SourceUnavailable if neither answers.
+    """
+    rendered = api_post("/api/template", {"template": CAMERA_STATES_TEMPLATE},
+                        timeout=HA_TEMPLATE_TIMEOUT)
+    if rendered is not None:
+        METRICS.add_parsed("ha_template", len(rendered))
+        try:
+            cameras = json.loads(rendered)
+            if isinstance(cameras, list):
+                return cameras
+        except ValueError as e:
+            print(f"[DEBUG] Camera states template returned invalid JSON: {e}")
+
+    print("[DEBUG] Falling back to /api/states")
+    try:
+        with get_session("ha").get(f"{HA_URL}/api/states", headers=ha_headers(),
+                                   timeout=HA_STATES_TIMEOUT, stream=True) as resp:
+            if resp.status_code != 200:
+                raise SourceUnavailable(f"/api/states: HTTP {resp.status_code}")
+            resp.raw.decode_content = True
+            cameras, _ = stream_json_filter(
+                resp.raw, (),
+                keep=lambda state: state.get("entity_id", "").startswith("camera."),
+                prefilter=CAMERA_ENTITY_PREFILTER, source="ha_states")
+            return cameras
+    except SourceUnavailable:
+        raise
+    except Exception as e:
+        raise SourceUnavailable(f"/api/states: {e}") from e
+
+
+def get_stream_url_from_attributes(state: Dict) -> Optional[str]:
+    """Try to get RTSP URL from camera entity attributes."""
+    attrs = state.get("attributes", {})
+
+    # Check common attribute names
+    for attr in ["stream_source", "rtsp_url", "video_url", "stream_url", "rtsp_stream"]:
+        if attr in attrs and attrs[attr]:
+            url = attrs[attr]
+            if isinstance(url, str) and "://" in url:
+                return url
+
+    return None
+
+
+# =============================================================================
+# Camera matching
+# =============================================================================
+
+# Tokens that say nothing about which camera a name refers to
+MATCH_STOPWORDS = frozenset({"camera", "high", "medium", "low", "resolution", "insecure"})
+
+
+def normalize_name(value: str) -> str:
+    """Lower-case, accent-free, single-spaced alphanumeric form of a name."""
+    value = unicodedata.normalize("NFKD", value or "")
+    value = "".join(c for c in value if not unicodedata.combining(c))
+    return " ".join(re.findall(r"[a-z0-9]+", value.lower()))
+
+
+def name_tokens(normalized: str) -> frozenset:
+    return frozenset(t for t in normalized.split() if t not in MATCH_STOPWORDS)
+
+
+def compile_camera_filters(filters: Optional[List[str]]) -> Callable[[str, str], bool]:
+    """Build a predicate (entity_id, friendly_name) -> bool from camera_filters."""
+    needles = [f.lower() for f in (filters or []) if f]
+    if not needles:
+        return lambda entity_id, name: True
+
+    def matches(entity_id: str, name: str) -> bool:
+        haystacks = (entity_id.lower(), name.lower())
+        return any(n in h for n in needles for h in haystacks)
+
+    return matches
+
+
+class CameraMatcher:
+    """Index of discovered cameras for matching stream sources to entities.
+
+    Built once per run. Cameras are indexed by exact keys (device id, MAC,
+    entity id), normalized name and object-id slug, separator-free form and
+    name tokens, so each source name is only scored against the few
+    cameras it could plausibly be. assign() does a scored best-match
+    assignment (each camera at most once, ties broken by key order), so
+    "Garage" prefers "Garage" over "Garage Side" and results do not depend
+    on dict order.
+    """
+
+    SCORE_KEY = 100        # Same device id, MAC or entity id
+    SCORE_EXACT = 90       # Same normalized name or slug
+    SCORE_COMPACT = 85     # Same name ignoring separators ("frontdoor" / "Front Door")
+    SCORE_TOKENS = 80      # Same set of significant words
+    SCORE_OVERLAP = 40     # Most words shared, plus up to 39 by overlap ratio
+    SCORE_SUBSTRING = 30   # Legacy substring fallback
+
+    # Minimum shared/union word ratio for a partial overlap to count
+    OVERLAP_MIN_RATIO = 0.67
+
+    # Tokens shared by more cameras than this are not used to find candidates
+    COMMON_TOKEN_LIMIT = 50
+
+    def __init__(self):
+        self.by_key = {}       # "mac:<MAC>" / "device:<id>" / "entity:<id>" -> entity_id
+        self.by_form = {}      # normalized name, slug or compact form -> {entity_id}
+        self.by_token = {}     # token -> {entity_id}
+        self.profiles = {}     # entity_id -> (forms, compact forms, tokens)
+
+    def add(self, entity_id: str, name: str, keys: Tuple[str, ...] = ()):
+        """Index one camera entity."""
+        slug = normalize_name(entity_id.split(".", 1)[-1])
+        norm = normalize_name(name)
+        forms = {f for f in (norm, slug) if f}
+        compacts = {f.replace(" ", "") for f in forms}
+        tokens = name_tokens(norm) | name_tokens(slug)
+        self.profiles[entity_id] = (forms, compacts, tokens)
+
+        for key in (f"entity:{entity_id}",) + tuple(keys):
+            self.by_key.setdefault(key, entity_id)
+        for form in forms | compacts:
+            self.by_form.setdefault(form, set()).add(entity_id)
+        for token in tokens:
+            self.by_token.setdefault(token, set()).add(entity_id)
+
+    def _score(self, entity_id: str, norm: str, compact: str, tokens: frozenset) -> int:
+        forms, compacts, entity_tokens = self.profiles[entity_id]
+        if norm in forms:
+            return self.SCORE_EXACT
+        if compact in compacts:
+            return self.SCORE_COMPACT
+        if tokens and tokens == entity_tokens:
+            return self.SCORE_TOKENS
+        shared = len(tokens & entity_tokens)
+        if not shared:
+            return 0
+        # A single common word ("Door", "Room", "Side") is not enough: every
+        # word of the shorter name must appear in the other, or the names must
+        # share most of their words ("Back Door" is not "Front Door")
+        union = len(tokens | entity_tokens)
+        if shared < min(len(tokens), len(entity_tokens)) and shared < self.OVERLAP_MIN_RATIO * union:
+            return 0
+        return self.SCORE_OVERLAP + (39 * shared) // union
+
+    def candidates(self, name: str, keys: Tuple[str, ...] = ()) -> Dict[str, int]:
+        """Score the cameras a source name/keys could refer to."""
+        scores = {}
+        for key in keys:
+            entity_id = self.by_key.get(key)
+            if entity_id:
+                scores[entity_id] = self.SCORE_KEY
+
+        norm = normalize_name(name)
+        compact = norm.replace(" ", "")
+        tokens = name_tokens(norm)
+        pool = set(self.by_form.get(norm, ())) | set(self.by_form.get(compact, ()))
+        for token in tokens:
+            ids = self.by_token.get(token, ())
+            if len(ids) <= self.COMMON_TOKEN_LIMIT:
+                pool.update(ids)
+        for entity_id in pool:
+            if entity_id not in scores:
+                score = self._score(entity_id, norm, compact, tokens)
+                if score:
+                    scores[entity_id] = score
+        return scores
+
+    def assign(self, items: Dict[str, Dict],
+               eligible: Callable[[str], bool] = lambda entity_id: True) -> Dict[str, str]:
+        """Assign source items to cameras, best scores first, one-to-one.
+
+        Args:
+            items: item key -> {"name": ..., "keys": (...)}
+            eligible: Whether a camera may still receive a stream
+
+        Returns:
+            item key -> entity_id for the matched items
+        """
+        pairs = []
+        for item_key, item in items.items():
+            for entity_id, score in self.candidates(item.get("name", item_key),
+                                                    tuple(item.get("keys", ()))).items():
+                if eligible(entity_id):
+                    pairs.append((-score, item_key, entity_id))
+        pairs.sort()
+
+        assigned = {}
+        taken = set()
+        for _, item_key, entity_id in pairs:
+            if item_key not in assigned and entity_id not in taken:
+                assigned[item_key] = entity_id
+                taken.add(entity_id)
+
+        # Legacy fallback for leftovers: substring match on separator-free names.
+        # Only for run-together names ("frontdoor"); when both names have
+        # several words the token rules above already decided.
+        leftovers = sorted(k for k in items if k not in assigned)
+        if leftovers:
+            free = sorted(e for e in self.profiles if e not in taken and eligible(e))
+            for item_key in leftovers:
+                norm = normalize_name(items[item_key].get("name", item_key))
+                compact = norm.replace(" ", "")
+                if len(compact) < 3:
+                    continue
+                for entity_id in free:
+                    if entity_id in taken:
+                        continue
+                    if any((" " not in norm or " " not in form)
+                           and (compact in c or (len(c) >= 3 and c in compact))
+                           for form in self.profiles[entity_id][0]
+                           for c in (form.replace(" ", ""),)):
+                        assigned[item_key] = entity_id
+                        taken.add(entity_id)
+                        break
+        return assigned
+
+
+# =============================================================================
+# Stream health probing (RTSP OPTIONS/DESCRIBE)
+# =============================================================================
+
+STREAM_PROBE_CONCURRENCY = 16
+STREAM_PROBE_TIMEOUT = 3       # per connection/request
+STREAM_PROBE_DEADLINE = 20     # whole probe round; unfinished probes count as unknown
+STREAM_PROBE_TTL = 300         # how long a live result is trusted
+STREAM_PROBE_DEAD_TTL = 60     # dead streams are re-checked sooner
+RTSP_DEFAULT_PORTS = {"rtsp": 554, "rtsps": 322}
+
+
+def redact_url(url: str) -> str:
+    """URL with any user:password removed, for logging."""
+    parts = urlsplit(url)
+    if "@" not in parts.netloc:
+        return url
+    return urlunsplit(parts._replace(netloc="***@" + parts.netloc.rsplit("@", 1)[1]))
+
+
+def rtsp_connect(url: str, timeout: float) -> Tuple[socket.socket, str]:
+    """Open a (TLS for rtsps) connection for an RTSP URL.
+
+    Returns (socket, request URL); credentials never go in the request line.
+    Raises ValueError for URLs that are not RTSP/RTSPS.
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in RTSP_DEFAULT_PORTS or not parts.hostname:
+        raise ValueError("invalid URL")
+    netloc = parts.netloc.rsplit("@", 1)[-1]
+    request_url = urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+    sock = socket.create_connection((parts.hostname, parts.port or RTSP_DEFAULT_PORTS[scheme]),
+                                    timeout=timeout)
+    try:
+        if scheme == "rtsps":
+            # Cameras and NVRs use self-signed certificates
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            sock = context.wrap_socket(sock, server_hostname=parts.hostname)
+        sock.settimeout(timeout)
+    except Exception:
+        sock.close()
+        raise
+    return sock, request_url
+
+
+def read_rtsp_response(reader) -> Tuple[int, Dict[str, str], bytes]:
+    """Read one RTSP response: (status, lower-cased headers, body)."""
+    status_line = reader.readline(1024).decode("latin-1")
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith("RTSP/") or not parts[1].isdigit():
+        raise ValueError("not an RTSP server")
+    headers = {}
+    while True:
+        line = reader.readline(8192)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = headers.get("content-length", "")
+    body = reader.read(min(int(length), 65536)) if length.isdigit() else b""
+    return int(parts[1]), headers, body
+
+
+def rtsp_request(sock, reader, method: str, url: str, cseq: int,
+                 headers: Optional[Dict[str, str]] = None,
+                 user_agent: str = "Auto-Monocle") -> Tuple[int, Dict[str, str], bytes]:
+    """Send one RTSP request and return its response (status, headers, body)."""
+    request = f"{method} {url} RTSP/1.0\r\nCSeq: {cseq}\r\nUser-Agent: {user_agent}\r\n"
+    if method == "DESCRIBE":
+        request += "Accept: application/sdp\r\n"
+    for name, value in (headers or {}).items():
+        request += f"{name}: {value}\r\n"
+    sock.sendall((request + "\r\n").encode())
+    return read_rtsp_response(reader)
+
+
+class StreamProber:
+    """Bounded-concurrency RTSP/RTSPS health checks with a per-URL cache.
+
+    A stream is alive if its server answers OPTIONS and DESCRIBE with 200,
+    or asks for credentials (the stream exists; the gateway sends the URL's
+    own credentials). Refused connections, TLS errors and error statuses
+    mean dead; a timeout is unknown (a busy camera is not a missing one).
+    Non-RTSP URLs are not probed.
+
+    Results are cached per URL for ``ttl`` seconds (``dead_ttl`` for dead
+    ones), and consecutive dead results are counted per URL. Kept at module
+    level, so the discovery service reuses it.
+    """
+
+    def __init__(self, timeout: float = STREAM_PROBE_TIMEOUT, ttl: float = STREAM_PROBE_TTL,
+                 dead_ttl: float = STREAM_PROBE_DEAD_TTL,
+                 concurrency: int = STREAM_PROBE_CONCURRENCY,
+                 deadline: float = STREAM_PROBE_DEADLINE):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.dead_ttl = dead_ttl
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self._cache = {}  # url -> (expires, alive, status)
+        self._failures = {}  # url -> consecutive dead probes
+        self._lock = threading.Lock()
+
+    def failures(self, url: str) -> int:
+        """Probes in a row that found ``url`` dead (unknown results don't count)."""
+        with self._lock:
+            return self._failures.get(url, 0)
+
+    def probe(self, url: str) -> Tuple[Optional[bool], str]:
+        """Probe one URL now (uncached). Returns (alive, status)."""
+        if urlsplit(url).scheme.lower() not in RTSP_DEFAULT_PORTS:
+            return None, "not probed"
+        try:
+            sock, request_url = rtsp_connect(url, self.timeout)
+            try:
+                reader = sock.makefile("rb")
+                for cseq, method in enumerate(("OPTIONS", "DESCRIBE"), 1):
+                    status = rtsp_request(sock, reader, method, request_url, cseq)[0]
+                    if status == 401:
+                        return True, "auth required"
+                    if status != 200:
+                        return False, f"{method} {status}"
+                return True, "ok"
+            finally:
+                sock.close()
+        except socket.timeout:
+            return None, "timeout"
+        except (OSError, ValueError) as e:
+            return False, str(e) or type(e).__name__
+
+    def check(self, urls: List[str]) -> Dict[str, Tuple[Optional[bool], str]]:
+        """Probe many URLs concurrently, answering from the cache where possible.
+
+        Returns url -> (alive, status); alive is None if the URL was not
+        probed (not RTSP, or the round deadline passed first).
+        """
+        results = {}
+        pending = []
+        now = time.monotonic()
+        with self._lock:
+            for url in dict.fromkeys(urls):
+                cached = self._cache.get(url)
+                if cached and cached[0] > now:
+                    results[url] = cached[1:]
+                else:
+                    pending.append(url)
+        METRICS.count("stream_probe_cache_hits", len(results))
+        if not pending:
+            return results
+
+        executor = ThreadPoolExecutor(max_workers=min(self.concurrency, len(pending)),
+                                      thread_name_prefix="probe")
+        try:
+            futures = {executor.submit(self.probe, url): url for url in pending}
+            try:
+                for future in as_completed(futures, timeout=self.deadline):
+                    results[futures[future]] = future.result()
+            except FuturesTimeoutError:
+                print(f"[WARN] Stream probing missed its {self.deadline}s deadline")
+        finally:
+            # Sockets time out on their own; don't wait for stragglers
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        now = time.monotonic()
+        with self._lock:
+            for url in pending:
+                if url not in results:
+                    results[url] = (None, "deadline")
+                    continue
+                alive, status = results[url]
+                if alive is not None:
+                    self._cache[url] = (now + (self.ttl if alive else self.dead_ttl), alive, status)
+                    METRICS.count("stream_probes_alive" if alive else "stream_probes_dead")
+                    if alive:
+                        self._failures.pop(url, None)
+                    else:
+                        self._failures[url] = self._failures.get(url, 0) + 1
+        return results
+
+
+STREAM_PROBER = StreamProber()
+
+# A camera's selected URL is only given up after this many dead probes in a row
+STREAM_SWITCH_FAILURES = 3
+
+# entity_id -> URL selected for it; kept across refreshes
+_SELECTED_STREAMS: Dict[str, str] = {}
+
+
+def select_stream_urls(cameras: List[Dict], mode: str = "prefer") -> List[Dict]:
+    """Probe every camera's candidate URLs and pick the stream to use.
+
+    Candidates are ranked live, unknown, dead (keeping discovery order
+    within each group). A camera keeps the URL selected on the previous
+    refresh while it is live or unknown, and until it has been found dead
+    STREAM_SWITCH_FAILURES times in a row, so a flaky probe does not
+    rewrite the config (and restart the gateway). A live URL from a
+    preferred source (earlier in the candidates, see source_priority)
+    always takes over, e.g. once go2rtc answers again. In "prefer" mode a
+    camera whose candidates are all dead keeps its current URL; in "drop"
+    mode it is left out.
+    """
+    urls = [url for camera in cameras for url in camera.get("candidates") or []]
+    if not urls:
+        return cameras
+    results = STREAM_PROBER.check(urls)
+    rank = {True: 0, None: 1, False: 2}
+
+    selected = []
+    for camera in cameras:
+        candidates = camera.get("candidates") or []
+        if not candidates:
+            selected.append(camera)
+            continue
+        best = min(candidates, key=lambda url: rank[results[url][0]])
+        current = _SELECTED_STREAMS.pop(camera["entity_id"], None)
+        current = current if current in candidates else None
+        sources = camera.get("candidate_sources") or {}
+        source_order = list(dict.fromkeys(sources.get(url) for url in candidates))
+        if (current and results[best][0] is True and
+                source_order.index(sources.get(best)) < source_order.index(sources.get(current))):
+            current = None  # a preferred source is live: no reason to stick
+        kept = False
+        if current:
+            alive, status = results[current]
+            if alive is not False:
+                best = current  # live or unknown is no worse than a switch
+            elif STREAM_PROBER.failures(current) < STREAM_SWITCH_FAILURES:
+                print(f"[WARN] {redact_url(current)} for {camera['name']} failed "
+                      f"{STREAM_PROBER.failures(current)} of {STREAM_SWITCH_FAILURES} "
+                      f"health checks in a row ({status}), keeping it")
+                best = current
+                kept = True
+            camera["stream_url"] = current
+
+        alive, status = results[best]
+        if alive is False and not kept:
+            if mode == "drop":
+                print(f"[WARN] Dropping {camera['name']}: no live stream ({status})")
+                METRICS.count("cameras_dropped_dead")
+                continue
+            print(f"[WARN] No live stream for {camera['name']} ({status}), keeping "
+                  f"{redact_url(camera['stream_url'])}")
+        elif best != camera["stream_url"]:
+            print(f"[INFO] Using {redact_url(best)} for {camera['name']} "
+                  f"({redact_url(camera['stream_url'])}: {results[camera['stream_url']][1]})")
+            camera["stream_url"] = best
+        _SELECTED_STREAMS[camera["entity_id"]] = camera["stream_url"]
+        selected.append(camera)
+    return selected
+
+
+# =============================================================================
+# go2rtc restream (one upstream connection per camera)
+# =============================================================================
+
+GO2RTC_RTSP_PORT = 8554
+# HA's own go2rtc serves its API on 11984 and RTSP on 18554
+GO2RTC_RTSP_PORTS = {11984: 18554}
+GO2RTC_RESTREAM_PREFIX = "monocle_"
+
+# go2rtc API the restreams were registered with (used by the prewarmer)
+_GO2RTC_RESTREAM_API = None
+
+
+def go2rtc_stream_name(entity_id: str) -> str:
+    """Name of the go2rtc stream registered for a camera entity."""
+    slug = re.sub(r"[^a-z0-9_]+", "_", entity_id.split(".", 1)[-1].lower()).strip("_")
+    return f"{GO2RTC_RESTREAM_PREFIX}{slug}"
+
+
+def restream_via_go2rtc(cameras: List[Dict]) -> List[Dict]:
+    """Point cameras at go2rtc restreams instead of their sources.
+
+    Every camera's stream is registered in go2rtc (``monocle_<entity>``;
+    cameras found through go2rtc keep their own stream) and Monocle gets
+    rtsp://<go2rtc host>:8554/<stream>, so go2rtc holds one connection to
+    the camera however many viewers there are. Streams of cameras that
+    are gone are removed. Needs go2rtc's own API reachable from the add-on
+    (the supervisor proxy is read-only); otherwise, or if a stream cannot
+    be registered, cameras keep their direct URLs.
+    """
+    global _GO2RTC_RESTREAM_API
+    # The supervisor proxy only reads streams, go2rtc's own API is needed
+    endpoints = [url for url in GO2RTC_ENDPOINTS if "supervisor" not in url]
+    if _GO2RTC_PREFERRED in endpoints:
+        endpoints.remove(_GO2RTC_PREFERRED)
+        endpoints.insert(0, _GO2RTC_PREFERRED)
+    api_url = existing = None
+    for url in endpoints:
+        if get_breaker(f"go2rtc:{url}").allow():
+            existing = probe_go2rtc_endpoint(url)
+            if existing is not None:
+                api_url = url
+                break
+    if api_url is None:
+        print("[WARN] go2rtc restream: no go2rtc API reachable, using direct stream URLs")
+        return cameras
+    _GO2RTC_RESTREAM_API = api_url
+    parts = urlsplit(api_url)
+    host = parts.hostname
+    rtsp_port = GO2RTC_RTSP_PORTS.get(parts.port, GO2RTC_RTSP_PORT)
+    session = get_session("go2rtc")
+
+    def producer_urls(info) -> List[str]:
+        producers = info.get("producers") if isinstance(info, dict) else None
+        return [p.get("url") for p in producers or [] if isinstance(p, dict)]
+
+    wanted = set()
+    for camera in cameras:
+        source_url = camera.get("stream_url")
+        if not source_url:
+            continue
+        name = camera.get("go2rtc_stream")
+        if not name or source_url not in producer_urls(existing.get(name)):
+            name = go2rtc_stream_name(camera["entity_id"])
+            wanted.add(name)
+            if source_url not in producer_urls(existing.get(name)):
+                # PUT creates a stream, PATCH changes the source of an existing one
+                method = "PATCH" if name in existing else "PUT"
+                try:
+                    response = session.request(method, api_url, params={"name": name, "src": source_url},
+                                               timeout=5)
+                    response.raise_for_status()
+                    METRICS.count("go2rtc_streams_registered")
+                    print(f"[INFO] Registered go2rtc stream {name} for {camera['name']}")
+                except Exception as e:
+                    print(f"[WARN] Could not register go2rtc stream for {camera['name']}: {e}")
+                    continue
+        camera["source_url"] = source_url
+        camera["stream_url"] = f"rtsp://{host}:{rtsp_port}/{name}"
+
+    for name in existing:
+        if name.startswith(GO2RTC_RESTREAM_PREFIX) and name not in wanted:
+            try:
+                session.delete(api_url, params={"src": name}, timeout=5).raise_for_status()
+                METRICS.count("go2rtc_streams_removed")
+                print(f"[INFO] Removed go2rtc stream {name}")
+            except Exception as e:
+                print(f"[DEBUG] Could not remove go2rtc stream {name}: {e}")
+    return cameras
+
+
+# =============================================================================
+# Stream pre-warming (keepalive consumers on go2rtc restreams)
+# =============================================================================
+
+PREWARM_REPORT_PATH = os.path.join(DATA_PATH, "stream_prewarm.json")
+PREWARM_USER_AGENT = "Auto-Monocle-Prewarm"
+PREWARM_TIMEOUT = 10           # connect/read timeout and first-frame deadline
+PREWARM_KEEPALIVE = 25         # seconds between GET_PARAMETER keepalives
+PREWARM_RETRY_MAX = 60         # longest wait between reconnects
+PREWARM_POLL_INTERVAL = 30     # how often go2rtc consumers are checked for idle release
+
+H264_KEYFRAME_NALS = {5, 7}                # IDR, SPS
+H265_KEYFRAME_NALS = set(range(16, 22)) | {32, 33}  # IRAP, VPS, SPS
+
+
+def parse_sdp_tracks(sdp: str) -> List[Tuple[str, str, str]]:
+    """(media, control, codec) for each video/audio track of an SDP."""
+    tracks = []
+    for block in re.split(r"\r?\nm=", "\n" + sdp)[1:]:
+        media = block.split(None, 1)[0]
+        if media not in ("video", "audio"):
+            continue
+        control = re.search(r"^a=control:(\S+)", block, re.M)
+        codec = re.search(r"^a=rtpmap:\d+ ([^/\s]+)", block, re.M)
+        tracks.append((media, control.group(1) if control else "",
+                       codec.group(1).upper() if codec else ""))
+    return tracks
+
+
+def is_keyframe(rtp: bytes, codec: str) -> bool:
+    """Whether an RTP packet starts an H.264/H.265 keyframe (or carries its parameter sets)."""
+    if len(rtp) < 13 or rtp[0] >> 6 != 2:
+        return False
+    offset = 12 + 4 * (rtp[0] & 0x0F)
+    if rtp[0] & 0x10 and len(rtp) >= offset + 4:  # header extension
+        offset += 4 + 4 * struct.unpack(">H", rtp[offset + 2:offset + 4])[0]
+    payload = rtp[offset:]
+    if codec == "H265":
+        if len(payload) < 3:
+            return False
+        nal = (payload[0] >> 1) & 0x3F
+        if nal == 48:  # aggregation packet: first NAL after its 2-byte size
+            nal = (payload[4] >> 1) & 0x3F if len(payload) > 4 else -1
+        elif nal == 49:  # fragmentation unit: only its start counts
+            nal = payload[2] & 0x3F if payload[2] & 0x80 else -1
+        return nal in H265_KEYFRAME_NALS
+    if not payload:
+        return False
+    nal = payload[0] & 0x1F
+    if nal == 24:  # STAP-A
+        nal = payload[3] & 0x1F if len(payload) > 3 else -1
+    elif nal == 28:  # FU-A
+        nal = payload[1] & 0x1F if len(payload) > 1 and payload[1] & 0x80 else -1
+    return nal in H264_KEYFRAME_NALS
+
+
+class RTSPConsumer:
+    """Minimal RTSP client that plays a stream over TCP and discards it.
+
+    Used to hold a go2rtc producer open and to time the first keyframe.
+    Only RTSP framing and RTP headers are parsed.
+    """
+
+    def __init__(self, url: str, timeout: float = PREWARM_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.session = ""
+        self.cseq = 0
+        self.video_channel = None
+        self.codec = ""
+        self.local_addr = ""
+
+    def _request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None):
+        self.cseq += 1
+        headers = dict(headers or {})
+        if self.session:
+            headers["Session"] = self.session
+        status, response_headers, body = rtsp_request(self.sock, self.reader, method, url, self.cseq,
+                                                      headers, user_agent=PREWARM_USER_AGENT)
+        if status != 200:
+            raise ValueError(f"{method} {status}")
+        return response_headers, body
+
+    def play(self):
+        """Connect, DESCRIBE, SETUP every track (interleaved) and PLAY."""
+        self.sock, request_url = rtsp_connect(self.url, self.timeout)
+        self.reader = self.sock.makefile("rb")
+        self.local_addr = "%s:%s" % self.sock.getsockname()[:2]
+        headers, body = self._request("DESCRIBE", request_url)
+        base = headers.get("content-base") or headers.get("content-location") or request_url
+        tracks = parse_sdp_tracks(body.decode("latin-1"))
+        if not tracks:
+            raise ValueError("no tracks")
+        for channel, (media, control, codec) in enumerate(tracks):
+            if control.startswith("rtsp"):
+                track_url = control
+            elif control in ("", "*"):
+                track_url = base
+            else:
+                track_url = f"{base.rstrip('/')}/{control}"
+            headers, _ = self._request("SETUP", track_url, {
+                "Transport": f"RTP/AVP/TCP;unicast;interleaved={2 * channel}-{2 * channel + 1}"})
+            self.session = headers.get("session", "").split(";")[0]
+            if media == "video" and self.video_channel is None:
+                self.video_channel = 2 * channel
+                self.codec = codec
+        self._request("PLAY", request_url)
+
+    def read_packet(self) -> Tuple[Optional[int], bytes]:
+        """Next interleaved packet as (channel, data); (None, b"") for an RTSP response."""
+        marker = self.reader.read(1)
+        if not marker:
+            raise ConnectionError("stream closed")
+        if marker == b"$":
+            header = self.reader.read(3)
+            if len(header) < 3:
+                raise ConnectionError("stream closed")
+            return header[0], self.reader.read(struct.unpack(">H", header[1:])[0])
+        # Response to a keepalive: the rest of its status line, headers and body
+        self.reader.readline(1024)
+        length = 0
+        while True:
+            line = self.reader.readline(8192)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length" and value.strip().isdigit():
+                length = int(value.strip())
+        if length:
+            self.reader.read(length)
+        return None, b""
+
+    def wait_for_keyframe(self, deadline: float) -> bool:
+        """Read until the first video keyframe (True) or the deadline passes."""
+        while time.monotonic() < deadline:
+            channel, data = self.read_packet()
+            if channel is not None and channel == self.video_channel and is_keyframe(data, self.codec):
+                return True
+        return False
+
+    def keepalive(self):
+        """Send GET_PARAMETER without waiting; the response is skipped by read_packet()."""
+        self.cseq += 1
+        request = (f"GET_PARAMETER {self.url} RTSP/1.0\r\nCSeq: {self.cseq}\r\n"
+                   f"User-Agent: {PREWARM_USER_AGENT}\r\nSession: {self.session}\r\n\r\n")
+        self.sock.sendall(request.encode())
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+
+def measure_first_frame(url: str, timeout: float = PREWARM_TIMEOUT) -> Optional[float]:
+    """Seconds from connecting to the first keyframe, None if none arrived in time."""
+    consumer = RTSPConsumer(url, timeout)
+    started = time.monotonic()
+    try:
+        consumer.play()
+        if consumer.wait_for_keyframe(started + timeout):
+            return time.monotonic() - started
+    except (OSError, ValueError):
+        pass
+    finally:
+        consumer.close()
+    return None
+
+
+class WarmStream(threading.Thread):
+    """Keeps one stream playing until stopped, reconnecting on failure.
+
+    The first keyframe of each connection gives the cold time to first
+    frame; once the stream is warm, one extra short connection measures
+    what a new viewer (Monocle) gets.
+    """
+
+    def __init__(self, name: str, url: str, on_measured: Callable[["WarmStream"], None]):
+        super().__init__(name=f"prewarm-{name}", daemon=True)
+        self.camera = name
+        self.url = url
+        self.on_measured = on_measured
+        self.state = "connecting"
+        self.status = ""
+        self.cold_ttff = None
+        self.warm_ttff = None
+        self.warm_since = None
+        self.reconnects = 0
+        self.local_addr = ""
+        self._consumer = None
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+        consumer = self._consumer
+        if consumer is not None:
+            consumer.close()
+
+    def run(self):
+        retry = 5
+        while not self._stopping.is_set():
+            self._consumer = RTSPConsumer(self.url)
+            started = time.monotonic()
+            try:
+                self._consumer.play()
+                self.local_addr = self._consumer.local_addr
+                if not self._consumer.wait_for_keyframe(started + PREWARM_TIMEOUT):
+                    raise ValueError("no keyframe")
+                self.cold_ttff = time.monotonic() - started
+                self.state, self.status, self.warm_since = "warm", "ok", time.time()
+                if self.warm_ttff is None:
+                    self.warm_ttff = measure_first_frame(self.url)
+                self.on_measured(self)
+                retry = 5
+                last_keepalive = time.monotonic()
+                while not self._stopping.is_set():
+                    self._consumer.read_packet()
+                    if time.monotonic() - last_keepalive >= PREWARM_KEEPALIVE:
+                        self._consumer.keepalive()
+                        last_keepalive = time.monotonic()
+            except (OSError, ValueError) as e:
+                if self._stopping.is_set():
                     break
-            if not match:
+                self.state, self.status = "retrying", str(e) or type(e).__name__
+                self.reconnects += 1
+                print(f"[WARN] Pre-warm {self.camera}: {self.status}, retrying in {retry}s")
+            finally:
+                self._consumer.close()
+            self._stopping.wait(retry)
+            retry = min(retry * 2, PREWARM_RETRY_MAX)
+        self.state = "released"
+
+
+def prewarm_selectors(options: Dict) -> Set[str]:
+    return {normalize_name(item) for item in options.get("prewarm") or [] if item}
+
+
+def camera_prewarm_keys(camera: Dict, entities: Dict[str, Dict]) -> Set[str]:
+    """Names a prewarm entry can use for a camera: name, entity ID, MAC and HA labels."""
+    entity_id = camera.get("entity_id", "")
+    entry = entities.get(entity_id) or {}
+    keys = [camera.get("name", ""), entity_id, entity_id.split(".", 1)[-1], camera.get("mac", "")]
+    keys += entry.get("labels") or []
+    return {normalize_name(key) for key in keys if key}
+
+
+class StreamPrewarmer:
+    """Keeps selected cameras' go2rtc restreams open between views.
+
+    Only restreamed cameras can be pre-warmed: the keepalive consumer then
+    shares go2rtc's single upstream connection with Monocle, so the RTSPS
+    handshake and NVR session setup are already done when Alexa asks.
+    With an idle timeout, a stream nobody else watched for that long is
+    released, and warmed again the next time it is viewed. Per-camera
+    state and times to first frame are written to PREWARM_REPORT_PATH.
+    Active only while the discovery service runs (start()/stop()).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.idle_timeout = 0
+        self._streams = {}   # restream URL -> WarmStream
+        self._targets = {}   # restream URL -> camera name
+        self._last_used = {}  # restream URL -> time of last other consumer
+        self._released = set()
+        self._warned = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._monitor = None
+
+    def start(self, options: Dict):
+        self.enabled = bool(prewarm_selectors(options))
+        if not self.enabled:
+            return
+        self.idle_timeout = int(options.get("prewarm_idle_timeout", 0) or 0) * 60
+        self._stop.clear()
+        self._monitor = threading.Thread(target=self._monitor_loop, name="prewarm-monitor", daemon=True)
+        self._monitor.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            streams, self._streams = list(self._streams.values()), {}
+        for stream in streams:
+            stream.stop()
+
+    def update(self, cameras: List[Dict], options: Dict):
+        """Warm the selected cameras of a discovery result, release the rest."""
+        if not self.enabled:
+            return
+        selectors = prewarm_selectors(options)
+        entities = REGISTRY.entities_by_id() or {}
+        targets = {}
+        for camera in cameras:
+            if not camera.get("stream_url") or not selectors & camera_prewarm_keys(camera, entities):
+                continue
+            if not camera.get("source_url"):
+                if camera["name"] not in self._warned:
+                    print(f"[WARN] Pre-warm {camera['name']}: needs go2rtc_restream, skipped")
+                    self._warned.add(camera["name"])
+                continue
+            targets[camera["stream_url"]] = camera["name"]
+        now = time.time()
+        with self._lock:
+            self._targets = targets
+            for url in list(self._streams):
+                if url not in targets:
+                    self._streams.pop(url).stop()
+            self._released &= set(targets)
+            for url, name in targets.items():
+                self._last_used.setdefault(url, now)
+                if url not in self._streams and url not in self._released:
+                    self._warm(url, name)
+        self.write_report()
+
+    def _warm(self, url: str, name: str):
+        stream = WarmStream(name, url, self._measured)
+        self._streams[url] = stream
+        stream.start()
+
+    def _measured(self, stream: WarmStream):
+        warm = f"{stream.warm_ttff * 1000:.0f} ms" if stream.warm_ttff is not None else "n/a"
+        print(f"[INFO] Pre-warm {stream.camera}: first frame after "
+              f"{stream.cold_ttff * 1000:.0f} ms cold, {warm} warm")
+        self.write_report()
+
+    def _viewers(self) -> Optional[Dict[str, int]]:
+        """Consumers per go2rtc stream, not counting our own keepalives."""
+        if not _GO2RTC_RESTREAM_API:
+            return None
+        streams = probe_go2rtc_endpoint(_GO2RTC_RESTREAM_API)
+        if streams is None:
+            return None
+        with self._lock:
+            own = {stream.local_addr for stream in self._streams.values()}
+        viewers = {}
+        for name, info in streams.items():
+            consumers = info.get("consumers") if isinstance(info, dict) else None
+            viewers[name] = sum(1 for c in consumers or [] if isinstance(c, dict)
+                                and c.get("user_agent") != PREWARM_USER_AGENT
+                                and c.get("remote_addr") not in own)
+        return viewers
+
+    def _monitor_loop(self):
+        while not self._stop.wait(PREWARM_POLL_INTERVAL):
+            if not self.idle_timeout:
                 continue
+            viewers = self._viewers()
+            if viewers is None:
+                continue
+            now = time.time()
+            with self._lock:
+                for url, name in self._targets.items():
+                    if viewers.get(urlsplit(url).path.lstrip("/"), 0):
+                        self._last_used[url] = now
+                        if url in self._released:
+                            print(f"[INFO] Pre-warm {name}: viewed, warming again")
+                            self._released.discard(url)
+                            self._warm(url, name)
+                    elif url in self._streams and now - self._last_used[url] > self.idle_timeout:
+                        print(f"[INFO] Pre-warm {name}: idle for "
+                              f"{self.idle_timeout // 60} min, released")
+                        self._streams.pop(url).stop()
+                        self._released.add(url)
+            self.write_report()
 
-        # Store with various name keys for matching
-        entity_lookup[entity_id] = state
-        entity_lookup[friendly_name.lower()] = state
-        entity_lookup[entity_id.replace("camera.", "")] = state
+    def report(self) -> Dict[str, Dict]:
+        def ms(seconds):
+            return round(seconds * 1000) if seconds is not None else None
 
-        # Initialize camera info
-        discovered[entity_id] = {
-            "entity_id": entity_id,
-            "name": friendly_name or entity_id.replace("camera.", "").replace("_", " ").title(),
-            "stream_url": None
-        }
+        with self._lock:
+            report = {}
+            for url, name in sorted(self._targets.items(), key=lambda item: item[1]):
+                stream = self._streams.get(url)
+                entry = {"stream": redact_url(url), "last_used": self._last_used.get(url)}
+                if stream is None:
+                    entry["state"] = "released"
+                else:
+                    entry.update(state=stream.state, status=stream.status,
+                                 warm_since=stream.warm_since, reconnects=stream.reconnects,
+                                 cold_ttff_ms=ms(stream.cold_ttff),
+                                 warm_ttff_ms=ms(stream.warm_ttff))
+                report[name] = entry
+        return report
 
-    # Method 1: Try go2rtc
-    print("[INFO] Checking go2rtc streams...")
-    go2rtc_streams = get_go2rtc_streams()
-    for stream_name, rtsp_url in go2rtc_streams.items():
-        # Try to match stream name to camera entity
-        for entity_id, camera in discovered.items():
-            if (stream_name.lower() in entity_id.lower() or
-                stream_name.lower() in camera["name"].lower() or
-                entity_id.replace("camera.", "") == stream_name):
-                camera["stream_url"] = rtsp_url
-                print(f"[INFO] Matched go2rtc stream '{stream_name}' to {entity_id}")
-                break
+    def write_report(self, path: Optional[str] = None):
+        path = path or PREWARM_REPORT_PATH
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"updated": time.time(), "cameras": self.report()}, f, indent=2)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[DEBUG] Could not write {path}: {e}")
 
-    # Method 2: Try UniFi Protect (queries API for rtspAlias)
-    print("[INFO] Checking UniFi Protect integration...")
-    unifi_cameras = get_unifi_rtsp_urls(stream_quality)
-    for unifi_key, cam_data in unifi_cameras.items():
-        cam_name = cam_data["name"]
-        rtsp_url = cam_data["url"]
-
-        # Try to match to existing HA camera entity
-        matched = False
-        for entity_id, camera in discovered.items():
-            if camera["stream_url"]:
-                continue
-            # Match by name similarity
-            entity_name = camera["name"].lower()
-            unifi_name = cam_name.lower()
-            if (unifi_name in entity_name or entity_name in unifi_name or
-                unifi_name.replace(" ", "_") in entity_id.lower()):
-                camera["stream_url"] = rtsp_url
-                print(f"[INFO] Matched UniFi '{cam_name}' to {entity_id}")
-                matched = True
-                break
 
-        # If no match found, add as new camera
-        if not matched:
-            new_entity_id = f"camera.unifi_{cam_name.lower().replace(' ', '_')}"
-            discovered[new_entity_id] = {
-                "entity_id": new_entity_id,
-                "name": cam_name,
-                "stream_url": rtsp_url
-            }
-            print(f"[INFO] Added UniFi camera: {cam_name}")
+PREWARMER = StreamPrewarmer()
+
+
+# =============================================================================
+# Discovery sources (plugins)
+# =============================================================================
+
+class CameraSource(abc.ABC):
+    """A discovery source plugin.
+
+    candidates() is a generator that yields camera candidates as soon as
+    they are found, so matching can start while slower sources are still
+    running. A candidate is a JSON-serializable dict:
+
+        id         unique within the source (stream name, entity ID, ...)
+        name       name used to match the candidate to a camera entity
+        urls       stream URLs, best first
+        keys       optional exact match keys ("mac:<MAC>", "entity:<id>", ...)
+        info       optional fields copied onto the camera (e.g. "mac")
+        entity_id  only for sources that define cameras (HA entities)
+
+    The yielded candidates are also the source's cached result in daemon
+    mode and in the warm start snapshot. Subclasses must implement
+    candidates(); register new sources with register_source().
+    """
+
+    name = ""
+    deadline = 30            # seconds from the start of the run
+    priority = 100           # lower: URLs are tried first when sources overlap
+    defines_cameras = False  # candidates are HA camera entities (filtered, matched against)
+    adds_unmatched = False   # unmatched candidates become cameras of their own
+
+    @abc.abstractmethod
+    def candidates(self, settings: Dict) -> Iterator[Dict]:
+        """Yield this source's camera candidates (see the class docstring)."""
+
+
+class Go2rtcSource(CameraSource):
+    """Method 1: go2rtc streams, matched to entities by stream name."""
+
+    name = SOURCE_GO2RTC
+    deadline = 8
+    priority = 10
+
+    def candidates(self, settings: Dict) -> Iterator[Dict]:
+        print("[INFO] Checking go2rtc streams...")
+        for stream_name, url in get_go2rtc_streams().items():
+            yield {"id": stream_name, "name": stream_name, "urls": [url],
+                   "info": {"go2rtc_stream": stream_name}}
+
+
+class UniFiSource(CameraSource):
+    """Method 2: UniFi Protect RTSP(S) streams, matched by MAC or name.
+
+    Yields once all NVRs have answered (or hit their deadline), since the
+    bandwidth budget is shared by the cameras of every NVR.
+    """
+
+    name = SOURCE_UNIFI
+    deadline = 45
+    priority = 20
+    adds_unmatched = True
+
+    def candidates(self, settings: Dict) -> Iterator[Dict]:
+        # Queries API for rtspAlias
+        print("[INFO] Checking UniFi Protect integration...")
+        cameras = get_unifi_rtsp_urls(settings.get("stream_quality", "high"),
+                                      settings.get("channel_policy"))
+        for key in sorted(cameras):
+            cam = cameras[key]
+            keys = []
+            if cam.get("mac"):
+                keys.append(f"mac:{cam['mac'].upper().replace(':', '')}")
+            if cam.get("entity_id"):
+                keys.append(f"entity:{cam['entity_id']}")
+            yield {"id": key, "name": cam["name"], "urls": cam.get("candidates") or [cam["url"]],
+                   "keys": keys,
+                   "info": {field: cam[field] for field in ("mac", "channel", "nvr") if cam.get(field)}}
+
+
+class EntitySource(CameraSource):
+    """Method 3: HA camera entities, with their stream_source-like attribute."""
 
-    # Method 3: Check entity attributes
-    print("[INFO] Checking camera entity attributes...")
-    for entity_id, camera in discovered.items():
-        if camera["stream_url"]:
-            continue  # Already has URL
+    name = SOURCE_ENTITIES
+    deadline = 35  # HA_TEMPLATE_TIMEOUT + HA_STATES_TIMEOUT, plus a margin
+    priority = 30
+    defines_cameras = True
 
-        state = entity_lookup.get(entity_id)
-        if state:
+    def candidates(self, settings: Dict) -> Iterator[Dict]:
+        camera_entities = get_camera_entities()
+        print(f"[INFO] Found {len(camera_entities)} camera entities in HA")
+        for state in camera_entities:
+            entity_id = state.get("entity_id", "")
+            if not entity_id:
+                continue
+            friendly_name = state.get("attributes", {}).get("friendly_name", "")
             url = get_stream_url_from_attributes(state)
-            if url:
-                camera["stream_url"] = url
-                print(f"[INFO] Found stream_source for {entity_id}")
+            yield {"id": entity_id, "entity_id": entity_id,
+                   "name": friendly_name or entity_id.replace("camera.", "").replace("_", " ").title(),
+                   "urls": [url] if url else []}
+
+
+# Source name -> plugin, in registration order
+SOURCES: Dict[str, CameraSource] = {}
+
+
+def register_source(source: CameraSource):
+    """Add (or replace) a discovery source.
+
+    Raises:
+        TypeError: If ``source`` is not a CameraSource instance
+        ValueError: If the source has no name
+    """
+    if not isinstance(source, CameraSource):
+        raise TypeError(f"not a CameraSource: {source!r}")
+    if not source.name:
+        raise ValueError(f"{type(source).__name__} has no name")
+    SOURCES[source.name] = source
+
+
+register_source(EntitySource())
+register_source(Go2rtcSource())
+register_source(UniFiSource())
+
+
+def valid_source_data(name: str, data) -> bool:
+    """Whether a cached source result is a list of candidates of that source."""
+    return isinstance(data, list) and all(
+        isinstance(c, dict) and c.get("source") == name and "id" in c for c in data)
+
+
+# Query parameters that do not change which stream a URL plays
+STREAM_IDENTITY_IGNORED_PARAMS = {"enablesrtp"}
+
+
+def stream_identity(url: str) -> str:
+    """Canonical identity of a stream URL: scheme://host:port/path[?query].
+
+    Credentials, default ports, trailing slashes and query parameter order
+    do not count. UniFi Protect serves each alias over RTSPS (7441) and
+    plain RTSP (7447); both count as the RTSPS stream.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.rsplit("@", 1)[-1].lower()
+    try:
+        host, port = parts.hostname or "", parts.port or RTSP_DEFAULT_PORTS.get(scheme)
+    except ValueError:
+        host, port = netloc, None
+    if port in (UNIFI_RTSPS_PORT, UNIFI_RTSP_INSECURE_PORT):
+        scheme, port = "rtsps", UNIFI_RTSPS_PORT
+    query = "&".join(sorted(param for param in parts.query.split("&") if param and
+                            param.split("=", 1)[0].lower() not in STREAM_IDENTITY_IGNORED_PARAMS))
+    identity = f"{scheme}://{host}{f':{port}' if port else ''}{parts.path.rstrip('/') or '/'}"
+    return f"{identity}?{query}" if query else identity
+
+
+def stream_transport(url: str) -> Tuple[str, Optional[int]]:
+    """Scheme and port (default port filled in) a stream URL is played over."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    try:
+        return scheme, parts.port or RTSP_DEFAULT_PORTS.get(scheme)
+    except ValueError:
+        return scheme, None
+
+
+class CameraResolver:
+    """Merges candidates from all sources into cameras, as they arrive.
+
+    Candidates from camera-defining sources (HA entities) become cameras
+    (after camera_filters) and are indexed in a CameraMatcher. Other
+    candidates are matched to them: all at once, best scores first, when
+    the last camera-defining source is done, and one by one after that.
+    Each camera takes at most one candidate per source. Unmatched
+    candidates of adds_unmatched sources become cameras of their own.
+    finish() collapses cameras and URLs that are the same stream (see
+    _deduplicate) and orders every camera's URLs by source preference:
+    ``source_priority`` first, then the sources' own priorities.
+    """
+
+    def __init__(self, filters: Optional[List[str]] = None,
+                 source_priority: Optional[List[str]] = None):
+        self.camera_filter = compile_camera_filters(filters)
+        preferred = [name for name in source_priority or [] if name in SOURCES]
+        self.rank = {name: (preferred.index(name) if name in preferred else len(preferred), source.priority)
+                     for name, source in SOURCES.items()}
+        self.entities_by_id = REGISTRY.entities_by_id() or {}
+        self.devices_by_id = REGISTRY.devices_by_id() or {}
+        self.matcher = CameraMatcher()
+        self.cameras = {}    # entity_id -> camera
+        self.attached = {}   # entity_id -> [candidate]
+        self.pending = {}    # source -> {candidate id: candidate}
+        self.taken = {}      # source -> {entity_id}
+        self.added = {}      # entity_id -> source it was added from (unmatched candidate)
+        self.macs = {}       # entity_id -> MACs of its HA device
+        self.open_definers = {name for name, source in SOURCES.items() if source.defines_cameras}
+
+    def _attach(self, entity_id: str, candidate: Dict):
+        self.attached.setdefault(entity_id, []).append(candidate)
+        self.taken.setdefault(candidate["source"], set()).add(entity_id)
+
+    def _add_camera(self, candidate: Dict):
+        entity_id = candidate["entity_id"]
+        if not self.camera_filter(entity_id, candidate["name"]) or entity_id in self.cameras:
+            return
+        self.cameras[entity_id] = {"entity_id": entity_id, "name": candidate["name"],
+                                   "stream_url": None, "candidates": []}
+        self._attach(entity_id, candidate)
+        # Exact keys from the registries: device id and the device's MACs
+        keys = []
+        device_id = (self.entities_by_id.get(entity_id) or {}).get("device_id")
+        if device_id:
+            keys.append(f"device:{device_id}")
+            self.macs[entity_id] = device_macs(self.devices_by_id.get(device_id) or {})
+            keys.extend(f"mac:{mac}" for mac in self.macs[entity_id])
+        self.matcher.add(entity_id, candidate["name"], tuple(keys))
+
+    def _new_entity_id(self, name: str, cid: str, camera_name: str) -> str:
+        """Camera id for an unmatched candidate, unique among the cameras.
+
+        Named after the camera; on a collision (same name on two consoles)
+        the candidate's own id is used instead, so neither camera is lost.
+        """
+        entity_id = f"camera.{name}_{camera_name.lower().replace(' ', '_')}"
+        if entity_id not in self.cameras:
+            return entity_id
+        slug = re.sub(r"[^a-z0-9]+", "_", cid.split(".", 1)[-1].lower()).strip("_")
+        unique = f"camera.{name}_{slug}"
+        suffix = 2
+        while unique in self.cameras:
+            unique = f"camera.{name}_{slug}_{suffix}"
+            suffix += 1
+        print(f"[WARN] {entity_id} already exists, adding {name} '{camera_name}' as {unique}")
+        return unique
+
+    def _match(self, name: str):
+        items = self.pending.pop(name, {})
+        if not items:
+            return
+        taken = self.taken.setdefault(name, set())
+        matches = self.matcher.assign(
+            {cid: {"name": c["name"], "keys": c.get("keys", ())} for cid, c in items.items()},
+            eligible=lambda entity_id: entity_id not in taken)
+        for cid in sorted(items):
+            candidate = items[cid]
+            entity_id = matches.get(cid)
+            if entity_id:
+                self._attach(entity_id, candidate)
+                print(f"[INFO] Matched {name} '{candidate['name']}' to {entity_id}")
+            elif SOURCES[name].adds_unmatched and candidate.get("urls"):
+                new_entity_id = self._new_entity_id(name, cid, candidate["name"])
+                self.cameras[new_entity_id] = {"entity_id": new_entity_id, "name": candidate["name"],
+                                               "stream_url": None, "candidates": []}
+                self._attach(new_entity_id, candidate)
+                self.added[new_entity_id] = name
+                print(f"[INFO] Added {name} camera: {candidate['name']}")
+
+    def add(self, candidate: Dict):
+        """Take one candidate (its "source" must be a registered source)."""
+        name = candidate["source"]
+        if SOURCES[name].defines_cameras:
+            self._add_camera(candidate)
+            return
+        self.pending.setdefault(name, {})[candidate["id"]] = candidate
+        if not self.open_definers:
+            self._match(name)
+
+    def source_done(self, name: str):
+        """A source has no more candidates; matching starts once every camera is known."""
+        if name in self.open_definers:
+            self.open_definers.discard(name)
+            if not self.open_definers:
+                for pending in sorted(self.pending, key=self.rank.get):
+                    self._match(pending)
+
+    def _identities(self, entity_id: str) -> Tuple[Set[str], Set[str]]:
+        """(stream identities, MACs) of a camera."""
+        streams, macs = set(), set(self.macs.get(entity_id, ()))
+        for candidate in self.attached.get(entity_id, []):
+            mac = (candidate.get("info") or {}).get("mac")
+            if mac:
+                macs.add(mac.upper().replace(":", ""))
+            streams.update(stream_identity(url) for url in candidate.get("urls") or [])
+        return streams, macs
+
+    def _deduplicate(self):
+        """Collapse cameras that are the same stream or device into one.
+
+        Cameras sharing a stream identity are merged. Cameras sharing a MAC
+        are merged too, unless that would join two HA entities that both
+        have streams (a device can have several cameras, e.g. a doorbell's
+        package camera). HA entities are kept over cameras added for
+        unmatched candidates, then the camera whose best URL comes from the
+        most preferred source, then the first discovered; it takes over the
+        other cameras' candidates.
+        """
+        parent = {entity_id: entity_id for entity_id in self.cameras}  # union-find
+
+        def find(entity_id):
+            while parent[entity_id] != entity_id:
+                parent[entity_id] = parent[parent[entity_id]]
+                entity_id = parent[entity_id]
+            return entity_id
+
+        identities = {}
+        owner = {}    # stream identity -> first camera with it
+        by_mac = {}   # MAC -> cameras with it
+        for entity_id in self.cameras:
+            streams, macs = self._identities(entity_id)
+            identities[entity_id] = streams | {f"mac:{mac}" for mac in macs}
+            for identity in streams:
+                if identity in owner:
+                    parent[find(entity_id)] = find(owner[identity])
+                else:
+                    owner[identity] = entity_id
+            for mac in macs:
+                by_mac.setdefault(mac, []).append(entity_id)
+        for members in by_mac.values():
+            with_streams = [e for e in members if e not in self.added
+                            and any(not i.startswith("mac:") for i in identities[e])]
+            if len(with_streams) > 1:
+                continue
+            target = with_streams[0] if with_streams else members[0]
+            for entity_id in members:
+                parent[find(entity_id)] = find(target)
+
+        groups = {}
+        for order, entity_id in enumerate(self.cameras):
+            groups.setdefault(find(entity_id), []).append((order, entity_id))
+
+        def preference(item):
+            order, entity_id = item
+            ranks = [self.rank[c["source"]] for c in self.attached.get(entity_id, []) if c.get("urls")]
+            return entity_id in self.added, min(ranks, default=(len(SOURCES), 0)), order
+
+        for members in groups.values():
+            if len(members) < 2:
+                continue
+            keep = min(members, key=preference)[1]
+            for _, entity_id in members:
+                if entity_id == keep:
+                    continue
+                shared = sorted(identities[entity_id] & identities[keep]) or ["shared stream"]
+                print(f"[INFO] Removed duplicate camera '{self.cameras[entity_id]['name']}' "
+                      f"({entity_id}): same camera as {keep} ({redact_url(shared[0])})")
+                METRICS.count("duplicate_cameras_removed")
+                self.attached.setdefault(keep, []).extend(self.attached.pop(entity_id, []))
+                del self.cameras[entity_id]
+                self.added.pop(entity_id, None)
+
+    def finish(self) -> List[Dict]:
+        """Return the deduplicated cameras, each with its URLs in source preference order."""
+        self.open_definers.clear()
+        for name in sorted(self.pending, key=self.rank.get):
+            self._match(name)
+        self._deduplicate()
+
+        matched = {}
+        for entity_id, camera in self.cameras.items():
+            candidates = sorted(self.attached.get(entity_id, []), key=lambda c: self.rank[c["source"]])
+            # stream identity -> {(scheme, port): URL} kept from earlier (preferred) candidates
+            seen = {}
+            for candidate in candidates:
+                for field, value in (candidate.get("info") or {}).items():
+                    camera.setdefault(field, value)
+                if candidate.get("urls") and self.added.get(entity_id) != candidate["source"]:
+                    matched[candidate["source"]] = matched.get(candidate["source"], 0) + 1
+                # Only exact duplicates (same stream, scheme and port) are dropped, so
+                # alternative transports (e.g. UniFi plain RTSP on 7447) stay as fallbacks
+                urls = []
+                for url in candidate.get("urls") or []:
+                    kept = seen.get(stream_identity(url), {}).get(stream_transport(url))
+                    if kept is not None and kept != url:
+                        print(f"[DEBUG] {camera['name']}: dropped {redact_url(url)} "
+                              f"({candidate['source']}), same stream as {redact_url(kept)}")
+                        METRICS.count("duplicate_urls_removed")
+                        continue
+                    urls.append(url)
+                for url in urls:
+                    seen.setdefault(stream_identity(url), {}).setdefault(stream_transport(url), url)
+                add_stream_candidates(camera, urls, candidate["source"])
+        for name in SOURCES:
+            METRICS.set_matched(name, matched.get(name, 0))
+            if SOURCES[name].adds_unmatched:
+                METRICS.set_matched(f"{name}_unmatched", sum(1 for n in self.added.values() if n == name))
+        return list(self.cameras.values())
+
+
+# =============================================================================
+# Main discovery logic
+# =============================================================================
+
+def fetch_sources(names, settings: Dict) -> Iterator[Tuple[str, Optional[Dict], bool]]:
+    """Run several discovery sources concurrently, yielding as results arrive.
+
+    Yields (source, candidate, True) for every candidate as soon as its
+    source produces it, and (source, None, completed) once per source when
+    it finishes, fails or misses its deadline. Each source's deadline is
+    measured from the start of the run, so total time is bounded by the
+    slowest single source. Failures and missed deadlines count for the
+    source's circuit breaker; sources whose circuit is open are skipped.
+    """
+    events = queue.Queue()
+
+    def run(source: CameraSource):
+        try:
+            with METRICS.phase(f"source:{source.name}", profile=PROFILE_PER_THREAD):
+                for candidate in source.candidates(settings):
+                    candidate["source"] = source.name
+                    events.put((source.name, candidate, None))
+        except Exception as e:
+            events.put((source.name, None, e))
+        else:
+            events.put((source.name, None, None))
+
+    pending = set()
+    for name in names:
+        if get_breaker(name).allow():
+            pending.add(name)
+        else:
+            yield name, None, False
+    if not pending:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="source")
+    started = time.monotonic()
+    try:
+        for name in pending:
+            executor.submit(run, SOURCES[name])
+        while pending:
+            deadline = min(SOURCES[name].deadline for name in pending)
+            try:
+                name, candidate, error = events.get(timeout=max(0, started + deadline - time.monotonic()))
+            except queue.Empty:
+                for name in sorted(pending):
+                    source_deadline = SOURCES[name].deadline
+                    if time.monotonic() - started >= source_deadline:
+                        print(f"[WARN] Discovery source '{name}' missed its {source_deadline}s deadline")
+                        get_breaker(name).record_failure(f"missed {source_deadline}s deadline")
+                        pending.discard(name)
+                        yield name, None, False
+                continue
+            if name not in pending:
+                continue  # already past its deadline
+            if candidate is not None:
+                yield name, candidate, True
+                continue
+            pending.discard(name)
+            breaker = get_breaker(name)
+            if error is None:
+                breaker.record_success()
+            elif isinstance(error, SourceUnavailable):
+                print(f"[WARN] Discovery source '{name}' unavailable: {error}")
+                breaker.record_failure(str(error))
+            else:
+                print(f"[ERROR] Discovery source '{name}' failed: {error}")
+                breaker.record_failure(str(error))
+            yield name, None, error is None
+    finally:
+        # Don't wait for late sources; their HTTP timeouts end them in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+        print(f"[DEBUG] Fetched {', '.join(names)} in {time.monotonic() - started:.2f}s")
+
+
+def discover_cameras(filters: List[str] = None, stream_quality: str = "high",
+                     source_data: Optional[Dict] = None,
+                     refresh: Optional[Set[str]] = None,
+                     channel_policy: Optional[Dict] = None,
+                     source_priority: Optional[List[str]] = None) -> List[Dict]:
+    """
+    Discover cameras from every registered source (see CameraSource):
+    1. go2rtc streams
+    2. UniFi Protect integration
+    3. Camera entity attributes
+
+    Candidates are handed to a CameraResolver as the sources yield them;
+    cameras found by several sources are merged into one.
+
+    Args:
+        filters: List of filter strings to match camera names/entity_ids
+        stream_quality: "high", "medium", "low" or "auto" for UniFi cameras
+        source_data: Candidates per source from a previous run. Missing
+            sources are fetched and stored back, so a long-running caller
+            only re-fetches the sources it has invalidated.
+        refresh: Sources to re-fetch even if present in source_data. If a
+            refresh fails, the previous result is kept (merged with
+            whatever the source yielded before failing).
+        channel_policy: Bandwidth budget and per-camera quality overrides
+            for UniFi cameras (see channel_policy_from_options)
+        source_priority: Source names, most preferred first, deciding
+            which duplicate is kept and the order of a camera's URLs
+    """
+    if source_data is None:
+        source_data = {}
+    settings = {"stream_quality": stream_quality, "channel_policy": channel_policy}
+    resolver = CameraResolver(filters, source_priority)
+    resolve_time = 0.0
+
+    def resolve(method, *args):
+        nonlocal resolve_time
+        started = time.perf_counter()
+        method(*args)
+        resolve_time += time.perf_counter() - started
+
+    wanted = [name for name in SOURCES
+              if name not in source_data or (refresh is not None and name in refresh)]
+    for name in SOURCES:
+        if name not in wanted:
+            METRICS.set_source(name, "cached")
+            print(f"[DEBUG] Reusing cached {name} results")
+            for candidate in source_data[name]:
+                resolve(resolver.add, candidate)
+            resolve(resolver.source_done, name)
+
+    # Sources run concurrently; candidates are matched as they arrive
+    fetched = {name: [] for name in wanted}
+    with METRICS.phase("fetch_sources"):
+        for name, candidate, completed in fetch_sources(wanted, settings):
+            if candidate is not None:
+                fetched[name].append(candidate)
+                resolve(resolver.add, candidate)
+                continue
+            if completed:
+                source_data[name] = fetched[name]
+                METRICS.set_source(name, "fetched")
+            elif name in source_data:
+                METRICS.set_source(name, "stale")
+                print(f"[WARN] Using previous '{name}' results ({get_breaker(name).state} circuit)")
+                seen = {c["id"] for c in fetched[name]}
+                for cached in source_data[name]:
+                    if cached["id"] not in seen:
+                        resolve(resolver.add, cached)
+            else:
+                METRICS.set_source(name, "partial" if fetched[name] else "failed")
+            resolve(resolver.source_done, name)
+
+    # Resolver time: incremental matching during the fetch, plus finish()
+    started = time.perf_counter()
+    cameras = resolver.finish()
+    METRICS.add_phase("resolve", started - resolve_time)
 
     # Summary
-    with_urls = sum(1 for c in discovered.values() if c["stream_url"])
-    print(f"[INFO] Discovery complete: {len(discovered)} cameras, {with_urls} with RTSP URLs")
+    with_urls = sum(1 for c in cameras if c["stream_url"])
+    METRICS.count("cameras_discovered", len(cameras))
+    METRICS.count("cameras_with_url", with_urls)
+    print(f"[INFO] Discovery complete: {len(cameras)} cameras, {with_urls} with RTSP URLs")
+
+    return cameras
+
 
-    return list(discovered.values())
+def add_stream_candidates(camera: Dict, urls: List[str], source: Optional[str] = None):
+    """Append stream URLs to a camera's candidates (first one is the stream_url).
+
+    ``source`` is recorded per URL in camera["candidate_sources"].
+    """
+    for url in urls:
+        if url and url not in camera["candidates"]:
+            camera["candidates"].append(url)
+            camera.setdefault("candidate_sources", {})[url] = source
+    if camera["candidates"]:
+        camera["stream_url"] = camera["candidates"][0]
 
 
 def generate_monocle_config(cameras: List[Dict]) -> Dict:
@@ -516,26 +3414,710 @@ def write_monocle_token(token: str, path: str = "/etc/monocle/monocle.token"):
     print("[INFO] Wrote Monocle token file")
 
 
-def write_monocle_config(config: Dict, path: str = "/etc/monocle/monocle.json"):
-    """Write Monocle configuration to file."""
+def canonical_monocle_config(config: Dict) -> str:
+    """Serialize a Monocle config canonically (sorted cameras, keys and tags).
+
+    The same camera set always produces the same bytes, regardless of the
+    order discovery found the cameras in.
+    """
+    cameras = []
+    for camera in config.get("cameras", []):
+        camera = dict(camera)
+        if isinstance(camera.get("tags"), list):
+            camera["tags"] = sorted(camera["tags"])
+        cameras.append(camera)
+    cameras.sort(key=lambda c: (c.get("name", "").lower(), c.get("name", ""), c.get("url", "")))
+    return json.dumps({**config, "cameras": cameras}, indent=2, sort_keys=True) + "\n"
+
+
+def diff_monocle_configs(old: Optional[Dict], new: Dict) -> Dict:
+    """Describe how the camera set changed between two Monocle configs.
+
+    Cameras are paired by name first (several cameras can share a name:
+    same name and URL first, then in URL order), then leftovers by URL (a
+    rename). Returns lists of added/removed names (a name is listed once
+    per camera), url_changed and changed (other fields, e.g. tags) names,
+    renamed (old, new) pairs, and ``restart``: whether the gateway must
+    restart. Renames alone don't restart it; the new names are on disk for
+    the next restart.
+    """
+    def by_name(config: Optional[Dict]) -> Dict[str, List[Dict]]:
+        cams = {}
+        for cam in sorted((config or {}).get("cameras", []), key=lambda c: str(c.get("url"))):
+            cams.setdefault(cam.get("name"), []).append(cam)
+        return cams
+
+    old_cams, new_cams = by_name(old), by_name(new)
+    url_changed, changed = [], []
+    old_only, new_only = [], []  # (name, camera) without a same-name partner
+    for name in sorted(old_cams.keys() | new_cams.keys(), key=str):
+        olds, news = list(old_cams.get(name, [])), []
+        pairs = []
+        for new_cam in new_cams.get(name, []):
+            same = next((cam for cam in olds if cam.get("url") == new_cam.get("url")), None)
+            if same is None:
+                news.append(new_cam)
+            else:
+                olds.remove(same)
+                pairs.append((same, new_cam))
+        while olds and news:
+            pairs.append((olds.pop(0), news.pop(0)))
+        old_only.extend((name, cam) for cam in olds)
+        new_only.extend((name, cam) for cam in news)
+        for old_cam, new_cam in pairs:
+            if old_cam.get("url") != new_cam.get("url"):
+                url_changed.append(name)
+            elif canonical_monocle_config({"cameras": [old_cam]}) != canonical_monocle_config({"cameras": [new_cam]}):
+                changed.append(name)
+
+    renamed = []
+    for name, cam in new_only[:]:
+        match = next((item for item in old_only if item[1].get("url") == cam.get("url")), None)
+        if match is not None:
+            old_only.remove(match)
+            new_only.remove((name, cam))
+            renamed.append((match[0], name))
+
+    diff = {
+        "added": sorted((name for name, _ in new_only), key=str),
+        "removed": sorted((name for name, _ in old_only), key=str),
+        "url_changed": url_changed,
+        "changed": changed,
+        "renamed": renamed,
+    }
+    diff["restart"] = bool(diff["added"] or diff["removed"] or url_changed or changed or old is None)
+    return diff
+
+
+def format_config_diff(diff: Dict) -> str:
+    """One-line human summary of diff_monocle_configs() output."""
+    parts = []
+    for key in ("added", "removed", "url_changed", "changed"):
+        if diff[key]:
+            parts.append(f"{key.replace('_', ' ')}: {', '.join(diff[key])}")
+    if diff["renamed"]:
+        parts.append("renamed: " + ", ".join(f"{a} -> {b}" for a, b in diff["renamed"]))
+    return "; ".join(parts) or "no changes"
+
+
+def write_monocle_config(config: Dict, path: str = MONOCLE_CONFIG_PATH) -> Dict:
+    """Write Monocle configuration to file (canonical, atomic, only if changed).
+
+    Writes to a temporary file in the same directory and renames it over
+    the old one, so the gateway never sees a partial file. Returns the
+    diff_monocle_configs() result against the previous file.
+    """
+    old = read_monocle_config(path)
+    diff = diff_monocle_configs(old, config)
+    content = canonical_monocle_config(config)
+    if old is not None and canonical_monocle_config(old) == content:
+        print("[DEBUG] Monocle config unchanged, not rewriting")
+        return diff
+
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w") as f:
-        json.dump(config, f, indent=2)
-    print(f"[INFO] Wrote Monocle config with {len(config.get('cameras', []))} cameras")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    print(f"[INFO] Wrote Monocle config with {len(config.get('cameras', []))} cameras "
+          f"({format_config_diff(diff)})")
+    return diff
 
 
-def main():
-    """Main entry point."""
-    options_path = "/data/options.json"
+def read_monocle_config(path: str = MONOCLE_CONFIG_PATH) -> Optional[Dict]:
+    """Read the Monocle configuration currently on disk (None if missing/invalid)."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def load_options(path: str = OPTIONS_PATH) -> Dict:
+    """Load add-on options written by the Supervisor."""
     options = {}
-    if os.path.exists(options_path):
-        with open(options_path) as f:
+    if os.path.exists(path):
+        with open(path) as f:
             options = json.load(f)
+    return options
+
+
+def build_monocle_config(options: Dict, source_data: Optional[Dict] = None,
+                         refresh: Optional[Set[str]] = None) -> Dict:
+    """Run discovery (if enabled) and return the Monocle configuration."""
+    if not options.get("auto_discover", True):
+        print("[INFO] Auto-discovery disabled")
+        return {"cameras": []}
+
+    camera_filters = options.get("camera_filters", [])
+    stream_quality = options.get("stream_quality", "high")
+    cameras = discover_cameras(camera_filters if camera_filters else None, stream_quality,
+                               source_data, refresh, channel_policy_from_options(options),
+                               options.get("source_priority"))
+    probe_mode = options.get("stream_probe", "prefer")
+    if probe_mode != "off":
+        with METRICS.phase("probe_streams"):
+            cameras = select_stream_urls(cameras, probe_mode)
+    if options.get("go2rtc_restream", False):
+        with METRICS.phase("go2rtc_restream"):
+            cameras = restream_via_go2rtc(cameras)
+    PREWARMER.update(cameras, options)
+    with METRICS.phase("generate_config"):
+        return generate_monocle_config(cameras)
+
+
+def run_discovery(options: Dict, config_path: str = MONOCLE_CONFIG_PATH,
+                  source_data: Optional[Dict] = None,
+                  refresh: Optional[Set[str]] = None) -> Tuple[Dict, Dict]:
+    """Build and write the Monocle config as one measured run.
+
+    Metrics for the run are written to METRICS_JSON_PATH/METRICS_PROM_PATH
+    afterwards (and a cProfile dump to PROFILE_PATH if profile_discovery is
+    set). Returns (config, write_monocle_config() diff).
+    """
+    METRICS.reset()
+    METRICS.runs += 1
+    METRICS.profiling = bool(options.get("profile_discovery", False))
+    try:
+        with METRICS.phase("total", profile=True):
+            config = build_monocle_config(options, source_data, refresh)
+            with METRICS.phase("write_config"):
+                diff = write_monocle_config(config, config_path)
+    finally:
+        METRICS.log_summary(METRICS.write())
+    return config, diff
+
+
+# =============================================================================
+# Last-known-good snapshot (warm start)
+# =============================================================================
+
+# Options that change the discovery result; a snapshot taken with other
+# values is not used for a warm start
+SNAPSHOT_OPTION_KEYS = ("auto_discover", "camera_filters", "stream_quality",
+                        "bandwidth_budget", "camera_quality", "stream_probe",
+                        "go2rtc_restream", "source_priority")
+
+
+def snapshot_fingerprint(options: Dict) -> str:
+    return json.dumps({key: options.get(key) for key in SNAPSHOT_OPTION_KEYS}, sort_keys=True)
+
+
+def save_discovery_snapshot(config: Dict, source_data: Dict, options: Dict,
+                            path: Optional[str] = None):
+    """Persist a successful discovery result (config and raw source results)."""
+    path = path or SNAPSHOT_PATH
+    snapshot = {
+        "saved": time.time(),
+        "options": snapshot_fingerprint(options),
+        "config": config,
+        "source_data": source_data,
+    }
+    try:
+        # Stream URLs can carry credentials or rtspAlias tokens: owner-only, atomic
+        tmp_path = f"{path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        print(f"[DEBUG] Could not save discovery snapshot: {e}")
+
+
+def load_discovery_snapshot(options: Dict, path: Optional[str] = None) -> Optional[Dict]:
+    """Return the last snapshot if it was taken with the current options."""
+    path = path or SNAPSHOT_PATH
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except Exception:
+        return None
+    if not isinstance(snapshot, dict) or not isinstance(snapshot.get("config"), dict):
+        return None
+    if snapshot.get("options") != snapshot_fingerprint(options):
+        print("[INFO] Discovery options changed, not using the saved camera snapshot")
+        return None
+    return snapshot
+
+
+# =============================================================================
+# Event-driven discovery (HA WebSocket API)
+# =============================================================================
+
+# Event reason for a WebSocket reconnect (usually an HA restart)
+HA_RECONNECTED_REASON = "Home Assistant reconnected"
+
+# Config entry domains whose changes affect a discovery source
+CONFIG_ENTRY_SOURCES = {
+    "unifiprotect": {SOURCE_UNIFI},
+    "go2rtc": {SOURCE_GO2RTC},
+}
+
+# Camera attributes that change the discovery result (access_token and
+# entity_picture rotate every few minutes and must not trigger a refresh)
+CAMERA_DISCOVERY_ATTRIBUTES = ("friendly_name", "stream_source", "rtsp_url",
+                               "video_url", "stream_url", "rtsp_stream")
+
+
+class HAEventListener(threading.Thread):
+    """Subscribe to HA registry/state events and report affected sources.
+
+    Calls ``on_change(sources, reason)`` with the set of discovery sources
+    that need to be re-fetched. Reconnects with backoff; after a reconnect
+    every source is reported, since events may have been missed.
+
+    HA writes the entity and device registries to .storage only about 10
+    seconds after a registry event, so a refresh right after the event
+    still reads the old files. Registry events are therefore reported a
+    second time once REGISTRY_SAVE_DELAY has passed since the last one.
+    """
+
+    REGISTRY_EVENTS = ("entity_registry_updated", "device_registry_updated")
+    # HA's registry save delay (10 s) plus some margin
+    REGISTRY_SAVE_DELAY = 15
+
+    SUBSCRIPTIONS = [
+        {"type": "subscribe_events", "event_type": "entity_registry_updated"},
+        {"type": "subscribe_events", "event_type": "device_registry_updated"},
+        {"type": "config_entries/subscribe"},
+        {"type": "subscribe_events", "event_type": "state_changed"},
+    ]
+
+    def __init__(self, on_change: Callable[[Set[str], str], None],
+                 url: str = HA_WS_URL, token: Optional[str] = None):
+        super().__init__(name="ha-events", daemon=True)
+        self.on_change = on_change
+        self.url = url
+        self.token = token or SUPERVISOR_TOKEN
+        self.connected = False
+        self._ws = None
+        self._stopping = threading.Event()
+        self._followup = None  # timer for the post-save refresh of registry events
+        self._followup_sources = set()
+        self._followup_lock = threading.Lock()
+
+    def stop(self):
+        self._stopping.set()
+        with self._followup_lock:
+            if self._followup is not None:
+                self._followup.cancel()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def run(self):
+        backoff = 1
+        has_connected = False
+        while not self._stopping.is_set():
+            try:
+                self._connect()
+                if has_connected:
+                    self.on_change(set(SOURCES), HA_RECONNECTED_REASON)
+                has_connected = True
+                backoff = 1
+                self._read_loop()
+            except Exception as e:
+                if not self._stopping.is_set():
+                    print(f"[WARN] HA event connection lost: {e}")
+            finally:
+                self.connected = False
+                if self._ws is not None:
+                    try:
+                        self._ws.close()
+                    except Exception:
+                        pass
+                    self._ws = None
+            self._stopping.wait(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def _connect(self):
+        ws = websocket.create_connection(self.url, timeout=10)
+        self._ws = ws
+        msg = json.loads(ws.recv())
+        if msg.get("type") == "auth_required":
+            ws.send(json.dumps({"type": "auth", "access_token": self.token}))
+            msg = json.loads(ws.recv())
+        if msg.get("type") != "auth_ok":
+            raise ConnectionError(f"authentication failed: {msg.get('message', msg.get('type'))}")
+
+        for msg_id, subscription in enumerate(self.SUBSCRIPTIONS, start=1):
+            ws.send(json.dumps({"id": msg_id, **subscription}))
+        self.connected = True
+        print(f"[INFO] Subscribed to Home Assistant events at {self.url}")
+
+    def _read_loop(self):
+        ws = self._ws
+        ws.settimeout(60)
+        while not self._stopping.is_set():
+            try:
+                raw = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                ws.ping()
+                continue
+            if not raw:
+                raise ConnectionError("connection closed")
+            # Cheap pre-filter: most traffic is state_changed for non-camera entities
+            if '"state_changed"' in raw and '"entity_id":"camera.' not in raw:
+                continue
+            msg = json.loads(raw)
+            sources, reason = self.handle_message(msg)
+            if sources:
+                self.on_change(sources, reason)
+                event = msg.get("event")
+                if isinstance(event, dict) and event.get("event_type") in self.REGISTRY_EVENTS:
+                    self._schedule_followup(sources)
+
+    def _schedule_followup(self, sources: Set[str]):
+        """Report ``sources`` again once HA has saved the registries."""
+        with self._followup_lock:
+            self._followup_sources |= sources
+            if self._followup is not None:
+                self._followup.cancel()
+            self._followup = threading.Timer(self.REGISTRY_SAVE_DELAY, self._run_followup)
+            self._followup.daemon = True
+            self._followup.start()
+
+    def _run_followup(self):
+        with self._followup_lock:
+            sources, self._followup_sources = self._followup_sources, set()
+            self._followup = None
+        if sources and not self._stopping.is_set():
+            self.on_change(sources, "registry saved to disk")
+
+    @staticmethod
+    def handle_message(msg: Dict) -> Tuple[Set[str], str]:
+        """Map one WebSocket message to the discovery sources it invalidates."""
+        if msg.get("type") == "result" and not msg.get("success", True):
+            print(f"[WARN] HA subscription {msg.get('id')} failed: {msg.get('error')}")
+            return set(), ""
+        if msg.get("type") != "event":
+            return set(), ""
+
+        event = msg.get("event")
+        if isinstance(event, list):
+            # config_entries/subscribe: [{"type": "added"|"removed"|"updated"|None, "entry": {...}}]
+            sources = set()
+            for change in event:
+                if change.get("type") is None:
+                    continue  # Initial snapshot, not a change
+                domain = change.get("entry", {}).get("domain", "")
+                sources |= CONFIG_ENTRY_SOURCES.get(domain, set())
+            return sources, "config entry changed"
+
+        event_type = event.get("event_type")
+        data = event.get("data", {})
+        if event_type == "entity_registry_updated":
+            if data.get("entity_id", "").startswith("camera."):
+                return {SOURCE_ENTITIES, SOURCE_UNIFI}, f"{data['entity_id']} {data.get('action')}"
+        elif event_type == "device_registry_updated":
+            # Device names are used for UniFi camera names
+            return {SOURCE_UNIFI}, f"device {data.get('device_id')} {data.get('action')}"
+        elif event_type == "state_changed":
+            entity_id = data.get("entity_id", "")
+            if not entity_id.startswith("camera."):
+                return set(), ""
+            old_state = data.get("old_state")
+            new_state = data.get("new_state")
+            if old_state is None or new_state is None:
+                return {SOURCE_ENTITIES}, f"{entity_id} added/removed"
+            old_attrs = old_state.get("attributes", {})
+            new_attrs = new_state.get("attributes", {})
+            if any(old_attrs.get(a) != new_attrs.get(a) for a in CAMERA_DISCOVERY_ATTRIBUTES):
+                return {SOURCE_ENTITIES}, f"{entity_id} attributes changed"
+        return set(), ""
+
+
+# =============================================================================
+# Adaptive refresh scheduling
+# =============================================================================
+
+REFRESH_BACKOFF_FACTOR = 2
+REFRESH_JITTER = 0.1  # +/- share of the interval added to each delay
+
+
+class RefreshScheduler:
+    """Interval between full refreshes, adapted to how often results change.
+
+    Starts at ``floor`` (refresh_interval). Each full refresh with the same
+    result as the previous one multiplies the interval by
+    REFRESH_BACKOFF_FACTOR, up to ``ceiling`` (max_refresh_interval); a
+    camera change, a failed or incomplete run, or an HA restart drops it
+    back to the floor. Every delay gets REFRESH_JITTER so several add-ons
+    or NVR clients do not refresh at the same moment.
+    """
+
+    def __init__(self, floor: float, ceiling: float):
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.interval = floor
+        self.reason = "startup"
+        self.unchanged_runs = 0
+
+    def record(self, outcome: str, detail: str = ""):
+        """Adapt to a run: "unchanged", "changed", "error" or "restart"."""
+        if outcome == "unchanged":
+            self.unchanged_runs += 1
+            self.interval = min(self.interval * REFRESH_BACKOFF_FACTOR, self.ceiling)
+            self.reason = f"no changes in {self.unchanged_runs} run(s)"
+            return
+        self.unchanged_runs = 0
+        self.interval = self.floor
+        self.reason = {"changed": "cameras changed", "error": "discovery error",
+                       "restart": "Home Assistant restarted"}.get(outcome, outcome)
+        if detail:
+            self.reason += f" ({detail})"
+
+    def next_delay(self, minimum: float = 0) -> Tuple[float, str]:
+        """Seconds until the next full refresh (jittered) and why."""
+        interval, reason = self.interval, self.reason
+        if minimum > interval:
+            interval, reason = minimum, f"{reason}; event connection up"
+        return interval * random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER), reason
+
+
+# =============================================================================
+# Discovery service (long-running daemon mode)
+# =============================================================================
+
+class DiscoveryService:
+    """Long-running discovery loop with its own scheduler.
+
+    Runs discovery inside one process, so the interpreter, imports and the
+    raw per-source results survive between cycles. In "events" mode, HA
+    WebSocket events mark individual sources dirty and trigger a debounced
+    partial refresh; a full resync still runs at least EVENT_RESYNC_INTERVAL
+    apart. In "poll" mode (or while the event connection is down) full
+    refreshes follow a RefreshScheduler: every refresh_interval at first,
+    backing off towards max_refresh_interval while nothing changes.
+
+    On start, the last successful result saved under /data is written to
+    monocle.json right away (warm start), so the gateway can start before
+    the first discovery finishes; that discovery then only changes the
+    config if its result differs.
+
+    The Monocle config is only rewritten when the result changes, and
+    run.sh is told about it through a line-based notification FIFO:
+
+        ready    first discovery finished, gateway can be started
+        changed  monocle.json was rewritten, gateway must be restarted
+    """
+
+    # Quiet period after the last event before refreshing, and the longest
+    # a burst of events can delay a refresh
+    DEBOUNCE_SECONDS = 3
+    DEBOUNCE_MAX_SECONDS = 30
+    EVENT_RESYNC_INTERVAL = 3600
+
+    def __init__(self, options: Dict, notify_path: Optional[str] = None,
+                 config_path: str = MONOCLE_CONFIG_PATH):
+        self.options = options
+        self.notify_path = notify_path
+        self.config_path = config_path
+        self.interval = int(options.get("refresh_interval", 300))
+        self.scheduler = RefreshScheduler(self.interval, int(options.get("max_refresh_interval", 3600)))
+        self.mode = options.get("discovery_mode", "events")
+        self.last_config = read_monocle_config(config_path)
+        self.source_data = {}  # source name -> raw result, reused between cycles
+        self.cycles = 0
+        self.listener = None
+        self._dirty = set()
+        self._dirty_reasons = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def notify(self, event: str):
+        """Send an event line to run.sh (no-op without a notification FIFO)."""
+        if not self.notify_path:
+            return
+        try:
+            # Non-blocking open: if nobody is reading, drop the event instead of hanging
+            fd = os.open(self.notify_path, os.O_WRONLY | os.O_NONBLOCK)
+            try:
+                os.write(fd, f"{event}\n".encode())
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"[WARN] Could not send '{event}' notification: {e}")
+
+    def mark_dirty(self, sources: Set[str], reason: str = ""):
+        """Invalidate cached sources and wake the scheduler (thread-safe).
+
+        An event about a source means its upstream (or its configuration)
+        changed, so the source's circuit breakers are reset too.
+        """
+        for source in sources:
+            reset_breakers(source)
+        if reason == HA_RECONNECTED_REASON:
+            self.scheduler.record("restart")
+        with self._lock:
+            self._dirty |= set(sources)
+            if reason:
+                self._dirty_reasons.append(reason)
+        print(f"[DEBUG] Event: {reason} -> refresh {', '.join(sorted(sources))}")
+        self._wake.set()
+
+    def run_cycle(self, sources: Optional[Set[str]] = None) -> bool:
+        """Run one discovery cycle, re-fetching ``sources`` (default: all).
+
+        Returns True if the effective camera set changed and the gateway
+        must be restarted.
+        """
+        self.cycles += 1
+        refresh = set(SOURCES) if sources is None else sources
+        config, diff = run_discovery(self.options, self.config_path, self.source_data, refresh)
+        self.last_config = config
+        incomplete = [name for name in SOURCES if METRICS.sources.get(name) not in ("fetched", "cached")]
+        if incomplete:
+            self.scheduler.record("error", f"{', '.join(incomplete)} not refreshed")
+        elif diff["restart"] or diff["renamed"]:
+            self.scheduler.record("changed")
+        elif refresh >= set(SOURCES):
+            # Only full refreshes count towards backing off
+            self.scheduler.record("unchanged")
+        # Only complete results become the warm start snapshot
+        if not incomplete:
+            save_discovery_snapshot(config, self.source_data, self.options)
+        if not diff["restart"]:
+            if diff["renamed"]:
+                print(f"[INFO] Camera names changed ({format_config_diff(diff)}), "
+                      "applied on next gateway restart")
+            else:
+                print("[INFO] No camera changes detected")
+        return diff["restart"]
+
+    def warm_start(self) -> bool:
+        """Write monocle.json from the saved snapshot; True if one was used."""
+        snapshot = load_discovery_snapshot(self.options)
+        if snapshot is None:
+            return False
+        config = snapshot["config"]
+        write_monocle_config(config, self.config_path)
+        self.last_config = config
+        # Previous raw results stand in for sources that fail the first refresh
+        self.source_data = {name: data for name, data in (snapshot.get("source_data") or {}).items()
+                            if name in SOURCES and valid_source_data(name, data)}
+        age = max(0, time.time() - snapshot.get("saved", time.time()))
+        print(f"[INFO] Warm start: {len(config.get('cameras', []))} cameras from snapshot "
+              f"({age / 3600:.1f}h old), refreshing in the background")
+        return True
+
+    def stop(self, *_args):
+        """Ask the scheduler loop to exit (also used as signal handler)."""
+        self._stop.set()
+        self._wake.set()
+
+    def _resync_interval(self) -> float:
+        connected = self.listener is not None and self.listener.connected
+        delay, reason = self.scheduler.next_delay(self.EVENT_RESYNC_INTERVAL if connected else 0)
+        print(f"[INFO] Next full refresh in {delay:.0f}s "
+              f"(interval {self.scheduler.interval:.0f}s: {reason})")
+        return delay
+
+    def _wait_for_work(self) -> Optional[Set[str]]:
+        """Block until the next cycle is due; return the sources to refresh.
+
+        Returns None when the service is stopping.
+        """
+        if not self._wake.wait(self._resync_interval()):
+            print("[INFO] Refreshing camera list...")
+            return set(SOURCES)
+
+        # Debounce: wait for a quiet period so bursts of events cause one refresh
+        deadline = time.monotonic() + self.DEBOUNCE_MAX_SECONDS
+        while not self._stop.is_set():
+            self._wake.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._wake.wait(min(self.DEBOUNCE_SECONDS, remaining)):
+                break
+        if self._stop.is_set():
+            return None
+
+        with self._lock:
+            sources, reasons = self._dirty, self._dirty_reasons
+            self._dirty, self._dirty_reasons = set(), []
+        if sources:
+            print(f"[INFO] Refreshing {', '.join(sorted(sources))} "
+                  f"({len(reasons)} event(s), e.g. {reasons[0] if reasons else 'n/a'})")
+        return sources
+
+    def _start_listener(self):
+        if self.mode != "events":
+            return
+        if websocket is None:
+            print("[WARN] websocket-client not installed, falling back to polling")
+            return
+        self.listener = HAEventListener(self.mark_dirty)
+        self.listener.start()
+        enable_unifi_live_updates(self.mark_dirty)
+
+    def run(self):
+        """Run the first discovery, then refresh on events/schedule until stopped."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        print(f"[INFO] Discovery service started (mode: {self.mode}, refresh every {self.interval}s)")
+        self._start_listener()
+        PREWARMER.start(self.options)
+        warm = self.warm_start()
+        if warm:
+            self.notify("ready")
+        try:
+            if self.run_cycle() and warm:
+                print("[INFO] Camera configuration changed since the snapshot")
+                self.notify("changed")
+        except Exception as e:
+            print(f"[ERROR] Initial discovery failed: {e}")
+            self.scheduler.record("error", str(e))
+        if not warm:
+            if self.last_config is None:
+                # Gateway needs a config file to start, even an empty one
+                self.last_config = {"cameras": []}
+                write_monocle_config(self.last_config, self.config_path)
+            self.notify("ready")
+
+        while True:
+            sources = self._wait_for_work()
+            if sources is None:
+                break
+            if not sources:
+                continue
+            try:
+                if self.run_cycle(sources):
+                    print("[INFO] Camera configuration changed")
+                    self.notify("changed")
+            except Exception as e:
+                print(f"[ERROR] Discovery cycle failed: {e}")
+                self.scheduler.record("error", str(e))
+
+        if self.listener is not None:
+            self.listener.stop()
+        PREWARMER.stop()
+        print("[INFO] Discovery service stopped")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Auto-discover cameras for Monocle Gateway")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and refresh cameras every refresh_interval")
+    parser.add_argument("--notify", metavar="FIFO",
+                        help="FIFO to write ready/changed events to (daemon mode)")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Main entry point."""
+    args = parse_args(argv)
+    options = load_options()
 
     monocle_token = options.get("monocle_token", "")
     auto_discover = options.get("auto_discover", True)
-    stream_quality = options.get("stream_quality", "high")
-    camera_filters = options.get("camera_filters", [])
 
     if not monocle_token:
         print("[ERROR] Monocle token not configured", file=sys.stderr)
@@ -548,14 +4130,11 @@ def main():
     print("[INFO] Starting camera discovery...")
     write_monocle_token(monocle_token)
 
-    if auto_discover:
-        cameras = discover_cameras(camera_filters if camera_filters else None, stream_quality)
-        config = generate_monocle_config(cameras)
-        write_monocle_config(config)
-    else:
-        print("[INFO] Auto-discovery disabled")
-        write_monocle_config({"cameras": []})
+    if args.daemon and auto_discover:
+        DiscoveryService(options, notify_path=args.notify).run()
+        return
 
+    run_discovery(options)
     print("[INFO] Camera discovery complete")
 
 
@@ -6,11 +6,11 @@ echo "  Auto-Monocle Add-on Starting"
 echo "========================================"
 
 MONOCLE_CONFIG="/etc/monocle/monocle.json"
+EVENTS_FIFO="/tmp/monocle-discovery.events"
 
 # Read configuration
 MONOCLE_TOKEN=$(bashio::config 'monocle_token')
 AUTO_DISCOVER=$(bashio::config 'auto_discover')
-REFRESH_INTERVAL=$(bashio::config 'refresh_interval')
 
 if [ -z "$MONOCLE_TOKEN" ] || [ "$MONOCLE_TOKEN" = "null" ]; then
     bashio::log.error "Monocle token not configured!"
@@ -18,9 +18,39 @@ if [ -z "$MONOCLE_TOKEN" ] || [ "$MONOCLE_TOKEN" = "null" ]; then
     exit 1
 fi
 
-# Run camera discovery (also writes token file)
-bashio::log.info "Running camera discovery..."
-python3 /opt/monocle/discover_cameras.py
+start_gateway() {
+    cd /opt/monocle
+    ./monocle-gateway &
+    GATEWAY_PID=$!
+}
+
+if [ "$AUTO_DISCOVER" = "true" ]; then
+    # Start the discovery service once; it refreshes cameras in-process and
+    # reports "ready"/"changed" events through a FIFO (also writes token file)
+    rm -f "$EVENTS_FIFO"
+    mkfifo "$EVENTS_FIFO"
+    # Open read-write so the FIFO never hits EOF between events
+    exec 3<>"$EVENTS_FIFO"
+
+    bashio::log.info "Starting camera discovery service..."
+    python3 /opt/monocle/discover_cameras.py --daemon --notify "$EVENTS_FIFO" &
+    DISCOVERY_PID=$!
+
+    # Wait for a usable config: the saved snapshot (warm start) or the first discovery
+    EVENT=""
+    while [ "$EVENT" != "ready" ]; do
+        if ! read -r -t 5 EVENT <&3; then
+            if ! kill -0 "$DISCOVERY_PID" 2>/dev/null; then
+                bashio::log.error "Camera discovery service exited!"
+                exit 1
+            fi
+        fi
+    done
+else
+    # Run camera discovery once (also writes token file)
+    bashio::log.info "Running camera discovery..."
+    python3 /opt/monocle/discover_cameras.py
+fi
 
 if [ ! -f "/etc/monocle/monocle.token" ]; then
     bashio::log.error "Monocle token file not created!"
@@ -32,41 +62,37 @@ if [ "$AUTO_DISCOVER" = "true" ] && [ ! -f "$MONOCLE_CONFIG" ]; then
     exit 1
 fi
 
-# Get initial config hash
-CONFIG_HASH=$(md5sum "$MONOCLE_CONFIG" 2>/dev/null | cut -d' ' -f1 || echo "none")
-
-# Start camera refresh in background (restarts gateway on changes)
-if [ "$AUTO_DISCOVER" = "true" ]; then
-    (
-        while true; do
-            sleep "$REFRESH_INTERVAL"
-            bashio::log.info "Refreshing camera list..."
-            python3 /opt/monocle/discover_cameras.py
-
-            # Check if config changed
-            NEW_HASH=$(md5sum "$MONOCLE_CONFIG" 2>/dev/null | cut -d' ' -f1 || echo "none")
-            if [ "$NEW_HASH" != "$CONFIG_HASH" ]; then
-                bashio::log.info "Camera configuration changed, restarting Monocle Gateway..."
-                CONFIG_HASH="$NEW_HASH"
-                pkill -f monocle-gateway || true
-                sleep 2
-                cd /opt/monocle
-                ./monocle-gateway &
-                bashio::log.info "Monocle Gateway restarted"
-            else
-                bashio::log.info "No camera changes detected"
-            fi
-        done
-    ) &
-fi
-
 bashio::log.info "Starting Monocle Gateway..."
 bashio::log.info "Make sure port 443 is forwarded to this add-on"
+start_gateway
+
+if [ "$AUTO_DISCOVER" != "true" ]; then
+    # Wait for gateway process (keeps container alive)
+    wait $GATEWAY_PID
+    exit $?
+fi
 
-# Start Monocle Gateway (in foreground to keep container alive)
-cd /opt/monocle
-./monocle-gateway &
-GATEWAY_PID=$!
+# Restart the gateway whenever the discovery service reports a change
+while true; do
+    if read -r -t 30 EVENT <&3; then
+        if [ "$EVENT" = "changed" ]; then
+            bashio::log.info "Camera configuration changed, restarting Monocle Gateway..."
+            kill "$GATEWAY_PID" 2>/dev/null || true
+            wait "$GATEWAY_PID" 2>/dev/null || true
+            sleep 2
+            start_gateway
+            bashio::log.info "Monocle Gateway restarted"
+        fi
+    fi
 
-# Wait for gateway process
-wait $GATEWAY_PID
+    if ! kill -0 "$GATEWAY_PID" 2>/dev/null; then
+        bashio::log.error "Monocle Gateway exited"
+        kill "$DISCOVERY_PID" 2>/dev/null || true
+        exit 1
+    fi
+    if ! kill -0 "$DISCOVERY_PID" 2>/dev/null; then
+        bashio::log.error "Camera discovery service exited"
+        kill "$GATEWAY_PID" 2>/dev/null || true
+        exit 1
+    fi
+done